@@ -1,42 +1,406 @@
 import os
+import csv
+import contextlib
+import hashlib
+import json
+import sqlite3
+import threading
+import warnings
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+import multiscale
 import multiscale.utility_functions as util
 import pandas as pd
 from pathlib import Path
 
 
-def dataframe_generator_excel(analysis_list, index, relevant_cols=None):
+def prefetched(load_function, items):
+        """
+        Yield load_function(item) for each item, loading the next item on a background thread while the
+        current one is being used
+        
+        :param load_function: Function that loads one item, e.g. reads a file into a dataframe
+        :param items: Items to load, in order
+        :return: Generator of the loaded items
+        """
+        items = list(items)
+        if not items:
+                return
+        
+        with ThreadPoolExecutor(max_workers=1) as executor:
+                future = executor.submit(load_function, items[0])
+                for next_item in items[1:]:
+                        current = future.result()
+                        future = executor.submit(load_function, next_item)
+                        yield current
+                
+                yield future.result()
+
+
+def _read_excel_frame(item, index, relevant_cols):
+        usecols = None if relevant_cols is None else [index] + list(relevant_cols)
+        df = pd.read_excel(str(item), index_col=index, usecols=usecols)
+        df.name = item.stem
+        return df
+
+
+def dataframe_generator_excel(analysis_list, index, relevant_cols=None, prefetch=True):
         """
         Generator to yield dataframes from a list of excel docs, one at a time
         
         analysis_list = the list of excel docs
         index = index column of the excel doc
-        relevant_cols = subset of dataframe to return
+        relevant_cols = subset of dataframe to return, the only columns read from the file
+        prefetch = read the next doc on a background thread while the current one is used
         """
         
-        if relevant_cols is None:
+        def read(item):
+                return _read_excel_frame(item, index, relevant_cols)
+        
+        if prefetch:
+                yield from prefetched(read, analysis_list)
+        else:
                 for item in analysis_list:
-                        dataframe = pd.read_excel(str(item), index_col = index)
-                        dataframe.name = item.stem
-                        yield dataframe
+                        yield read(item)
+
+
+def dataframe_generator_csv(analysis_list, relevant_cols=None, engine=None, prefetch=True):
+        """
+        Generator to yield dataframes from a list of csv files, one at a time
+        
+        analysis_list = the list of csv files
+        relevant_cols = subset of columns to read from each file
+        engine = csv parser engine, e.g. 'pyarrow' for the multithreaded Arrow reader
+        prefetch = read the next file on a background thread while the current one is used
+        """
+        
+        def read(item):
+                return pd.read_csv(str(item), usecols=relevant_cols, engine=engine)
+        
+        if prefetch:
+                yield from prefetched(read, analysis_list)
         else:
                 for item in analysis_list:
-                        df = pd.read_excel(str(item), index_col = index)
-                        output_df = df[relevant_cols]
-                        output_df.name = item.stem
-                        yield output_df
+                        yield read(item)
+
 
+_results_types = {'str': str, 'float': 'float64', 'int': 'int64'}
 
-def dataframe_generator_csv(analysis_list):
+
+def _results_format(output_path):
+        """Pick the results file format from the file extension"""
+        extension = Path(output_path).suffix.lower()
+        
+        if extension in ('.parquet', '.pq'):
+                return 'parquet'
+        elif extension in ('.arrow', '.feather'):
+                return 'arrow'
+        else:
+                return 'csv'
+
+
+class ResultsWriter(object):
+        def __init__(self, output_path, columns: dict, batch_size: int=10000):
+                """
+                Buffered, typed writer for tile and ROI analysis results.
+                
+                Rows are collected in memory and written in batches.  The output format follows the file extension:
+                .parquet for Parquet, .arrow/.feather for the Arrow IPC format, and csv for anything else.
+                Parquet and Arrow output require pyarrow.
+                
+                :param output_path: Path to the results file
+                :param columns: Ordered dictionary of column name to type, where type is 'str', 'float', or 'int'
+                :param batch_size: Number of rows to buffer before writing them out
+                """
+                self.output_path = Path(output_path)
+                self.columns = dict(columns)
+                self.batch_size = batch_size
+                self.file_format = _results_format(output_path)
+                
+                self._rows = []
+                self._writer = None
+                self._file = None
+        
+        def __enter__(self):
+                return self
+        
+        def __exit__(self, exc_type, exc_value, traceback):
+                self.close()
+        
+        def write_row(self, row):
+                """Add a single row, ordered the same as the columns"""
+                self._rows.append(row)
+                
+                if len(self._rows) >= self.batch_size:
+                        self.flush()
+        
+        def write_rows(self, rows):
+                """Add several rows, each ordered the same as the columns"""
+                for row in rows:
+                        self.write_row(row)
+        
+        def write_dataframe(self, dataframe: pd.DataFrame):
+                """Write a dataframe holding the results columns, after any buffered rows"""
+                self.flush()
+                self._write_batch(dataframe[list(self.columns)])
+        
+        def _rows_dataframe(self, rows):
+                return pd.DataFrame(rows, columns=list(self.columns))
+        
+        def _write_batch(self, dataframe):
+                dataframe = dataframe.astype({name: _results_types[kind] for name, kind in self.columns.items()})
+                
+                if self.file_format == 'csv':
+                        if self._file is None:
+                                self._file = open(str(self.output_path), 'w', newline='')
+                                csv.writer(self._file).writerow(list(self.columns))
+                        dataframe.to_csv(self._file, header=False, index=False)
+                        return
+                
+                import pyarrow as pa
+                
+                table = pa.Table.from_pandas(dataframe, schema=self._arrow_schema(pa), preserve_index=False)
+                
+                if self._writer is None:
+                        if self.file_format == 'parquet':
+                                import pyarrow.parquet as pq
+                                self._writer = pq.ParquetWriter(str(self.output_path), table.schema)
+                        else:
+                                self._file = pa.OSFile(str(self.output_path), 'wb')
+                                self._writer = pa.ipc.new_file(self._file, table.schema)
+                
+                self._writer.write_table(table)
+        
+        def _arrow_schema(self, pa):
+                arrow_types = {'str': pa.string(), 'float': pa.float64(), 'int': pa.int64()}
+                return pa.schema([(name, arrow_types[kind]) for name, kind in self.columns.items()])
+        
+        def flush(self):
+                """Write out any buffered rows"""
+                if self._rows:
+                        self._write_batch(self._rows_dataframe(self._rows))
+                        self._rows = []
+        
+        def close(self):
+                """Write out buffered rows and close the file, writing a header-only file if nothing was added"""
+                if self._writer is None and self._file is None:
+                        self._write_batch(self._rows_dataframe(self._rows))
+                        self._rows = []
+                else:
+                        self.flush()
+                
+                if self._writer is not None:
+                        self._writer.close()
+                        self._writer = None
+                
+                if self._file is not None:
+                        self._file.close()
+                        self._file = None
+
+
+def write_results(dataframe: pd.DataFrame, output_path, columns: dict):
+        """Write a results dataframe in one call, in the format given by the output file extension"""
+        with ResultsWriter(output_path, columns) as writer:
+                writer.write_dataframe(dataframe)
+
+
+def read_results(file_path, index_levels: int=0, column_levels: int=1, columns: list=None, dtype: dict=None):
         """
-        Generator to yield dataframes from a list of excel docs, one at a time
+        Read a results table written as csv, Parquet, or Arrow
+        
+        :param file_path: Path to the results file
+        :param index_levels: Number of leading csv columns that form the index.  Stored formats keep their index.
+        :param column_levels: Number of csv header rows, for pivoted tables with multi-level columns
+        :param columns: Subset of columns to read
+        :param dtype: Column types for csv files, which otherwise are inferred.  Stored formats keep their types.
+        :return: Dataframe of the results
+        """
+        file_format = _results_format(file_path)
         
-        analysis_list = the list of excel docs
-        index = index column of the excel doc
-        relevant_cols = subset of dataframe to return
+        if file_format == 'parquet':
+                return pd.read_parquet(str(file_path), columns=columns)
+        
+        if file_format == 'arrow':
+                return pd.read_feather(str(file_path), columns=columns)
+        
+        index_col = list(range(index_levels)) if index_levels else None
+        
+        if column_levels > 1:
+                return pd.read_csv(str(file_path), header=list(range(column_levels)), index_col=index_col,
+                                   dtype=dtype, low_memory=False)
+        
+        return pd.read_csv(str(file_path), index_col=index_col, usecols=columns, dtype=dtype, low_memory=False)
+
+
+class ResultsStore(object):
+        """
+        A keyed results table held in memory, with the index and column semantics of write_pandas_row and
+        write_pandas_value.  Writes are buffered and flushed atomically to the results file every few writes,
+        instead of re-reading and rewriting the whole file on each call.
         """
-        for item in analysis_list:
-                df = pd.read_csv(str(item))
-                yield df
+        def __init__(self, file_path, index_label, column_labels=None, flush_every: int=100):
+                """
+                :param file_path: Path to the results file.  The format is picked from the extension, csv by default
+                :param index_label: Label of the index column
+                :param column_labels: Labels for each column, used when creating a new file
+                :param flush_every: Number of writes between flushes to disk
+                """
+                self.file_path = Path(file_path)
+                self.index_label = index_label
+                self.flush_every = flush_every
+                
+                self._data = self._load(column_labels)
+                self._pending = {}
+                self._writes_since_flush = 0
+        
+        def __enter__(self):
+                return self
+        
+        def __exit__(self, exc_type, exc_value, traceback):
+                self.close()
+        
+        def _load(self, column_labels):
+                file_format = _results_format(self.file_path)
+                
+                if self.file_path.is_file():
+                        if file_format == 'parquet':
+                                data = pd.read_parquet(str(self.file_path))
+                        elif file_format == 'arrow':
+                                data = pd.read_feather(str(self.file_path))
+                        else:
+                                data = pd.read_csv(str(self.file_path), dtype={self.index_label: str})
+                        
+                        if self.index_label in data.columns:
+                                data = data.set_index(self.index_label)
+                        data.index = data.index.astype(str)
+                        return data
+                
+                print('Creating new file {0} in {1}'.format(self.file_path.name, self.file_path.parent))
+                return pd.DataFrame(index=pd.Index([], dtype='object', name=self.index_label),
+                                    columns=column_labels)
+        
+        def write_row(self, index, column_values, column_labels=None):
+                """Write the values of a whole row, by default in the order of the existing columns"""
+                if column_labels is None:
+                        column_labels = list(self._data.columns)
+                self._pending.setdefault(str(index), {}).update(zip(column_labels, column_values))
+                self._count_write()
+        
+        def write_value(self, index, column, value):
+                """Write a single value"""
+                self._pending.setdefault(str(index), {})[column] = value
+                self._count_write()
+        
+        def read_row(self, index):
+                """Read a row, including unflushed writes.  Raises a KeyError if the row does not exist"""
+                self._merge_pending()
+                return self._data.loc[str(index)]
+        
+        def __contains__(self, index):
+                return str(index) in self._pending or str(index) in self._data.index
+        
+        def dataframe(self):
+                """The whole table, including unflushed writes"""
+                self._merge_pending()
+                return self._data.copy()
+        
+        def _count_write(self):
+                self._writes_since_flush += 1
+                if self._writes_since_flush >= self.flush_every:
+                        self.flush()
+        
+        def _merge_pending(self):
+                if not self._pending:
+                        return
+                
+                data = self._data
+                new_rows = [index for index in self._pending if index not in data.index]
+                if new_rows:
+                        data = data.reindex(data.index.append(pd.Index(new_rows, dtype='object')))
+                        data.index.name = self.index_label
+                
+                columns = {}
+                for index, values in self._pending.items():
+                        for column, value in values.items():
+                                columns.setdefault(column, ([], []))
+                                columns[column][0].append(index)
+                                columns[column][1].append(value)
+                
+                for column, (rows, values) in columns.items():
+                        if column not in data.columns:
+                                data[column] = pd.Series(index=data.index, dtype=object)
+                        try:
+                                data.loc[rows, column] = values
+                        except (TypeError, ValueError):
+                                data[column] = data[column].astype(object)
+                                data.loc[rows, column] = values
+                
+                self._data = data.infer_objects()
+                self._pending = {}
+        
+        def flush(self):
+                """Write the table to disk through a temporary file, so readers never see a partial file"""
+                self._merge_pending()
+                self._writes_since_flush = 0
+                
+                temp_path = Path(self.file_path.parent, self.file_path.name + '.partial')
+                file_format = _results_format(self.file_path)
+                if file_format == 'parquet':
+                        self._data.to_parquet(str(temp_path))
+                elif file_format == 'arrow':
+                        self._data.reset_index().to_feather(str(temp_path))
+                else:
+                        self._data.to_csv(str(temp_path))
+                
+                os.replace(str(temp_path), str(self.file_path))
+        
+        def close(self):
+                self.flush()
+
+
+_buffered_stores = None
+_buffered_flush_every = 100
+_buffered_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def buffered_results(flush_every: int=100):
+        """
+        Route write_pandas_row, write_pandas_value, read_pandas_row, and read_write_pandas_row through buffered
+        ResultsStores while inside the context, flushing them all on exit.  The stores are shared by every thread
+        of the process, such as bulk_map's thread workers, and each routed read or write holds a lock.
+        
+        :param flush_every: Number of writes to a file between flushes to disk
+        """
+        global _buffered_stores, _buffered_flush_every
+        with _buffered_lock:
+                nested = _buffered_stores is not None
+                if not nested:
+                        _buffered_stores = {}
+                        _buffered_flush_every = flush_every
+        if nested:
+                yield
+                return
+        
+        try:
+                yield
+        finally:
+                with _buffered_lock:
+                        stores, _buffered_stores = _buffered_stores, None
+                        for store in stores.values():
+                                store.close()
+
+
+def _buffered_store(file_path, index_label, column_labels=None):
+        """The buffered store for a results file, or None outside of a buffered_results context.  Call while holding
+        _buffered_lock"""
+        if _buffered_stores is None:
+                return None
+        
+        key = str(Path(file_path).resolve())
+        if key not in _buffered_stores:
+                _buffered_stores[key] = ResultsStore(file_path, index_label, column_labels,
+                                                     flush_every=_buffered_flush_every)
+        return _buffered_stores[key]
 
 
 def read_write_pandas_row(file_path, index,
@@ -57,6 +421,14 @@ def read_write_pandas_row(file_path, index,
         
         # todo: make it query based on the type, and not just a str
         
+        with _buffered_lock:
+                store = _buffered_store(file_path, index_label, column_labels)
+                if store is not None:
+                        if index not in store:
+                                print('Please enter in values for {0}'.format(index))
+                                store.write_row(index, [input(x + ': ') for x in column_labels], column_labels)
+                        return store.read_row(index)
+        
         (file_dir, file_name) = os.path.split(file_path)
         try:
                 data = pd.read_csv(file_path, index_col = index_label)
@@ -88,6 +460,12 @@ def write_pandas_row(file_path, index, column_values,
         index_label -- what is the first entry of the index column
         column_labels -- labels for each column/variable
         """
+        with _buffered_lock:
+                store = _buffered_store(file_path, index_label, column_labels)
+                if store is not None:
+                        store.write_row(index, column_values, column_labels)
+                        return
+        
         (file_dir, file_name) = os.path.split(file_path)
         
         try:
@@ -105,6 +483,17 @@ def write_pandas_row(file_path, index, column_values,
 def read_pandas_row(file_path, index, index_label):
         """Read a row from a .csv file"""
         
+        # Rows written earlier in the context may only exist in the store, before the file is ever flushed
+        with _buffered_lock:
+                buffered = _buffered_stores is not None and (str(Path(file_path).resolve()) in _buffered_stores
+                                                             or Path(file_path).is_file())
+                if buffered:
+                        try:
+                                return _buffered_store(file_path, index_label).read_row(index)
+                        except KeyError:
+                                print('The file does not exist')
+                                return []
+        
         try:
                 data = pd.read_csv(file_path, index_col=index_label)
                 return data.loc[index]
@@ -116,6 +505,12 @@ def read_pandas_row(file_path, index, index_label):
 def write_pandas_value(file_path, index, value, column,
                        index_label):
         
+        with _buffered_lock:
+                store = _buffered_store(file_path, index_label)
+                if store is not None:
+                        store.write_value(index, column, value)
+                        return
+        
         (file_dir, file_name) = os.path.split(file_path)
         
         try:
@@ -178,6 +573,100 @@ def create_new_image_path(core_image_path, output_dir, output_suffix=None,
         return new_path
 
 
+_catalog_cache = {}
+
+
+class DatasetCatalog(object):
+        """
+        The files of one extension in a directory, scanned once with their underscore separated name parts parsed,
+        and hash indexed for pairing against other directories
+        """
+        def __init__(self, directory, extension='.tif', subdirs=False):
+                """
+                :param directory: Directory to catalog
+                :param extension: File extension to catalog
+                :param subdirs: Whether to also catalog every subdirectory, in os.walk order
+                """
+                self.directory = Path(directory)
+                self.extension = extension
+                self.subdirs = subdirs
+                
+                self.paths = []
+                self._dir_mtimes = {}
+                self._scan(str(directory))
+                
+                self.parts = [file_name_parts(path) for path in self.paths]
+                self._indexes = {}
+        
+        def _scan(self, directory):
+                self._dir_mtimes[directory] = os.stat(directory).st_mtime_ns
+                
+                child_dirs = []
+                with os.scandir(directory) as entries:
+                        for entry in entries:
+                                if entry.name.endswith(self.extension):
+                                        self.paths.append(Path(directory, entry.name))
+                                if self.subdirs and entry.is_dir() and not entry.is_symlink():
+                                        child_dirs.append(entry.path)
+                
+                for child_dir in child_dirs:
+                        self._scan(child_dir)
+        
+        def __len__(self):
+                return len(self.paths)
+        
+        def is_current(self):
+                """Whether no file has been added to or removed from the cataloged directories since the scan"""
+                try:
+                        return all(os.stat(directory).st_mtime_ns == mtime
+                                   for directory, mtime in self._dir_mtimes.items())
+                except FileNotFoundError:
+                        return False
+        
+        def index(self, file_parts_to_compare=None):
+                """
+                Hash index of the catalog on some of the name parts
+                
+                :param file_parts_to_compare: Indices of the underscore separated name parts to key on, default first
+                :return: Dictionary of name part tuple: positions of the matching files, in catalog order
+                """
+                if file_parts_to_compare is None:
+                        file_parts_to_compare = [0]
+                
+                key = tuple(file_parts_to_compare)
+                if key not in self._indexes:
+                        index = {}
+                        for position, parts in enumerate(self.parts):
+                                name_key = tuple(trim_file_parts_list(parts, file_parts_to_compare))
+                                index.setdefault(name_key, []).append(position)
+                        self._indexes[key] = index
+                
+                return self._indexes[key]
+        
+        def keys(self, file_parts_to_compare=None):
+                """The name part key of every file, in catalog order"""
+                if file_parts_to_compare is None:
+                        file_parts_to_compare = [0]
+                return [tuple(trim_file_parts_list(parts, file_parts_to_compare)) for parts in self.parts]
+
+
+def get_catalog(directory, extension='.tif', subdirs=False) -> DatasetCatalog:
+        """Catalog a directory, reusing the catalog from earlier in the session if the directory has not changed"""
+        key = (str(Path(directory).resolve()), extension, subdirs)
+        catalog = _catalog_cache.get(key)
+        
+        if catalog is None or not catalog.is_current():
+                catalog = DatasetCatalog(directory, extension=extension, subdirs=subdirs)
+                _catalog_cache[key] = catalog
+        
+        return catalog
+
+
+def clear_catalog_cache():
+        """Forget every cached directory catalog"""
+        _catalog_cache.clear()
+
+
 def find_shared_images(dir_one, dir_two):
         """images from two directories are paired based on base names
         
@@ -191,22 +680,17 @@ def find_shared_images(dir_one, dir_two):
         # todo: make a check for different categories of name,
         #   if there are multiple instances of a single name?
         
-        file_list_one = [Path(f) for f in os.listdir(dir_one) if f.endswith('.tif')]
-        file_list_two = [Path(f) for f in os.listdir(dir_two) if f.endswith('.tif')]
+        catalog_one = get_catalog(dir_one)
+        catalog_two = get_catalog(dir_two)
+        index_two = catalog_two.index()
         
         dir_one_image_paths = list()
         dir_two_image_paths = list()
         
-        for i in range(0,len(file_list_one)):
-                core_name_one = get_core_file_name(file_list_one[i])
-                
-                for j  in range(0,len(file_list_two)):
-                        core_name_two = get_core_file_name(file_list_two[j])
-                        
-                        if core_name_one == core_name_two:
-                                
-                                dir_one_image_paths.append(Path(dir_one, file_list_one[i]))
-                                dir_two_image_paths.append(Path(dir_two, file_list_two[j]))
+        for path_one, core_name_one in zip(catalog_one.paths, catalog_one.keys()):
+                for position in index_two.get(core_name_one, []):
+                        dir_one_image_paths.append(Path(dir_one, path_one.name))
+                        dir_two_image_paths.append(Path(dir_two, catalog_two.paths[position].name))
         
         return dir_one_image_paths, dir_two_image_paths
 
@@ -239,30 +723,227 @@ def find_bulk_shared_images(dir_list, file_parts_to_compare=None, subdirs=False)
         if file_parts_to_compare is None:
                 file_parts_to_compare = [0]
         
-        num_dirs = len(dir_list)
+        catalogs = [get_catalog(directory, subdirs=subdirs) for directory in dir_list]
+        indexes = [catalog.index(file_parts_to_compare) for catalog in catalogs]
         
-        if subdirs:
-                list_of_file_lists = [util.list_filetype_in_subdirs(dir_list[index], '.tif') for
-                                      index in range(num_dirs)]
-        else:
-                list_of_file_lists = [util.list_filetype_in_dir(dir_list[index], '.tif') for
-                                      index in range(num_dirs)]
+        path_lists = [[] for catalog in catalogs]
         
-        list_of_file_parts_lists = [file_name_parts_list(list_of_file_lists[index]) for index in range(num_dirs)]
+        for item in catalogs[0].keys(file_parts_to_compare):
+                if all(item in index for index in indexes[1:]):
+                        for catalog, index, path_list in zip(catalogs, indexes, path_lists):
+                                path_list.append(catalog.paths[index[item][0]])
         
-        relevant_file_parts = [[trim_file_parts_list(parts_list, file_parts_to_compare)
-                                for parts_list in list_of_file_parts_lists[directory]]
-                               for directory in range(num_dirs)]
+        return path_lists
+
+
+def pair_bulk_images(input_dirs, file_ext='.tif', subdirs=False):
+        """
+        Pair the images of one or more directories the way the bulk functions do
         
-        path_lists = []
-        for i in range(num_dirs):
-                path_lists.append([])
+        :param input_dirs: List of directories.  One directory lists its images, two are paired with
+        find_shared_images, and more are paired with find_bulk_shared_images
+        :param file_ext: File extension of a single directory's images
+        :param subdirs: Whether to look for images in subdirectories
+        :return: List of tuples of paired image paths
+        """
+        if len(input_dirs) == 1:
+                if subdirs:
+                        path_list = util.list_filetype_in_subdirs(input_dirs[0], file_ext)
+                else:
+                        path_list = util.list_filetype_in_dir(input_dirs[0], file_ext)
+                return [(path,) for path in path_list]
         
-        for item in relevant_file_parts[0]:
-                if util.item_present_all_lists(item, relevant_file_parts[1:]):
-                        for index in range(num_dirs):
-                                item_index = relevant_file_parts[index].index(item)
-                                new_path = Path(list_of_file_lists[index][item_index])
-                                path_lists[index].append(new_path)
+        if len(input_dirs) == 2 and not subdirs:
+                return list(zip(*find_shared_images(input_dirs[0], input_dirs[1])))
         
-        return path_lists
+        return list(zip(*find_bulk_shared_images(input_dirs, subdirs=subdirs)))
+
+
+class BuildCache(object):
+        """
+        Sidecar database recording, for each output file, a signature of the inputs, parameters, and code version
+        that produced it, so that only outputs whose inputs or settings changed are recomputed
+        """
+        def __init__(self, cache_path, content_hash=False):
+                """
+                :param cache_path: Path to the .sqlite cache, created if it does not exist
+                :param content_hash: Sign inputs by a digest of their contents instead of their size and mtime
+                """
+                self.cache_path = Path(cache_path)
+                self.content_hash = content_hash
+                self._connection = sqlite3.connect(str(self.cache_path))
+                self._connection.execute(
+                        'CREATE TABLE IF NOT EXISTS outputs (output TEXT PRIMARY KEY, signature TEXT)')
+                self._connection.commit()
+        
+        def __enter__(self):
+                return self
+        
+        def __exit__(self, exc_type, exc_value, traceback):
+                self.close()
+        
+        def close(self):
+                self._connection.close()
+        
+        def _input_signature(self, input_path):
+                input_path = Path(input_path)
+                if self.content_hash:
+                        digest = hashlib.sha256()
+                        with open(str(input_path), 'rb') as file:
+                                for block in iter(lambda: file.read(1 << 20), b''):
+                                        digest.update(block)
+                        return [str(input_path.resolve()), digest.hexdigest()]
+                
+                stat = os.stat(str(input_path))
+                return [str(input_path.resolve()), stat.st_size, stat.st_mtime_ns]
+        
+        def signature(self, input_paths, parameters: dict=None, code_version: str=None):
+                """Hash of the inputs, parameters, and code version that produce an output"""
+                description = {
+                        'inputs': [self._input_signature(path) for path in input_paths],
+                        'parameters': parameters,
+                        'code': code_version if code_version is not None else multiscale.__version__}
+                text = json.dumps(description, sort_keys=True, default=repr)
+                return hashlib.sha256(text.encode()).hexdigest()
+        
+        def is_current(self, output_path, input_paths, parameters: dict=None, code_version: str=None):
+                """Whether the output exists and was produced from exactly these inputs, parameters, and code"""
+                if not Path(output_path).exists():
+                        return False
+                
+                row = self._connection.execute('SELECT signature FROM outputs WHERE output = ?',
+                                               (str(Path(output_path).resolve()),)).fetchone()
+                return row is not None and row[0] == self.signature(input_paths, parameters, code_version)
+        
+        def record(self, output_path, input_paths, parameters: dict=None, code_version: str=None):
+                """Record the inputs, parameters, and code that produced an output"""
+                with self._connection:
+                        self._connection.execute('INSERT OR REPLACE INTO outputs VALUES (?, ?)',
+                                                 (str(Path(output_path).resolve()),
+                                                  self.signature(input_paths, parameters, code_version)))
+
+
+def _code_version(item_function):
+        return '{0}:{1}.{2}'.format(multiscale.__version__, item_function.__module__, item_function.__qualname__)
+
+
+def bulk_map(item_function, input_dirs, output_dir=None, output_suffix=None, output_source: int=0,
+             extension='.tif', item_kwargs: dict=None, skip_existing_images=True,
+             num_workers: int=1, use_threads=False, subdirs=False, file_ext='.tif',
+             use_build_cache=False, content_hash=False, prepare_item=None, items=None):
+        """
+        Run the same check-skip-process-write cycle over every image, or set of paired images, in some directories
+        
+        :param item_function: Function called as item_function(*paired_paths, output_path, **item_kwargs), or
+        without the output path when there is no output_dir.  Must be a module level function for process pools
+        :param input_dirs: List of directories, paired as in pair_bulk_images
+        :param output_dir: Directory for the outputs, which are named after one of the paired images
+        :param output_suffix: Text in the output name after the core/sample name
+        :param output_source: Index of the paired image the output is named after
+        :param extension: Extension of the output files
+        :param item_kwargs: Keyword arguments passed on to every call of the item function
+        :param skip_existing_images: Whether to skip items whose output already exists, which resumes a stopped run
+        :param num_workers: Number of items processed at once.  1 processes them one after another
+        :param use_threads: Use a thread pool instead of a process pool
+        :param subdirs: Whether to look for images in subdirectories
+        :param file_ext: File extension of a single directory's images
+        :param use_build_cache: Skip only outputs recorded in output_dir/.build_cache.sqlite as made from the
+        current inputs, parameters, and code version, instead of every output that exists
+        :param content_hash: Sign the inputs in the build cache by their contents instead of their size and mtime
+        :param prepare_item: Function called here as prepare_item(*paired_paths) before any item is dispatched, where
+        it may ask the user for input.  It returns keyword arguments for that item alone, which are added to
+        item_kwargs and signed with them in the build cache.  An item whose preparation raises is reported as failed
+        :param items: Sets of paired paths to process, in place of pairing the images of input_dirs
+        :return: List of (paired paths, error) for every item that failed
+        """
+        if item_kwargs is None:
+                item_kwargs = {}
+        
+        failures = []
+        
+        def kwargs_for(paths):
+                """Keyword arguments of one item, or None when preparing it failed"""
+                if prepare_item is None:
+                        return item_kwargs
+                
+                try:
+                        return dict(item_kwargs, **prepare_item(*paths))
+                except Exception as error:
+                        warnings.warn('Preparing {0} failed: {1}'.format(Path(paths[output_source]).name, error))
+                        failures.append((paths, error))
+        
+        build_cache = None
+        if use_build_cache and output_dir is not None:
+                os.makedirs(str(output_dir), exist_ok=True)
+                build_cache = BuildCache(Path(output_dir, '.build_cache.sqlite'), content_hash=content_hash)
+        code_version = _code_version(item_function)
+        
+        jobs = []
+        if items is None:
+                items = pair_bulk_images(input_dirs, file_ext=file_ext, subdirs=subdirs)
+        
+        for paths in items:
+                args = list(paths)
+                prepared = False
+                
+                if output_dir is not None:
+                        output_path = create_new_image_path(paths[output_source], output_dir, output_suffix,
+                                                            extension=extension)
+                        if skip_existing_images:
+                                if build_cache is not None:
+                                        kwargs = kwargs_for(paths)
+                                        prepared = True
+                                        if kwargs is None or build_cache.is_current(output_path, paths, kwargs,
+                                                                                    code_version):
+                                                continue
+                                elif output_path.exists():
+                                        continue
+                        args.append(output_path)
+                
+                if not prepared:
+                        kwargs = kwargs_for(paths)
+                        if kwargs is None:
+                                continue
+                jobs.append((paths, args, kwargs))
+        
+        def report(number, paths, kwargs, error=None):
+                name = Path(paths[output_source]).name
+                if error is None:
+                        if build_cache is not None:
+                                output_path = create_new_image_path(paths[output_source], output_dir, output_suffix,
+                                                                    extension=extension)
+                                build_cache.record(output_path, paths, kwargs, code_version)
+                        print('Finished {0} ({1}/{2})'.format(name, number, len(jobs)))
+                else:
+                        warnings.warn('Processing {0} failed: {1}'.format(name, error))
+                        failures.append((paths, error))
+        
+        try:
+                if num_workers == 1 or len(jobs) < 2:
+                        for number, (paths, args, kwargs) in enumerate(jobs, 1):
+                                try:
+                                        item_function(*args, **kwargs)
+                                except Exception as error:
+                                        report(number, paths, kwargs, error)
+                                else:
+                                        report(number, paths, kwargs)
+                        
+                        return failures
+                
+                pool_type = ThreadPoolExecutor if use_threads else ProcessPoolExecutor
+                with pool_type(max_workers=num_workers) as executor:
+                        futures = {executor.submit(item_function, *args, **kwargs): (paths, kwargs)
+                                   for paths, args, kwargs in jobs}
+                        
+                        for number, future in enumerate(as_completed(futures), 1):
+                                try:
+                                        future.result()
+                                except Exception as error:
+                                        report(number, *futures[future], error)
+                                else:
+                                        report(number, *futures[future])
+        finally:
+                if build_cache is not None:
+                        build_cache.close()
+        
+        return failures
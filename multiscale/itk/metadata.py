@@ -90,19 +90,24 @@ def _query_spacing(unit_workspace, dims):
         return spacing
 
 
-def setup_image(path_image: Path, unit_workspace: str='microns', write_changes: bool=True, dimensions: int=2):
+def setup_image(path_image: Path, unit_workspace: str='microns', write_changes: bool=True, dimensions: int=2,
+                query_spacing: bool=True):
         """
         Read in an itk image and ensure that its spacing is in the right units/has been set in the first place
         :param path_image: path to the image file
         :param unit_workspace: unit that the workspace is working in
         :param write_changes: Whether to save new metadata
         :dimensions: Number of spatial dimensions for the image type
+        :param query_spacing: Whether to ask the user for the spacing of images without metadata, or keep the file's
         :return:
         """
         image = sitk.ReadImage(str(path_image))
         metadata = read_metadata(path_image)
         
-        if metadata is None:
+        if metadata is None and not query_spacing:
+                image.SetMetaData('Unit', unit_workspace)
+        
+        elif metadata is None:
                 print('{0} has no metadata.'.format(str(path_image.name)))
                 image.SetMetaData('Unit', unit_workspace)
                 current_spacing = image.GetSpacing()
@@ -126,6 +131,22 @@ def setup_image(path_image: Path, unit_workspace: str='microns', write_changes:
         return image
 
 
+def query_missing_spacing(*image_paths) -> dict:
+        """
+        Ask for the spacing of every image without metadata, as setup_image does, so that the images can be read
+        afterwards with query_spacing=False, e.g. by bulk_map's worker processes
+        
+        :param image_paths: Paths to the image files
+        :return: No keyword arguments, so that it can serve as bulk_map's prepare_item
+        """
+        for image_path in image_paths:
+                image_path = Path(image_path)
+                if read_metadata(image_path) is None:
+                        setup_image(image_path)
+        
+        return {}
+
+
 def write_metadata(image_path: Path, image: sitk.Image):
         """Write down the metadata keys to a txt file"""
         metadata = {}
@@ -146,9 +167,9 @@ def read_metadata(image_path: Path):
                 return None
         
 
-def write_image(image: sitk.Image, image_path: Path):
+def write_image(image: sitk.Image, image_path: Path, use_compression=False):
         # todo: Write using tiffile so that resolution saves properly?
-        sitk.WriteImage(image, str(image_path))
+        sitk.WriteImage(image, str(image_path), use_compression)
         write_metadata(image_path, image)
 
         
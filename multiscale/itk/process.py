@@ -5,17 +5,31 @@ Created on Wed Mar 21 10:06:55 2018
 @author: mpinkert
 """
 import multiscale.bulk_img_processing as blk
-import multiscale.utility_functions as util
 import multiscale.itk.metadata as meta
 
 import SimpleITK as sitk
 import numpy as np
 import os
+from pathlib import Path
+
+
+def mask_image(image_path, mask_path, masked_path):
+        """Mask one image file with another, treating any positive mask value as inside the mask"""
+        image = meta.setup_image(image_path, query_spacing=False)
+        mask = meta.setup_image(mask_path, query_spacing=False) > 0
+        
+        print('Masking ' + os.path.basename(image_path) + ' with '
+              + os.path.basename(mask_path))
+        
+        masked_image = sitk.Mask(image, mask)
+        meta.copy_relevant_metadata(masked_image, image)
+        
+        meta.write_image(masked_image, masked_path)
 
 
 def bulk_apply_mask(image_dir, mask_dir,
                     output_dir, output_suffix,
-                    skip_existing_images=True):
+                    skip_existing_images=True, num_workers=1, use_build_cache=False):
         """Find corresponding images between dirs and apply the second as a mask
         
         Inputs:
@@ -23,28 +37,14 @@ def bulk_apply_mask(image_dir, mask_dir,
         mask_dir -- Directory of images that will be used as the mask
         output_dir -- Directory where the masked images will be saved
         ouptut_suffix -- Filename text after the core/sample name of the image file
+        num_workers -- Number of images processed at once
+        use_build_cache -- Recompute only outputs whose inputs or settings changed since they were made
         """
         
-        (image_path_list, mask_path_list) = blk.find_shared_images(
-                image_dir, mask_dir)
-        
-        for i in range(np.size(image_path_list)):
-                
-                masked_path = blk.create_new_image_path(
-                        image_path_list[i], output_dir, output_suffix)
-                if masked_path.exists() and skip_existing_images:
-                        continue
-                
-                image = meta.setup_image(image_path_list[i])
-                mask = meta.setup_image(mask_path_list[i]) > 0
-                
-                print('Masking ' + os.path.basename(image_path_list[i]) + ' with '
-                      + os.path.basename(mask_path_list[i]))
-                
-                masked_image = sitk.Mask(image, mask)
-                meta.copy_relevant_metadata(masked_image, image)
-                
-                meta.write_image(masked_image, masked_path)
+        return blk.bulk_map(mask_image, [image_dir, mask_dir], output_dir, output_suffix,
+                            skip_existing_images=skip_existing_images, num_workers=num_workers,
+                            use_build_cache=use_build_cache,
+                            prepare_item=meta.query_missing_spacing)
 
 
 def apply_threshold(itk_image, image_name,
@@ -58,23 +58,24 @@ def apply_threshold(itk_image, image_name,
         return thresh_image
 
 
+def threshold_image(image_path, new_path, threshold=1):
+        """Apply an intensity based threshold to an image file"""
+        original = meta.setup_image(image_path, query_spacing=False)
+        new_image = apply_threshold(original, os.path.basename(image_path), threshold=threshold)
+        
+        meta.copy_relevant_metadata(new_image, original)
+        meta.write_image(new_image, new_path)
+
+
 def bulk_threshold(input_dir, output_dir, output_suffix,
                    threshold=1,
-                   skip_existing_images=False):
+                   skip_existing_images=False, num_workers=1, use_build_cache=False):
         """Apply intensity based thresholds to all images in folder"""
-        path_list = util.list_filetype_in_dir(input_dir, '.tif')
-        
-        for i in range(len(path_list)):
-                new_path = blk.create_new_image_path(path_list[i],
-                                                     output_dir, output_suffix)
-                if new_path.exists() and skip_existing_images:
-                        continue
-                
-                original = meta.setup_image(path_list[i])
-                new_image = apply_threshold(original, os.path.basename(path_list[i]), threshold=threshold)
-                
-                meta.copy_relevant_metadata(new_image, original)
-                meta.write_image(new_image, new_path)
+        return blk.bulk_map(threshold_image, [input_dir], output_dir, output_suffix,
+                            item_kwargs={'threshold': threshold},
+                            skip_existing_images=skip_existing_images, num_workers=num_workers,
+                            use_build_cache=use_build_cache,
+                            prepare_item=meta.query_missing_spacing)
 
 
 def convert_to_eightbit(itk_image, image_name):
@@ -84,28 +85,33 @@ def convert_to_eightbit(itk_image, image_name):
         return sitk.Cast(sitk.RescaleIntensity(itk_image), sitk.sitkUInt8)
 
 
-def bulk_convert_to_eightbit(input_dir, output_dir, output_suffix):
+def convert_image_to_eightbit(image_path, new_path):
+        """Convert an image file to 8 bit and save it as a new file"""
+        original = meta.setup_image(image_path, query_spacing=False)
+        new_image = convert_to_eightbit(original,
+                                        os.path.basename(image_path))
+        
+        meta.copy_relevant_metadata(new_image, original)
+        meta.write_image(new_image, new_path)
+
+
+def bulk_convert_to_eightbit(input_dir, output_dir, output_suffix, skip_existing_images=False, num_workers=1,
+                             use_build_cache=False):
         """Convert all tif images in a directory to 8bit and save in new directory
         
         Inputs:
         input_dir -- Directory of images to convert
         output_dir -- Directory to save converted images
         output_suffix -- Text in output image name after the core/sample name
-        
+        skip_existing_images -- Whether to skip images that were already converted
+        num_workers -- Number of images processed at once
+        use_build_cache -- Recompute only outputs whose inputs or settings changed since they were made
         """
         
-        path_list = util.list_filetype_in_dir(input_dir, '.tif')
-        
-        for i in range(len(path_list)):
-                original = meta.setup_image(path_list[i])
-                new_image = convert_to_eightbit(original,
-                                                os.path.basename(path_list[i]))
-                
-                new_path = blk.create_new_image_path(path_list[i],
-                                                     output_dir, output_suffix)
-                
-                meta.copy_relevant_metadata(new_image, original)
-                meta.write_image(new_image, new_path)
+        return blk.bulk_map(convert_image_to_eightbit, [input_dir], output_dir, output_suffix,
+                            skip_existing_images=skip_existing_images, num_workers=num_workers,
+                            use_build_cache=use_build_cache,
+                            prepare_item=meta.query_missing_spacing)
 
 
 def check_if_image_is_rgb(image: sitk.Image):
@@ -150,3 +156,73 @@ def window_image(image, dynamic_range):
         image_windowed = sitk.Cast(image_windowed, sitk.sitkUInt8)
         return image_windowed
 
+
+def foreground_mask(image: sitk.Image, shrink_factor: int=4, radius: int=1) -> sitk.Image:
+        """
+        Find the foreground of an image with an Otsu threshold at a coarse resolution, for masking registration
+        metrics to the tissue
+        
+        :param image: SimpleITK image
+        :param shrink_factor: How much to shrink the image before thresholding
+        :param radius: Radius in coarse pixels of the opening, closing, and dilation that clean up the mask
+        :return: 8-bit mask of 1 in the foreground, on the coarse grid but in the same physical space as the image
+        """
+        if check_if_image_is_rgb(image):
+                image = rgb_to_grayscale_img(image)
+        
+        image = sitk.Cast(image, sitk.sitkFloat32)
+        shrink_factor = int(max(1, min(shrink_factor, min(image.GetSize()) // 8)))
+        if shrink_factor > 1:
+                image = sitk.SmoothingRecursiveGaussian(image, [shrink_factor / 2 * spacing
+                                                                for spacing in image.GetSpacing()])
+                image = sitk.Shrink(image, [shrink_factor] * image.GetDimension())
+        
+        mask = sitk.OtsuThreshold(image, 0, 1)
+        
+        kernel = [radius] * image.GetDimension()
+        mask = sitk.BinaryMorphologicalOpening(mask, kernel)
+        mask = sitk.BinaryMorphologicalClosing(mask, kernel)
+        mask = sitk.BinaryDilate(mask, kernel)
+        
+        # An empty mask leaves no points for the metric, so fall back to the whole image
+        if not np.any(sitk.GetArrayViewFromImage(mask)):
+                mask = mask + 1
+        
+        return mask
+
+
+def read_foreground_mask(image_path: Path, cache_dir: Path, image: sitk.Image=None, shrink_factor: int=4,
+                         radius: int=1):
+        """
+        Read the cached foreground mask of an image file, computing and writing it first if it is missing or older
+        than the image.  The mask is saved in the cache directory, never beside the often read-only raw image, as a
+        _foreground_mask_shrink<n>_radius<n>.mha file to keep its origin and spacing, so masks made with different
+        parameters never stand in for each other.
+        
+        :param image_path: Path to the image file
+        :param cache_dir: Directory the mask is cached in
+        :param image: The image, if it has already been read
+        :param shrink_factor: How much to shrink the image before thresholding
+        :param radius: Radius in coarse pixels of the opening, closing, and dilation that clean up the mask
+        :return: 8-bit foreground mask
+        """
+        image_path = Path(image_path)
+        mask_path = Path(cache_dir, '{}_foreground_mask_shrink{}_radius{}.mha'.format(
+                image_path.stem, shrink_factor, radius))
+        
+        if mask_path.is_file() and mask_path.stat().st_mtime >= image_path.stat().st_mtime:
+                return sitk.ReadImage(str(mask_path))
+        
+        if image is None:
+                image = meta.setup_image(image_path, query_spacing=False)
+        
+        mask = foreground_mask(image, shrink_factor, radius)
+        
+        # Several workers can mask the same fixed image at once, so each writes its own temporary file and the
+        # finished mask is swapped into place, never leaving a partial file for another worker to read
+        os.makedirs(cache_dir, exist_ok=True)
+        partial_path = Path(mask_path.parent, '{}_partial{}.mha'.format(mask_path.stem, os.getpid()))
+        sitk.WriteImage(mask, str(partial_path))
+        os.replace(str(partial_path), str(mask_path))
+        
+        return mask
@@ -14,13 +14,19 @@ import multiscale.itk.itk_plotting as itkplt
 
 import SimpleITK as sitk
 import numpy as np
+import scipy.ndimage as ndi
 import os
+import time
+import warnings
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 from pathlib import Path
 
 import matplotlib.pyplot as plt
 
 from multiscale.itk.process import rgb_to_grayscale_img
+import multiscale.itk.process as proc
 
 
 class RegistrationHelper(object):
@@ -42,6 +48,99 @@ class RegistrationHelper(object):
                 return
 
 
+class RegistrationLog(object):
+        """
+        A low overhead record of a registration's progress, kept in memory without plotting
+        
+        Each iteration records the resolution level, wall time, metric value, and the length of the optimizer's step
+        through parameter space.  Each level
+        records its wall time, iteration count, final metric, and metric evaluations per second.
+        """
+        def __init__(self):
+                self.iterations = []
+                self.levels = []
+                self.stop_condition = None
+                self.total_time = None
+                
+                self._start = None
+                self._level_start = None
+                self._last_time = None
+                self._last_position = None
+        
+        def attach(self, registration_method: sitk.ImageRegistrationMethod):
+                """Add the logging commands to a registration method before it is executed"""
+                registration_method.AddCommand(sitk.sitkStartEvent, self._start_run)
+                registration_method.AddCommand(sitk.sitkMultiResolutionIterationEvent, self._start_level)
+                registration_method.AddCommand(sitk.sitkIterationEvent,
+                                               lambda: self._record_iteration(registration_method))
+                registration_method.AddCommand(sitk.sitkEndEvent, lambda: self._end_run(registration_method))
+        
+        def _start_run(self):
+                now = time.perf_counter()
+                if self._start is None:
+                        self._start = now
+                self._last_time = now
+        
+        def _close_level(self):
+                if self._level_start is None:
+                        return
+                
+                level = self.levels[-1]
+                level['Time'] = time.perf_counter() - self._level_start
+                level_iterations = [record for record in self.iterations if record['Level'] == level['Level']]
+                level['Iterations'] = len(level_iterations)
+                level['Final metric'] = level_iterations[-1]['Metric'] if level_iterations else float('nan')
+                level['Evaluations per second'] = len(level_iterations) / level['Time'] if level['Time'] else 0.0
+                self._level_start = None
+        
+        def _start_level(self):
+                self._close_level()
+                self._level_start = time.perf_counter()
+                self._last_time = self._level_start
+                self._last_position = None
+                self.levels.append({'Level': len(self.levels), 'Start': self._level_start - self._start})
+        
+        def _record_iteration(self, registration_method: sitk.ImageRegistrationMethod):
+                now = time.perf_counter()
+                position = np.array(registration_method.GetOptimizerPosition())
+                step = 0.0 if self._last_position is None else float(np.linalg.norm(position - self._last_position))
+                
+                self.iterations.append({'Level': len(self.levels) - 1,
+                                        'Iteration': registration_method.GetOptimizerIteration(),
+                                        'Time': now - self._start,
+                                        'Iteration time': now - self._last_time,
+                                        'Metric': registration_method.GetMetricValue(),
+                                        'Step': step})
+                self._last_time = now
+                self._last_position = position
+        
+        def _end_run(self, registration_method: sitk.ImageRegistrationMethod):
+                self._close_level()
+                self.stop_condition = registration_method.GetOptimizerStopConditionDescription()
+                self.total_time = time.perf_counter() - self._start
+        
+        def iterations_dataframe(self) -> pd.DataFrame:
+                return pd.DataFrame(self.iterations, columns=['Level', 'Iteration', 'Time', 'Iteration time',
+                                                              'Metric', 'Step'])
+        
+        def levels_dataframe(self) -> pd.DataFrame:
+                return pd.DataFrame(self.levels, columns=['Level', 'Start', 'Time', 'Iterations', 'Final metric',
+                                                          'Evaluations per second'])
+        
+        def to_dict(self) -> dict:
+                return {'Total time': self.total_time, 'Stop condition': self.stop_condition,
+                        'Levels': self.levels, 'Iterations': self.iterations}
+        
+        def write_json(self, path: Path):
+                util.write_json(self.to_dict(), path)
+        
+        def write_csv(self, path: Path):
+                """Write the per-iteration records to csv, with the level summaries in a _levels csv beside it"""
+                path = Path(path)
+                self.iterations_dataframe().to_csv(str(path), index=False)
+                self.levels_dataframe().to_csv(str(Path(path.parent, path.stem + '_levels.csv')), index=False)
+
+
 def _setup_smoothing_sigmas(scale: int=1):
         """Setup the smoothing sigmas array for registration"""
         smoothing_sigmas = [0]
@@ -143,7 +242,7 @@ def define_registration_method(parameters: dict=None) -> sitk.ImageRegistrationM
 def register(fixed_image: sitk.Image, moving_image: sitk.Image, reg_plot: RegistrationPlot=None,
              registration_method: sitk.ImageRegistrationMethod=None,
              initial_transform: sitk.Transform=None,
-             fixed_mask: sitk.Image=None, moving_mask: sitk.Image=None):
+             fixed_mask: sitk.Image=None, moving_mask: sitk.Image=None, registration_log: RegistrationLog=None):
         """Perform an affine registration using MI and RSGD over up to 4 scales
         
         Uses mutual information and regular step gradient descent
@@ -154,6 +253,7 @@ def register(fixed_image: sitk.Image, moving_image: sitk.Image, reg_plot: Regist
         base_registration_method -- The pre-defined optimizer/metric/interpolator
         fixed_mask -- Forces calculations over part of the fixed image
         moving_mask -- Forces calculations over part of the moving image
+        registration_log -- Records timing, metric, and step of each iteration, without plotting
         rotation -- Pre rotation in degrees, to assist in registration
         
         Outputs:
@@ -171,10 +271,10 @@ def register(fixed_image: sitk.Image, moving_image: sitk.Image, reg_plot: Regist
         if initial_transform is None:
                 initial_transform = tran.define_transform()
         
-        if fixed_mask:
+        if fixed_mask is not None:
                 registration_method.SetMetricFixedMask(fixed_mask)
         
-        if moving_mask:
+        if moving_mask is not None:
                 registration_method.SetMetricMovingMask(moving_mask)
         
         registration_method.SetInitialTransform(initial_transform, inPlace=False)
@@ -186,6 +286,9 @@ def register(fixed_image: sitk.Image, moving_image: sitk.Image, reg_plot: Regist
                                                        registration_method.GetMetricValue(), initial_transform))
                 registration_method.AddCommand(sitk.sitkEndEvent, lambda: reg_plot.plot_final_overlay(initial_transform))
         
+        if registration_log is not None:
+                registration_log.attach(registration_method)
+        
         final_transform = registration_method.Execute(fixed_image, moving_image)
         final_metric = registration_method.GetMetricValue()
         stop_condition = registration_method.GetOptimizerStopConditionDescription()
@@ -193,6 +296,276 @@ def register(fixed_image: sitk.Image, moving_image: sitk.Image, reg_plot: Regist
         return final_transform, final_metric, stop_condition
 
 
+def _unwrap_transform(transform: sitk.Transform) -> sitk.Transform:
+        """Take the single transform out of a registration's composite result, so it can be optimized further"""
+        if isinstance(transform, sitk.CompositeTransform) and transform.GetNumberOfTransforms() == 1:
+                return transform.GetNthTransform(0).Downcast()
+        
+        return transform
+
+
+def _pyramid_level(image: sitk.Image, shrink_factor: int, smoothing_sigma: float) -> sitk.Image:
+        """Smooth an image by a sigma in pixels and shrink it, as one level of a multi-resolution registration"""
+        if smoothing_sigma > 0:
+                image = sitk.SmoothingRecursiveGaussian(image, [smoothing_sigma * spacing
+                                                                for spacing in image.GetSpacing()])
+        
+        if shrink_factor > 1:
+                image = sitk.Shrink(image, [int(shrink_factor)] * image.GetDimension())
+        
+        return image
+
+
+def masked_sampling_parameters(registration_parameters: dict, mask: sitk.Image) -> dict:
+        """
+        Rescale the sampling percentage by a mask's foreground fraction.  ITK draws random samples over the whole
+        image and drops those outside the mask, so this keeps the requested share of samples on the foreground.
+        """
+        foreground_fraction = np.mean(sitk.GetArrayViewFromImage(mask) > 0)
+        sampling_percentage = min(1.0, registration_parameters['sampling_percentage'] / max(foreground_fraction, 1E-6))
+        
+        return dict(registration_parameters, sampling_percentage=sampling_percentage)
+
+
+class FixedImageContext(object):
+        """
+        The float image, multi-resolution pyramid, and mask of a fixed image, computed once and reused when many
+        moving images are registered to it
+        """
+        def __init__(self, fixed_image: sitk.Image, registration_parameters: dict=None, fixed_mask: sitk.Image=None,
+                     auto_mask: bool=False):
+                """
+                :param fixed_image: image that is being registered to
+                :param registration_parameters: dictionary of registration key/value arguments
+                :param fixed_mask: Forces calculations over part of the fixed image
+                :param auto_mask: Whether to sample only the fixed image's foreground when no mask is given
+                """
+                if registration_parameters is None:
+                        registration_parameters = setup_registration_parameters()
+                
+                if fixed_mask is None and auto_mask:
+                        fixed_mask = proc.foreground_mask(fixed_image)
+                        registration_parameters = masked_sampling_parameters(registration_parameters, fixed_mask)
+                
+                self.registration_parameters = registration_parameters
+                self.image = sitk.Cast(fixed_image, sitk.sitkFloat32)
+                self.mask = fixed_mask
+                
+                self.levels = list(zip(registration_parameters['shrink_factors'],
+                                       registration_parameters['smoothing_sigmas']))
+                self.level_images = [_pyramid_level(self.image, shrink, sigma) for shrink, sigma in self.levels]
+                
+                if fixed_mask is None:
+                        self.level_masks = [None] * len(self.levels)
+                else:
+                        self.level_masks = [sitk.Resample(fixed_mask, level_image, sitk.Transform(),
+                                                          sitk.sitkNearestNeighbor, 0, fixed_mask.GetPixelID())
+                                            for level_image in self.level_images]
+        
+        def _level_method(self, level_mask: sitk.Image=None, iterations: int=None) -> sitk.ImageRegistrationMethod:
+                """Registration method for one precomputed level, which ITK should not smooth or shrink again"""
+                parameters = self.registration_parameters
+                if iterations is not None:
+                        parameters = dict(parameters, iterations=iterations)
+                
+                registration_method = define_registration_method(parameters)
+                registration_method.SetShrinkFactorsPerLevel([1])
+                registration_method.SetSmoothingSigmasPerLevel([0])
+                
+                if level_mask is not None:
+                        registration_method.SetMetricFixedMask(level_mask)
+                
+                return registration_method
+        
+        def register(self, moving_image: sitk.Image, initial_transform: sitk.Transform=None,
+                     moving_mask: sitk.Image=None, iterations: int=None, registration_log: RegistrationLog=None):
+                """
+                Register a moving image to the fixed image, coarsest level first
+                
+                :param moving_image: image that is being transformed and registered
+                :param initial_transform: transform to start from, defaults to an identity affine transform
+                :param moving_mask: Forces calculations over part of the moving image
+                :param iterations: optimizer iterations per level, if different from the registration parameters
+                :param registration_log: Records timing, metric, and step of each iteration, without plotting
+                :return: Final transform, metric, and stop condition, as from register
+                """
+                moving_image = sitk.Cast(moving_image, sitk.sitkFloat32)
+                
+                if initial_transform is None:
+                        initial_transform = tran.define_transform()
+                
+                transform = initial_transform
+                for (shrink, sigma), level_image, level_mask in zip(self.levels, self.level_images, self.level_masks):
+                        registration_method = self._level_method(level_mask, iterations)
+                        if moving_mask is not None:
+                                registration_method.SetMetricMovingMask(moving_mask)
+                        if registration_log is not None:
+                                registration_log.attach(registration_method)
+                        
+                        registration_method.SetInitialTransform(_unwrap_transform(transform), inPlace=False)
+                        transform = registration_method.Execute(level_image, _pyramid_level(moving_image, shrink, sigma))
+                
+                return transform, registration_method.GetMetricValue(), \
+                        registration_method.GetOptimizerStopConditionDescription()
+        
+        def evaluate(self, moving_image: sitk.Image, transform: sitk.Transform, moving_mask: sitk.Image=None) -> float:
+                """Metric of a transform over every pixel of the full resolution images"""
+                registration_method = self._level_method(self.mask)
+                if moving_mask is not None:
+                        registration_method.SetMetricMovingMask(moving_mask)
+                registration_method.SetMetricSamplingStrategy(registration_method.NONE)
+                registration_method.SetInitialTransform(transform)
+                
+                return registration_method.MetricEvaluate(self.image, sitk.Cast(moving_image, sitk.sitkFloat32))
+
+
+def _fft_window(array: np.ndarray) -> np.ndarray:
+        """Hann-window an array and zero pad it to a square, so that frequency space rotates with the image"""
+        window = np.outer(np.hanning(array.shape[0]), np.hanning(array.shape[1]))
+        windowed = (array - array.mean()) * window
+        
+        side = max(array.shape)
+        padded = np.zeros([side, side])
+        padded[:array.shape[0], :array.shape[1]] = windowed
+        
+        return padded
+
+
+def phase_correlation(fixed_array: np.ndarray, moving_array: np.ndarray):
+        """
+        Estimate the shift of the moving array's content relative to the fixed array by phase correlation
+        
+        :param fixed_array: 2D array being registered to
+        :param moving_array: 2D array of the same shape
+        :return: Shift in pixels along each array axis, and the height of the correlation peak
+        """
+        cross_power = np.fft.fft2(moving_array) * np.conj(np.fft.fft2(fixed_array))
+        cross_power /= np.maximum(np.abs(cross_power), 1E-12)
+        correlation = np.real(np.fft.ifft2(cross_power))
+        
+        peak = np.unravel_index(np.argmax(correlation), correlation.shape)
+        shift = np.array([idx - size if idx > size // 2 else idx for idx, size in zip(peak, correlation.shape)],
+                         dtype=float)
+        
+        # Refine each axis to a fraction of a pixel with a parabola through the peak and its neighbors
+        for axis, size in enumerate(correlation.shape):
+                before, after = list(peak), list(peak)
+                before[axis], after[axis] = (peak[axis] - 1) % size, (peak[axis] + 1) % size
+                low, mid, high = correlation[tuple(before)], correlation[peak], correlation[tuple(after)]
+                denominator = low - 2 * mid + high
+                if denominator < 0:
+                        shift[axis] += 0.5 * (low - high) / denominator
+        
+        return shift, correlation[peak]
+
+
+def _log_polar_magnitude(array: np.ndarray, num_angles: int, num_radii: int):
+        """Resample the high-passed magnitude spectrum of a square array onto log-polar coordinates"""
+        magnitude = np.abs(np.fft.fftshift(np.fft.fft2(array)))
+        
+        frequencies = np.fft.fftshift(np.fft.fftfreq(array.shape[0]))
+        emphasis = np.cos(np.pi * frequencies[:, None]) * np.cos(np.pi * frequencies[None, :])
+        magnitude *= 1 - emphasis
+        
+        center = array.shape[0] // 2
+        max_radius = array.shape[0] / 2
+        angles = np.linspace(0, np.pi, num_angles, endpoint=False)
+        radii = np.exp(np.linspace(0, np.log(max_radius), num_radii, endpoint=False))
+        
+        rows = center + radii[None, :] * np.sin(angles[:, None])
+        cols = center + radii[None, :] * np.cos(angles[:, None])
+        log_polar = ndi.map_coordinates(magnitude, [rows, cols], order=1)
+        
+        return log_polar, np.log(max_radius) / num_radii
+
+
+def _downsampled_array(image: sitk.Image, max_size: int):
+        """Smooth and shrink an image so that no side is longer than max_size, returning the array and image"""
+        shrink = int(np.ceil(max(image.GetSize()) / max_size))
+        image = _pyramid_level(sitk.Cast(image, sitk.sitkFloat32), shrink, shrink / 2 if shrink > 1 else 0)
+        
+        return sitk.GetArrayFromImage(image).astype(float), image
+
+
+def _similarity_to_transform(similarity: sitk.Similarity2DTransform, transform_type: type) -> sitk.Transform:
+        """Convert a similarity transform to the requested type, dropping the parts the type cannot hold"""
+        if transform_type == sitk.Similarity2DTransform:
+                return similarity
+        
+        if transform_type == sitk.TranslationTransform:
+                return sitk.TranslationTransform(2, similarity.GetTranslation())
+        
+        if transform_type == sitk.Euler2DTransform:
+                return sitk.Euler2DTransform(similarity.GetCenter(), similarity.GetAngle(),
+                                             similarity.GetTranslation())
+        
+        transform = tran.define_transform(transform_type)
+        transform.SetMatrix(similarity.GetMatrix())
+        transform.SetCenter(similarity.GetCenter())
+        transform.SetTranslation(similarity.GetTranslation())
+        
+        return transform
+
+
+def fft_initial_transform(fixed_image: sitk.Image, moving_image: sitk.Image,
+                          transform_type: type=sitk.AffineTransform, max_size: int=256,
+                          estimate_rotation: bool=True) -> sitk.Transform:
+        """
+        Estimate a registration's initial transform from the Fourier transforms of downsampled images
+        
+        Rotation and scale come from phase correlation of the log-polar magnitude spectra, and translation from
+        phase correlation of the images once the rotation and scale are undone.  Rotations are found modulo 180
+        degrees, so both candidates are tried and the one with the stronger translation peak is kept.
+        
+        :param fixed_image: image that is being registered to
+        :param moving_image: image that is being transformed and registered
+        :param transform_type: type of transform to return, e.g. affine, euler, similarity, or translation
+        :param max_size: longest side, in pixels, of the downsampled images
+        :param estimate_rotation: whether to estimate rotation and scale, or only translation
+        :return: Initial transform, rotating and scaling about the center of the fixed image
+        """
+        fixed_array, fixed_small = _downsampled_array(fixed_image, max_size)
+        moving_on_fixed = sitk.Resample(sitk.Cast(moving_image, sitk.sitkFloat32), fixed_small, sitk.Transform(),
+                                        sitk.sitkLinear, 0.0)
+        
+        center = fixed_small.TransformContinuousIndexToPhysicalPoint(
+                [(size - 1) / 2 for size in fixed_small.GetSize()])
+        
+        candidates = [(0.0, 1.0)]
+        if estimate_rotation and transform_type != sitk.TranslationTransform:
+                fixed_window = _fft_window(fixed_array)
+                moving_window = _fft_window(sitk.GetArrayFromImage(moving_on_fixed).astype(float))
+                num_angles = fixed_window.shape[0]
+                
+                fixed_polar, log_step = _log_polar_magnitude(fixed_window, num_angles, num_angles)
+                moving_polar = _log_polar_magnitude(moving_window, num_angles, num_angles)[0]
+                (angle_shift, radius_shift), peak = phase_correlation(fixed_polar, moving_polar)
+                
+                angle = angle_shift * np.pi / num_angles
+                scale = np.exp(-radius_shift * log_step)
+                if transform_type == sitk.Euler2DTransform:
+                        scale = 1.0
+                
+                candidates = [(angle, scale), (angle + np.pi, scale)]
+        
+        best_peak = None
+        for angle, scale in candidates:
+                similarity = sitk.Similarity2DTransform(scale, angle, (0, 0), center)
+                undone = sitk.Resample(moving_on_fixed, fixed_small, similarity, sitk.sitkLinear, 0.0)
+                shift, peak = phase_correlation(_fft_window(fixed_array),
+                                                _fft_window(sitk.GetArrayFromImage(undone).astype(float)))
+                
+                if best_peak is None or peak > best_peak:
+                        # Shift is in array order, (row, column), on the downsampled grid
+                        physical_shift = np.array(fixed_small.GetDirection()).reshape(2, 2) @ \
+                                         (shift[::-1] * np.array(fixed_small.GetSpacing()))
+                        matrix = np.array(similarity.GetMatrix()).reshape(2, 2)
+                        similarity.SetTranslation(tuple(matrix @ physical_shift))
+                        best_peak, best = peak, similarity
+        
+        return _similarity_to_transform(best, transform_type)
+
+
 def query_good_registration(transform: sitk.Transform, metric, stop):
 
         print('\nFinal metric value: {0}'.format(metric))
@@ -431,3 +804,340 @@ def bulk_supervised_register_images(fixed_dir: Path, moving_dir: Path,
                 
                 if write_transform:
                         tran.write_transform(registered_path, transform)
+
+
+def itk_threads_per_worker(num_workers: int) -> int:
+        """Split the available cores between worker processes so concurrent ITK filters don't oversubscribe them"""
+        return max(1, (os.cpu_count() or 1) // max(1, num_workers))
+
+
+def set_itk_threads(num_threads: int):
+        """Set the default number of threads used by ITK filters and registrations in this process"""
+        sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(num_threads)
+
+
+def starting_transforms(rotations=(0,), translations=((0, 0),), transform_type: type=sitk.AffineTransform):
+        """
+        Build a grid of initial transforms, replacing the interactive rotation and translation queries
+        
+        :param rotations: Initial rotations in degrees
+        :param translations: Initial translation parameters of the transform, in physical units
+        :param transform_type: what type of registration, e.g. affine or euler
+        :return: list of (rotation, translation, transform) for every combination
+        """
+        starts = []
+        for rotation in rotations:
+                for translation in translations:
+                        transform = tran.define_transform(transform_type, rotation)
+                        tran.set_translation(transform, list(translation))
+                        starts.append((rotation, tuple(translation), transform))
+        
+        return starts
+
+
+_worker_context = None
+_worker_moving_image = None
+_worker_moving_mask = None
+
+
+def _init_multi_start_worker(fixed_image: sitk.Image, moving_image: sitk.Image, registration_parameters: dict,
+                             num_threads: int, fixed_mask: sitk.Image=None, moving_mask: sitk.Image=None):
+        """Hold the fixed image context and moving image once per worker process and size its ITK thread pool"""
+        global _worker_context, _worker_moving_image, _worker_moving_mask
+        set_itk_threads(num_threads)
+        _worker_context = FixedImageContext(fixed_image, registration_parameters, fixed_mask)
+        _worker_moving_image = moving_image
+        _worker_moving_mask = moving_mask
+
+
+def _register_from_start(initial_transform: sitk.Transform, iterations: int,
+                         context: FixedImageContext=None, moving_image: sitk.Image=None,
+                         moving_mask: sitk.Image=None):
+        """Register the worker's image pair from one starting transform, scoring the result over every pixel"""
+        if context is None:
+                context, moving_image, moving_mask = _worker_context, _worker_moving_image, _worker_moving_mask
+        
+        transform, metric, stop = context.register(moving_image, initial_transform, moving_mask=moving_mask,
+                                                   iterations=iterations)
+        
+        # The optimizer's own metric is sampled at random, so it is too noisy to compare starts with
+        metric = context.evaluate(moving_image, transform, moving_mask)
+        
+        return transform, metric, stop
+
+
+def _map_starts(fixed_image, moving_image, transforms, registration_parameters, iterations, num_workers,
+                fixed_mask=None, moving_mask=None):
+        """Register from every starting transform, on a process pool when there is more than one worker"""
+        if num_workers == 1 or len(transforms) < 2:
+                context = FixedImageContext(fixed_image, registration_parameters, fixed_mask)
+                return [_register_from_start(transform, iterations, context, moving_image, moving_mask)
+                        for transform in transforms]
+        
+        with ProcessPoolExecutor(max_workers=num_workers, initializer=_init_multi_start_worker,
+                                 initargs=(fixed_image, moving_image, registration_parameters,
+                                           itk_threads_per_worker(num_workers), fixed_mask, moving_mask)) as pool:
+                return list(pool.map(_register_from_start, transforms, [iterations] * len(transforms)))
+
+
+def multi_start_register(fixed_image: sitk.Image, moving_image: sitk.Image,
+                         rotations=(-10, -5, 0, 5, 10), translations=((0, 0),),
+                         transform_type: type=sitk.AffineTransform, registration_parameters: dict=None,
+                         probe_iterations: int=20, keep: int=3, num_workers: int=None,
+                         fixed_mask: sitk.Image=None, moving_mask: sitk.Image=None):
+        """Register from a grid of starting rotations and translations and keep the best result
+        
+        Every start is first run for a few probe iterations.  Only the starts with the best probe metrics are
+        continued to a full registration, so clearly bad starts stop early.
+        
+        :param fixed_image: image that is being registered to
+        :param moving_image: image that is being transformed and registered
+        :param rotations: initial rotations in degrees
+        :param translations: initial translation parameters of the transform, in physical units
+        :param transform_type: what type of registration, e.g. affine or euler
+        :param registration_parameters: dictionary of registration key/value arguments
+        :param probe_iterations: number of iterations each start is run for before pruning
+        :param keep: number of starts continued to a full registration
+        :param num_workers: number of starts registered at once, defaults to the number of cores
+        :param fixed_mask: Forces calculations over part of the fixed image
+        :param moving_mask: Forces calculations over part of the moving image
+        :return: Final transform, metric, stop condition, and the (rotation, translation) start it came from
+        """
+        if registration_parameters is None:
+                registration_parameters = setup_registration_parameters()
+        
+        starts = starting_transforms(rotations, translations, transform_type)
+        
+        if num_workers is None:
+                num_workers = os.cpu_count() or 1
+        num_workers = max(1, min(num_workers, len(starts)))
+        
+        probes = _map_starts(fixed_image, moving_image, [transform for rotation, translation, transform in starts],
+                             registration_parameters, probe_iterations, num_workers, fixed_mask, moving_mask)
+        
+        ranked = sorted(range(len(starts)), key=lambda idx: probes[idx][1])[:keep]
+        
+        finals = _map_starts(fixed_image, moving_image, [_unwrap_transform(probes[idx][0]) for idx in ranked],
+                             registration_parameters, registration_parameters['iterations'],
+                             max(1, min(num_workers, len(ranked))), fixed_mask, moving_mask)
+        
+        best = min(range(len(ranked)), key=lambda idx: finals[idx][1])
+        transform, metric, stop = finals[best]
+        rotation, translation = starts[ranked[best]][:2]
+        
+        return transform, metric, stop, (rotation, translation)
+
+
+_worker_fixed_context = None
+
+
+def _init_fixed_context_worker(fixed_image: sitk.Image, registration_parameters: dict, num_threads: int):
+        """Build the fixed image context once per worker process and size its ITK thread pool"""
+        global _worker_fixed_context
+        set_itk_threads(num_threads)
+        _worker_fixed_context = FixedImageContext(fixed_image, registration_parameters)
+
+
+def _register_to_worker_context(key, moving_image: sitk.Image, initial_transform: sitk.Transform,
+                                transform_path: Path):
+        """Register one moving image to the worker's fixed image and write the transform"""
+        transform, metric, stop = _worker_fixed_context.register(moving_image, initial_transform)
+        
+        tran.write_transform(transform_path, transform)
+        return key, metric, stop
+
+
+def register_many_to_fixed(fixed_image: sitk.Image, moving_images: dict, transform_paths: dict,
+                           initial_transforms: dict=None, registration_parameters: dict=None,
+                           num_workers: int=None):
+        """
+        Register many moving images to one fixed image without user input, on a process pool.  A failed
+        registration is reported and recorded, and the others still finish and write their transforms.
+        
+        :param fixed_image: image that is being registered to
+        :param moving_images: Dictionary of key: moving image
+        :param transform_paths: Dictionary of key: path the transform is written to
+        :param initial_transforms: Dictionary of key: transform to start from, defaults to identity transforms
+        :param registration_parameters: dictionary of registration key/value arguments
+        :param num_workers: Number of worker processes.  Defaults to the number of cores
+        :return: Dictionary of key: (final metric, optimizer stop condition), with a nan metric for failures
+        """
+        if not moving_images:
+                return {}
+        if initial_transforms is None:
+                initial_transforms = {}
+        
+        if num_workers is None:
+                num_workers = os.cpu_count() or 1
+        num_workers = max(1, min(num_workers, len(moving_images)))
+        
+        results = {}
+        with ProcessPoolExecutor(max_workers=num_workers, initializer=_init_fixed_context_worker,
+                                 initargs=(fixed_image, registration_parameters,
+                                           itk_threads_per_worker(num_workers))) as pool:
+                futures = {pool.submit(_register_to_worker_context, key, moving_image,
+                                       initial_transforms.get(key), transform_paths[key]): key
+                           for key, moving_image in moving_images.items()}
+                
+                for future in as_completed(futures):
+                        key = futures[future]
+                        try:
+                                key, metric, stop = future.result()
+                        except Exception as error:
+                                warnings.warn('Registering {0} failed: {1}'.format(key, error))
+                                results[key] = (float('nan'), 'Failed: {0}'.format(error))
+                        else:
+                                print('Registered {0}, final metric {1}'.format(key, metric))
+                                results[key] = (metric, stop)
+        
+        return results
+
+
+def _register_image_pair(fixed_path: Path, moving_path: Path, registered_path: Path, transform_type: type,
+                         registration_parameters: dict, write_output: bool, write_transform: bool,
+                         multi_start: dict=None, prealign: bool=False, log_registration: bool=False,
+                         auto_mask: bool=False, mask_dir: Path=None):
+        """Register one image pair without user input, writing the outputs as soon as they are ready"""
+        fixed_image = meta.setup_image(fixed_path, query_spacing=False)
+        moving_image = meta.setup_image(moving_path, query_spacing=False)
+        
+        if auto_mask:
+                fixed_mask = proc.read_foreground_mask(fixed_path, Path(mask_dir, 'fixed'), fixed_image)
+                moving_mask = proc.read_foreground_mask(moving_path, Path(mask_dir, 'moving'), moving_image)
+                registration_parameters = masked_sampling_parameters(
+                        registration_parameters or setup_registration_parameters(), fixed_mask)
+        else:
+                fixed_mask, moving_mask = None, None
+        
+        if multi_start is not None:
+                transform, metric, stop, start = multi_start_register(
+                        fixed_image, moving_image, transform_type=transform_type,
+                        registration_parameters=registration_parameters, num_workers=1,
+                        fixed_mask=fixed_mask, moving_mask=moving_mask, **multi_start)
+        else:
+                if prealign:
+                        initial_transform = fft_initial_transform(fixed_image, moving_image, transform_type)
+                else:
+                        initial_transform = tran.read_initial_transform(moving_path, transform_type)
+                
+                registration_log = RegistrationLog() if log_registration else None
+                registration_method = define_registration_method(registration_parameters)
+                transform, metric, stop = register(fixed_image, moving_image,
+                                                   registration_method=registration_method,
+                                                   initial_transform=initial_transform,
+                                                   fixed_mask=fixed_mask, moving_mask=moving_mask,
+                                                   registration_log=registration_log)
+                
+                if log_registration:
+                        registration_log.write_json(Path(registered_path.parent,
+                                                         registered_path.stem + '_registration_log.json'))
+        
+        if write_output:
+                registered_image = sitk.Resample(moving_image, fixed_image, transform,
+                                                 sitk.sitkLinear, 0.0, moving_image.GetPixelID())
+                meta.copy_relevant_metadata(registered_image, moving_image)
+                meta.write_image(registered_image, registered_path)
+        
+        if write_transform:
+                tran.write_transform(registered_path, transform)
+        
+        return transform, metric, stop
+
+
+def bulk_register_images(fixed_dir: Path, moving_dir: Path,
+                         output_dir: Path, output_suffix: str, write_output: bool=True,
+                         write_transform: bool=True, transform_type: type=sitk.AffineTransform,
+                         registration_parameters: dict=None, skip_existing_images=True, num_workers: int=None,
+                         multi_start: dict=None, prealign: bool=False, log_registration: bool=False,
+                         auto_mask: bool=False, mask_dir: Path=None, registry_path: Path=None):
+        """Register two directories of images without user input, running the pairs concurrently on a process pool
+        
+        :param fixed_dir: directory holding the images that are being registered to
+        :param moving_dir: directory holding the images that will be registered
+        :param output_dir: directory to save the output images
+        :param output_suffix: base name of the output images
+        :param write_output: whether or not to actually write the output image
+        :param write_transform: whether or not to write down the transform that produced the output
+        :param transform_type: what type of registration, e.g. affine or euler
+        :param registration_parameters: dictionary of registration key/value arguments
+        :param skip_existing_images: whether to skip images that already have a transform/output image
+        :param num_workers: number of pairs registered at once, defaults to the number of cores
+        :param multi_start: keyword arguments for multi_start_register, e.g. {'rotations': [-10, 0, 10]}, to
+        register each pair from a grid of starts instead of its initial transform file
+        :param prealign: whether to start each pair from fft_initial_transform instead of its initial transform file
+        :param log_registration: whether to write each pair's RegistrationLog to a _registration_log.json file.  Not
+        available with multi_start, whose starts are separate registrations
+        :param auto_mask: whether to sample the metric only over the images' foreground, using cached masks
+        :param mask_dir: directory the foreground masks are cached in, defaults to a foreground_masks folder in the
+        output directory
+        :param registry_path: TransformRegistry to record each transform in, keyed by the moving and fixed image
+        names with the output suffix as the stage
+        :return: path to the summary file holding each pair's final metric and optimizer stop condition
+        """
+        if log_registration and multi_start is not None:
+                raise ValueError('log_registration records a single registration and cannot be used with multi_start')
+        
+        (fixed_path_list, moving_path_list) = blk.find_shared_images(fixed_dir, moving_dir)
+        
+        jobs = []
+        for fixed_path, moving_path in zip(fixed_path_list, moving_path_list):
+                registered_path = blk.create_new_image_path(moving_path, output_dir, output_suffix)
+                if registered_path.exists() and skip_existing_images:
+                        continue
+                jobs.append((fixed_path, moving_path, registered_path))
+        
+        summary_path = Path(output_dir, output_suffix + '_registration_summary.csv')
+        if not jobs:
+                return summary_path
+        
+        if mask_dir is None:
+                mask_dir = Path(output_dir, 'foreground_masks')
+        
+        if num_workers is None:
+                num_workers = os.cpu_count() or 1
+        num_workers = max(1, min(num_workers, len(jobs)))
+        
+        columns = {'Fixed': 'str', 'Moving': 'str', 'Metric': 'float', 'Stop condition': 'str'}
+        
+        # Keep the rows of pairs registered by earlier runs, so a resumed run extends the summary
+        previous_rows = None
+        if summary_path.is_file():
+                previous_rows = blk.read_results(summary_path, dtype={'Fixed': str, 'Moving': str})
+                registering = [moving_path.name for fixed_path, moving_path, registered_path in jobs]
+                previous_rows = previous_rows[~previous_rows['Moving'].isin(registering)]
+        
+        registry = tran.TransformRegistry(registry_path) if registry_path is not None else None
+        
+        with blk.ResultsWriter(summary_path, columns, batch_size=1) as writer, \
+                ProcessPoolExecutor(max_workers=num_workers, initializer=set_itk_threads,
+                                    initargs=(itk_threads_per_worker(num_workers),)) as executor:
+                futures = {executor.submit(_register_image_pair, fixed_path, moving_path, registered_path,
+                                           transform_type, registration_parameters,
+                                           write_output, write_transform, multi_start, prealign,
+                                           log_registration, auto_mask, mask_dir):
+                                   (fixed_path, moving_path)
+                           for fixed_path, moving_path, registered_path in jobs}
+                
+                if previous_rows is not None:
+                        writer.write_dataframe(previous_rows)
+                
+                for number, future in enumerate(as_completed(futures), 1):
+                        fixed_path, moving_path = futures[future]
+                        try:
+                                transform, metric, stop = future.result()
+                        except Exception as error:
+                                warnings.warn('Registering {0} failed: {1}'.format(moving_path.name, error))
+                                metric, stop = float('nan'), 'Failed: {0}'.format(error)
+                        else:
+                                print('Registered {0} to {1} ({2}/{3}), final metric {4}'.format(
+                                        moving_path.name, fixed_path.name, number, len(jobs), metric))
+                                if registry is not None:
+                                        registry.write(moving_path.name, fixed_path.name, output_suffix, transform,
+                                                       metric, stop)
+                        
+                        writer.write_row([fixed_path.name, moving_path.name, metric, stop])
+        
+        if registry is not None:
+                registry.close()
+        
+        return summary_path
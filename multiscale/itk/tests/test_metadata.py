@@ -68,6 +68,18 @@ class TestSetupImage(object):
                 return
         
 
+class TestQueryMissingSpacing(object):
+        def test_asks_only_for_images_without_metadata(self, generic_tif, monkeypatch):
+                described = Path(generic_tif.parent, 'described.tif')
+                meta.write_image(sitk.ReadImage(str(generic_tif)), described)
+                
+                queried = []
+                monkeypatch.setattr(meta, 'setup_image', lambda image_path: queried.append(image_path.name))
+                
+                assert meta.query_missing_spacing(generic_tif, described) == {}
+                assert queried == ['test_img.tif']
+        
+
 class TestWriteMetadata(object):
         def test_writes_file(self):
                 return
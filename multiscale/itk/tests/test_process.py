@@ -1,6 +1,7 @@
 import pytest
 import multiscale.itk.process as proc
 import SimpleITK as sitk
+import numpy as np
 
 
 class TestCheckIfImageIsRGB(object):
@@ -12,4 +13,51 @@ class TestCheckIfImageIsRGB(object):
         ])
         def test_various_image_types(self, image, expected):
                 image_is_rgb = proc.check_if_image_is_rgb(image)
-                assert image_is_rgb == expected
\ No newline at end of file
+                assert image_is_rgb == expected
+
+
+class TestForegroundMask(object):
+        def test_masks_sparse_foreground(self):
+                array = np.zeros([128, 128], dtype=np.float32)
+                array[40:80, 50:100] = 100
+                image = sitk.GetImageFromArray(array)
+                image.SetSpacing([0.5, 0.5])
+                
+                mask = proc.foreground_mask(image)
+                
+                assert mask.GetSize() == (32, 32)
+                assert mask.GetSpacing() == (2.0, 2.0)
+                assert mask.GetPixel(mask.TransformPhysicalPointToIndex((37, 30))) == 1
+                assert mask.GetPixel(mask.TransformPhysicalPointToIndex((5, 5))) == 0
+        
+        def test_empty_image_keeps_every_pixel(self):
+                mask = proc.foreground_mask(sitk.Image(64, 64, sitk.sitkFloat32))
+                assert np.all(sitk.GetArrayFromImage(mask) == 1)
+        
+        def test_caches_mask_in_cache_dir(self, tmpdir):
+                array = np.zeros([64, 64], dtype=np.uint8)
+                array[10:40, 20:50] = 200
+                image_path = tmpdir.join('1045_SHG.tif')
+                sitk.WriteImage(sitk.GetImageFromArray(array), str(image_path))
+                
+                cache_dir = tmpdir.join('masks')
+                
+                mask = proc.read_foreground_mask(image_path, cache_dir)
+                
+                assert cache_dir.join('1045_SHG_foreground_mask_shrink4_radius1.mha').check()
+                assert not cache_dir.listdir(lambda path: 'partial' in path.basename)
+                assert tmpdir.listdir(lambda path: path.ext == '.mha') == []
+                cached = proc.read_foreground_mask(image_path, cache_dir)
+                assert np.array_equal(sitk.GetArrayFromImage(cached), sitk.GetArrayFromImage(mask))
+        
+        def test_caches_each_parameter_set_separately(self, tmpdir):
+                array = np.zeros([64, 64], dtype=np.uint8)
+                array[10:40, 20:50] = 200
+                image_path = tmpdir.join('1045_SHG.tif')
+                sitk.WriteImage(sitk.GetImageFromArray(array), str(image_path))
+                
+                proc.read_foreground_mask(image_path, tmpdir.join('masks'))
+                mask = proc.read_foreground_mask(image_path, tmpdir.join('masks'), shrink_factor=2)
+                
+                assert tmpdir.join('masks', '1045_SHG_foreground_mask_shrink2_radius1.mha').check()
+                assert mask.GetSize() == (32, 32)
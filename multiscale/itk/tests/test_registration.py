@@ -1,8 +1,11 @@
 import pytest
 import SimpleITK as sitk
 import multiscale.itk.registration as reg
+import multiscale.itk.transform as tran
+import multiscale.bulk_img_processing as blk
 import multiscale.utility_functions as util
 import numpy as np
+from pathlib import Path
 
 
 @pytest.fixture()
@@ -16,6 +19,12 @@ def user_input_fixture(monkeypatch):
         return _user_inputs
 
 
+@pytest.fixture()
+def blob():
+        coordinates = np.mgrid[0:64, 0:64]
+        return np.exp(-((coordinates[0] - 30) ** 2 + (coordinates[1] - 34) ** 2) / 200).astype(np.float32)
+
+
 class TestSetupSmoothingSigmas(object):
         @pytest.mark.parametrize('scale, expected', [
                 (1, [0]), (2, [1, 0]), (4, [4, 2, 1, 0])
@@ -123,4 +132,227 @@ class TestQueryForChanges(object):
                 assert fixed is fixed_img
                 assert moving is moving_img
                 assert extracted is False
-                
\ No newline at end of file
+                
+
+class TestItkThreadsPerWorker(object):
+        def test_splits_cores_between_workers(self, monkeypatch):
+                monkeypatch.setattr('os.cpu_count', lambda: 8)
+                assert reg.itk_threads_per_worker(4) == 2
+                assert reg.itk_threads_per_worker(16) == 1
+
+
+class TestBulkRegisterImages(object):
+        def test_writes_outputs_and_summary(self, blob, tmpdir):
+                fixed_dir = tmpdir.mkdir('fixed')
+                moving_dir = tmpdir.mkdir('moving')
+                output_dir = tmpdir.mkdir('output')
+                
+                sitk.WriteImage(sitk.GetImageFromArray(blob), str(fixed_dir.join('1045_SHG.tif')))
+                sitk.WriteImage(sitk.GetImageFromArray(np.roll(blob, 2, axis=1)), str(moving_dir.join('1045_PS.tif')))
+                
+                summary_path = reg.bulk_register_images(str(fixed_dir), str(moving_dir), str(output_dir), 'Reg',
+                                                        num_workers=1)
+                
+                assert output_dir.join('1045_Reg.tif').check()
+                assert output_dir.join('1045_Reg.tfm').check()
+                summary = summary_path.read_text().splitlines()
+                assert summary[0] == 'Fixed,Moving,Metric,Stop condition'
+                assert summary[1].startswith('1045_SHG.tif,1045_PS.tif,-')
+        
+        def test_resumed_runs_extend_summary(self, blob, tmpdir):
+                fixed_dir = tmpdir.mkdir('fixed')
+                moving_dir = tmpdir.mkdir('moving')
+                output_dir = tmpdir.mkdir('output')
+                
+                def add_pair(sample):
+                        sitk.WriteImage(sitk.GetImageFromArray(blob), str(fixed_dir.join(sample + '_SHG.tif')))
+                        sitk.WriteImage(sitk.GetImageFromArray(np.roll(blob, 2, axis=1)),
+                                        str(moving_dir.join(sample + '_PS.tif')))
+                
+                def register():
+                        return reg.bulk_register_images(str(fixed_dir), str(moving_dir), str(output_dir), 'Reg',
+                                                        num_workers=1)
+                
+                add_pair('1045')
+                register()
+                add_pair('1046')
+                summary_path = register()
+                finished_summary = summary_path.read_text()
+                register()
+                
+                summary = blk.read_results(summary_path)
+                assert sorted(summary['Moving']) == ['1045_PS.tif', '1046_PS.tif']
+                assert summary_path.read_text() == finished_summary
+        
+        def test_caches_masks_outside_input_dirs(self, blob, tmpdir):
+                fixed_dir = tmpdir.mkdir('fixed')
+                moving_dir = tmpdir.mkdir('moving')
+                output_dir = tmpdir.mkdir('output')
+                
+                sitk.WriteImage(sitk.GetImageFromArray(blob), str(fixed_dir.join('1045_SHG.tif')))
+                sitk.WriteImage(sitk.GetImageFromArray(np.roll(blob, 2, axis=1)), str(moving_dir.join('1045_PS.tif')))
+                
+                reg.bulk_register_images(str(fixed_dir), str(moving_dir), str(output_dir), 'Reg', num_workers=1,
+                                         auto_mask=True)
+                
+                assert output_dir.join('1045_Reg.tfm').check()
+                mask_dir = output_dir.join('foreground_masks')
+                assert mask_dir.join('fixed', '1045_SHG_foreground_mask_shrink4_radius1.mha').check()
+                assert mask_dir.join('moving', '1045_PS_foreground_mask_shrink4_radius1.mha').check()
+                assert not fixed_dir.listdir(lambda path: path.ext == '.mha')
+                assert not moving_dir.listdir(lambda path: path.ext == '.mha')
+        
+        def test_multi_start_uses_masks(self, blob, tmpdir):
+                fixed_dir = tmpdir.mkdir('fixed')
+                moving_dir = tmpdir.mkdir('moving')
+                output_dir = tmpdir.mkdir('output')
+                
+                sitk.WriteImage(sitk.GetImageFromArray(blob), str(fixed_dir.join('1045_SHG.tif')))
+                sitk.WriteImage(sitk.GetImageFromArray(np.roll(blob, 2, axis=1)), str(moving_dir.join('1045_PS.tif')))
+                
+                summary_path = reg.bulk_register_images(
+                        str(fixed_dir), str(moving_dir), str(output_dir), 'Reg', num_workers=1,
+                        transform_type=sitk.Euler2DTransform, auto_mask=True,
+                        multi_start={'rotations': [-5, 0, 5], 'probe_iterations': 5, 'keep': 2})
+                
+                mask_dir = output_dir.join('foreground_masks')
+                assert mask_dir.join('moving', '1045_PS_foreground_mask_shrink4_radius1.mha').check()
+                assert blk.read_results(summary_path)['Metric'][0] < 0
+        
+        def test_multi_start_cannot_be_logged(self, tmpdir):
+                with pytest.raises(ValueError):
+                        reg.bulk_register_images(str(tmpdir), str(tmpdir), str(tmpdir), 'Reg', log_registration=True,
+                                                 multi_start={'rotations': [0]})
+
+
+class TestFixedImageContext(object):
+        def test_precomputes_pyramid_and_mask(self):
+                parameters = reg.setup_registration_parameters(scale=2)
+                fixed = sitk.Image(64, 64, sitk.sitkUInt8)
+                mask = sitk.Image(64, 64, sitk.sitkUInt8) + 1
+                
+                context = reg.FixedImageContext(fixed, parameters, fixed_mask=mask)
+                
+                assert context.image.GetPixelID() == sitk.sitkFloat32
+                assert [image.GetSize() for image in context.level_images] == [(32, 32), (64, 64)]
+                assert [level_mask.GetSize() for level_mask in context.level_masks] == [(32, 32), (64, 64)]
+        
+        def test_registers_many_moving_images(self, blob):
+                parameters = reg.setup_registration_parameters(scale=2, sampling_percentage=0.5)
+                context = reg.FixedImageContext(sitk.GetImageFromArray(blob), parameters)
+                
+                for shift in [1, 2]:
+                        moving = sitk.GetImageFromArray(np.roll(blob, shift, axis=1))
+                        transform, metric, stop = context.register(moving, sitk.TranslationTransform(2))
+                        assert reg._unwrap_transform(transform).GetOffset()[0] == pytest.approx(shift, abs=0.5)
+
+
+class TestMultiStartRegister(object):
+        def test_starting_transforms_cover_grid(self):
+                starts = reg.starting_transforms([-5, 0, 5], [(0, 0), (2, -2)], sitk.Euler2DTransform)
+                assert len(starts) == 6
+                assert [start[:2] for start in starts[:2]] == [(-5, (0, 0)), (-5, (2, -2))]
+                assert starts[1][2].GetTranslation() == (2, -2)
+        
+        def test_keeps_best_start(self, blob):
+                coordinates = np.mgrid[0:64, 0:64]
+                # A second, smaller spot beside the blob makes the image asymmetric under rotation
+                spot = np.exp(-((coordinates[0] - 30) ** 2 + (coordinates[1] - 50) ** 2) / 30).astype(np.float32)
+                fixed = sitk.GetImageFromArray(blob + spot)
+                fixed.SetOrigin([-32, -32])
+                rotation = tran.define_transform(sitk.Euler2DTransform, 40)
+                moving = sitk.Resample(fixed, fixed, rotation.GetInverse(), sitk.sitkLinear, 0.0)
+                
+                transform, metric, stop, start = reg.multi_start_register(
+                        fixed, moving, rotations=[-40, 0, 40], transform_type=sitk.Euler2DTransform,
+                        registration_parameters=reg.setup_registration_parameters(sampling_percentage=0.5),
+                        probe_iterations=5, keep=2, num_workers=1)
+                
+                assert start == (40, (0, 0))
+                assert np.rad2deg(reg._unwrap_transform(transform).GetAngle()) == pytest.approx(40, abs=2)
+                assert metric < 0
+
+
+class TestFftInitialTransform(object):
+        def test_phase_correlation_finds_shift(self):
+                array = np.random.RandomState(0).rand(32, 32)
+                shift, peak = reg.phase_correlation(array, np.roll(array, (3, -5), axis=(0, 1)))
+                assert shift == pytest.approx([3, -5], abs=0.01)
+        
+        def test_recovers_rotation_and_translation(self):
+                noise = sitk.GetImageFromArray(np.random.RandomState(0).rand(128, 128).astype(np.float32))
+                fixed = sitk.SmoothingRecursiveGaussian(noise, 3)
+                
+                true_transform = sitk.Euler2DTransform((63.5, 63.5), np.deg2rad(20), (3, -2))
+                moving = sitk.Resample(fixed, fixed, true_transform.GetInverse(), sitk.sitkLinear, 0.0)
+                
+                transform = reg.fft_initial_transform(fixed, moving, sitk.Euler2DTransform)
+                
+                assert np.rad2deg(transform.GetAngle()) == pytest.approx(20, abs=1.5)
+                for point in [(30, 30), (90, 60)]:
+                        assert transform.TransformPoint(point) == pytest.approx(true_transform.TransformPoint(point),
+                                                                                abs=1)
+
+
+class TestRegistrationLog(object):
+        def test_records_levels_and_iterations(self, blob, tmpdir):
+                fixed = sitk.GetImageFromArray(blob)
+                moving = sitk.GetImageFromArray(np.roll(blob, 2, axis=1))
+                
+                registration_log = reg.RegistrationLog()
+                parameters = reg.setup_registration_parameters(scale=2, iterations=10)
+                transform, metric, stop = reg.register(fixed, moving,
+                                                       registration_method=reg.define_registration_method(parameters),
+                                                       registration_log=registration_log)
+                
+                levels = registration_log.levels_dataframe()
+                iterations = registration_log.iterations_dataframe()
+                assert list(levels['Level']) == [0, 1]
+                assert levels['Iterations'].sum() == len(iterations)
+                assert registration_log.stop_condition == stop
+                
+                registration_log.write_csv(tmpdir.join('log.csv'))
+                registration_log.write_json(tmpdir.join('log.json'))
+                assert tmpdir.join('log_levels.csv').check()
+                assert util.read_json(tmpdir.join('log.json'))['Stop condition'] == stop
+
+
+class TestMaskedSamplingParameters(object):
+        def test_rescales_by_foreground_fraction(self):
+                mask = sitk.Image(10, 10, sitk.sitkUInt8)
+                mask[0:10, 0:2] = 1
+                parameters = reg.setup_registration_parameters(sampling_percentage=0.01)
+                
+                masked_parameters = reg.masked_sampling_parameters(parameters, mask)
+                
+                assert masked_parameters['sampling_percentage'] == pytest.approx(0.05)
+                assert parameters['sampling_percentage'] == 0.01
+        
+        def test_caps_at_every_pixel(self):
+                mask = sitk.Image(10, 10, sitk.sitkUInt8)
+                mask[0, 0] = 1
+                masked_parameters = reg.masked_sampling_parameters(reg.setup_registration_parameters(), mask)
+                assert masked_parameters['sampling_percentage'] == 1.0
+
+
+class TestRegisterManyToFixed(object):
+        def test_failed_state_does_not_stop_the_others(self, blob, tmpdir):
+                fixed = sitk.GetImageFromArray(blob)
+                moving_images = {idx: sitk.GetImageFromArray(np.roll(blob, idx, axis=1)) for idx in range(1, 4)}
+                
+                transform_paths = {idx: Path(str(tmpdir), 'T_{0}.tfm'.format(idx + 1)) for idx in range(1, 4)}
+                transform_paths[2] = Path(str(tmpdir), 'missing_dir', 'T_3.tfm')
+                initial_transforms = {idx: sitk.Euler2DTransform() for idx in range(1, 4)}
+                
+                with pytest.warns(UserWarning):
+                        results = reg.register_many_to_fixed(
+                                fixed, moving_images, transform_paths, initial_transforms,
+                                registration_parameters=reg.setup_registration_parameters(sampling_percentage=0.5),
+                                num_workers=2)
+                
+                assert sorted(results) == [1, 2, 3]
+                assert np.isnan(results[2][0]) and results[2][1].startswith('Failed')
+                for idx in [1, 3]:
+                        assert results[idx][0] < 0
+                        transform = sitk.ReadTransform(str(transform_paths[idx]))
+                        assert transform.GetParameters()[1] == pytest.approx(idx, abs=0.5)
@@ -106,3 +106,214 @@ class TestSetTranslation(object):
                 with pytest.raises(NotImplementedError):
                         transform = sitk.BSplineTransform(2)
                         tran.get_translation(transform)
+
+
+class TestTransformRegistry(object):
+        @pytest.mark.parametrize('transform', [
+                sitk.AffineTransform([1.1, 0.1, 0, 0.9], [2, 3], [5, 5]),
+                sitk.Euler2DTransform([5, 5], 0.3, [1, -2]),
+                sitk.Similarity2DTransform(1.2, 0.1, [0, 4], [1, 1]),
+                sitk.TranslationTransform(2, [3, 4]),
+                sitk.Euler3DTransform([0, 0, 0], 0.1, 0.2, 0.3, [1, 2, 3])
+        ])
+        def test_round_trips_typed_transforms(self, transform, tmpdir):
+                with tran.TransformRegistry(tmpdir.join('transforms.sqlite')) as registry:
+                        registry.write('1045_PS.tif', '1045_SHG.tif', 'Reg', transform, -0.5, 'Converged')
+                        new_transform = registry.read('1045_PS.tif', '1045_SHG.tif', 'Reg')
+                
+                assert type(new_transform) == type(transform)
+                assert new_transform.GetParameters() == pytest.approx(transform.GetParameters())
+                assert new_transform.GetFixedParameters() == pytest.approx(transform.GetFixedParameters())
+        
+        def test_loads_and_filters_entries(self, tmpdir):
+                with tran.TransformRegistry(tmpdir.join('transforms.sqlite')) as registry:
+                        registry.write_many([('1_PS.tif', '1_SHG.tif', 'Reg', sitk.Euler2DTransform(), -1, 'Done'),
+                                             ('2_PS.tif', '2_SHG.tif', 'Reg', sitk.AffineTransform(2), -2, 'Done'),
+                                             ('1_PS.tif', '1_SHG.tif', 'initial', sitk.Euler2DTransform(), None,
+                                              None)])
+                        
+                        transforms = registry.load(stage='Reg')
+                        entries = registry.entries(fixed='1_SHG.tif')
+                        
+                        assert ('1_PS.tif', '1_SHG.tif', 'initial') in registry
+                        assert registry.read('3_PS.tif', '3_SHG.tif', 'Reg') is None
+                
+                assert sorted(transforms) == [('1_PS.tif', '1_SHG.tif', 'Reg'), ('2_PS.tif', '2_SHG.tif', 'Reg')]
+                assert isinstance(transforms[('2_PS.tif', '2_SHG.tif', 'Reg')], sitk.AffineTransform)
+                assert sorted(entries['stage']) == ['Reg', 'initial']
+        
+        def test_composes_and_inverts(self, tmpdir):
+                with tran.TransformRegistry(tmpdir.join('transforms.sqlite')) as registry:
+                        registry.write('a', 'b', 'Reg', sitk.TranslationTransform(2, [1, 0]))
+                        registry.write('b', 'c', 'Reg', sitk.Euler2DTransform([0, 0], np.pi / 2, [0, 0]))
+                        
+                        composite = registry.compose([('a', 'b', 'Reg'), ('b', 'c', 'Reg')])
+                        inverse = registry.inverse('b', 'c', 'Reg')
+                        
+                        with pytest.raises(KeyError):
+                                registry.compose([('a', 'c', 'Reg')])
+                
+                assert composite.TransformPoint([1, 0]) == pytest.approx([1, 1])
+                assert isinstance(inverse, sitk.Euler2DTransform)
+                assert inverse.TransformPoint([0, 1]) == pytest.approx([1, 0])
+        
+        def test_stores_registration_composites(self, tmpdir):
+                transform = sitk.CompositeTransform([sitk.Euler2DTransform([0, 0], 0.2, [1, 1])])
+                with tran.TransformRegistry(tmpdir.join('transforms.sqlite')) as registry:
+                        registry.write('a', 'b', 'Reg', transform)
+                        new_transform = registry.read('a', 'b', 'Reg')
+                
+                assert isinstance(new_transform, sitk.CompositeTransform)
+                assert new_transform.TransformPoint([3, 4]) == pytest.approx(transform.TransformPoint([3, 4]))
+
+
+@pytest.fixture()
+def registered_dirs(tmpdir):
+        """Fixed, moving, and registered image directories of two samples, and the moving images' array"""
+        dirs = [Path(tmpdir.mkdir(name)) for name in ['fixed', 'moving', 'registered', 'output']]
+        
+        array = np.zeros([32, 32], dtype=np.uint8)
+        array[10:20, 10:20] = 200
+        for sample in ['1045', '1046']:
+                tran.meta.write_image(sitk.Image(32, 32, sitk.sitkUInt8), Path(dirs[0], sample + '_SHG.tif'))
+                tran.meta.write_image(sitk.GetImageFromArray(array), Path(dirs[1], sample + '_Orient.tif'))
+                sitk.WriteImage(sitk.Image(32, 32, sitk.sitkUInt8), str(Path(dirs[2], sample + '_PS_Registered.tif')))
+        
+        return dirs, array
+
+
+def _read_array(image_path):
+        return sitk.GetArrayFromImage(sitk.ReadImage(str(image_path)))
+
+
+class TestBulkApplyTransform(object):
+        def test_applies_registry_stage_by_sample(self, registered_dirs, tmpdir, monkeypatch):
+                (fixed_dir, moving_dir, registered_dir, output_dir), array = registered_dirs
+                
+                registry_path = tmpdir.join('transforms.sqlite')
+                with tran.TransformRegistry(registry_path) as registry:
+                        # Keyed as bulk_register_images keys them, by the original moving image's name
+                        registry.write_many([('1045_PS.tif', '1045_SHG.tif', 'PS_Registered',
+                                              sitk.TranslationTransform(2, [5, 0]), -1, 'Done'),
+                                             ('1046_PS.tif', '1046_SHG.tif', 'PS_Registered',
+                                              sitk.TranslationTransform(2, [0, 5]), -1, 'Done')])
+                
+                connections = []
+                registry_class = tran.TransformRegistry
+                
+                def open_registry(path):
+                        connections.append(path)
+                        return registry_class(path)
+                
+                monkeypatch.setattr(tran, 'TransformRegistry', open_registry)
+                
+                tran.bulk_apply_transform(fixed_dir, moving_dir, registered_dir, output_dir, 'Orient_Registered',
+                                          registry_path=registry_path, stage='PS_Registered')
+                
+                assert len(connections) == 1
+                assert not list(output_dir.glob('*.tfm'))
+                shifted_x = _read_array(Path(output_dir, '1045_Orient_Registered.tif'))
+                shifted_y = _read_array(Path(output_dir, '1046_Orient_Registered.tif'))
+                assert np.allclose(shifted_x, np.roll(array, -5, axis=1), atol=1)
+                assert np.allclose(shifted_y, np.roll(array, -5, axis=0), atol=1)
+        
+        def test_rebuilds_only_reregistered_pairs(self, registered_dirs, tmpdir):
+                (fixed_dir, moving_dir, registered_dir, output_dir), array = registered_dirs
+                
+                registry_path = tmpdir.join('transforms.sqlite')
+                with tran.TransformRegistry(registry_path) as registry:
+                        for sample in ['1045', '1046']:
+                                registry.write(sample + '_PS.tif', sample + '_SHG.tif', 'PS_Registered',
+                                               sitk.TranslationTransform(2, [5, 0]))
+                
+                def apply():
+                        return tran.bulk_apply_transform(fixed_dir, moving_dir, registered_dir, output_dir,
+                                                         'Orient_Registered', skip_existing_images=True,
+                                                         use_build_cache=True, registry_path=registry_path,
+                                                         stage='PS_Registered')
+                
+                apply()
+                untouched_path = Path(output_dir, '1045_Orient_Registered.tif')
+                untouched_mtime = untouched_path.stat().st_mtime_ns
+                with tran.TransformRegistry(registry_path) as registry:
+                        registry.write('1046_PS.tif', '1046_SHG.tif', 'PS_Registered',
+                                       sitk.TranslationTransform(2, [0, 5]))
+                apply()
+                
+                assert untouched_path.stat().st_mtime_ns == untouched_mtime
+                assert np.allclose(_read_array(Path(output_dir, '1046_Orient_Registered.tif')),
+                                   np.roll(array, -5, axis=0), atol=1)
+        
+        def test_missing_record_fails_only_its_pair(self, registered_dirs, tmpdir):
+                (fixed_dir, moving_dir, registered_dir, output_dir), array = registered_dirs
+                
+                registry_path = tmpdir.join('transforms.sqlite')
+                with tran.TransformRegistry(registry_path) as registry:
+                        registry.write('1045_PS.tif', '1045_SHG.tif', 'PS_Registered', sitk.TranslationTransform(2))
+                
+                with pytest.warns(UserWarning):
+                        failures = tran.bulk_apply_transform(fixed_dir, moving_dir, registered_dir, output_dir,
+                                                             'Orient_Registered', registry_path=registry_path,
+                                                             stage='PS_Registered')
+                
+                assert [paths[1].name for paths, error in failures] == ['1046_Orient.tif']
+                assert Path(output_dir, '1045_Orient_Registered.tif').is_file()
+        
+        def test_transform_files_are_passed_on(self, registered_dirs):
+                (fixed_dir, moving_dir, registered_dir, output_dir), array = registered_dirs
+                for sample in ['1045', '1046']:
+                        sitk.WriteTransform(sitk.TranslationTransform(2, [5, 0]),
+                                            str(Path(registered_dir, sample + '_PS_Registered.tfm')))
+                
+                tran.bulk_apply_transform(fixed_dir, moving_dir, registered_dir, output_dir, 'Orient_Registered')
+                
+                assert sorted(path.name for path in output_dir.glob('*.tfm')) == [
+                        '1045_Orient_Registered.tfm', '1046_Orient_Registered.tfm']
+
+
+class TestBulkResizeImage(object):
+        def test_reads_spacings_before_dispatching(self, tmpdir, monkeypatch):
+                fixed_dir = tmpdir.mkdir('fixed')
+                moving_dir = tmpdir.mkdir('moving')
+                output_dir = tmpdir.mkdir('output')
+                sitk.WriteImage(sitk.Image(16, 16, sitk.sitkUInt8), str(fixed_dir.join('1045_SHG.tif')))
+                sitk.WriteImage(sitk.Image(32, 32, sitk.sitkUInt8), str(moving_dir.join('1045_PS.tif')))
+                
+                spacings = {'1045_SHG.tif': 2.0, '1045_PS.tif': 1.0}
+                lookups = []
+                
+                def get_image_parameters(image_path, **kwargs):
+                        lookups.append(image_path.name)
+                        return [[spacings[image_path.name]] * 2]
+                
+                monkeypatch.setattr(tran.meta, 'get_image_parameters', get_image_parameters)
+                
+                tran.bulk_resize_image(str(fixed_dir), str(moving_dir), str(output_dir), 'Resized')
+                
+                assert sorted(lookups) == ['1045_PS.tif', '1045_SHG.tif']
+                assert sitk.ReadImage(str(output_dir.join('1045_Resized.tif'))).GetSize() == (16, 16)
+        
+        def test_new_images_leave_cached_resizes_alone(self, tmpdir, monkeypatch):
+                fixed_dir = tmpdir.mkdir('fixed')
+                moving_dir = tmpdir.mkdir('moving')
+                output_dir = tmpdir.mkdir('output')
+                sitk.WriteImage(sitk.Image(16, 16, sitk.sitkUInt8), str(fixed_dir.join('1045_SHG.tif')))
+                sitk.WriteImage(sitk.Image(32, 32, sitk.sitkUInt8), str(moving_dir.join('1045_PS.tif')))
+                
+                spacings = {'1045_SHG.tif': 2.0, '1045_PS.tif': 1.0, '1046_SHG.tif': 2.0, '1046_PS.tif': 1.0}
+                monkeypatch.setattr(tran.meta, 'get_image_parameters',
+                                    lambda image_path, **kwargs: [[spacings[image_path.name]] * 2])
+                
+                def resize():
+                        tran.bulk_resize_image(str(fixed_dir), str(moving_dir), str(output_dir), 'Resized',
+                                               skip_existing_images=True, use_build_cache=True)
+                
+                resize()
+                cached_path = Path(output_dir, '1045_Resized.tif')
+                cached_mtime = cached_path.stat().st_mtime_ns
+                sitk.WriteImage(sitk.Image(16, 16, sitk.sitkUInt8), str(fixed_dir.join('1046_SHG.tif')))
+                sitk.WriteImage(sitk.Image(32, 32, sitk.sitkUInt8), str(moving_dir.join('1046_PS.tif')))
+                resize()
+                
+                assert cached_path.stat().st_mtime_ns == cached_mtime
+                assert output_dir.join('1046_Resized.tif').check()
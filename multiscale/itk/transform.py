@@ -11,6 +11,9 @@ import SimpleITK as sitk
 import numpy as np
 import os
 import math
+import json
+import sqlite3
+import pandas as pd
 from pathlib import Path
 
 
@@ -44,6 +47,175 @@ def read_transform(transform_path: Path):
         return transform
         
 
+def _transform_to_record(transform: sitk.Transform) -> dict:
+        """Describe a transform by its type, dimension, and parameters, so it can be rebuilt with its type intact"""
+        transform = transform.Downcast()
+        
+        if isinstance(transform, sitk.CompositeTransform):
+                return {'type': 'CompositeTransform', 'dimension': transform.GetDimension(),
+                        'components': [_transform_to_record(transform.GetNthTransform(idx))
+                                       for idx in range(transform.GetNumberOfTransforms())]}
+        
+        return {'type': transform.GetName(), 'dimension': transform.GetDimension(),
+                'parameters': list(transform.GetParameters()),
+                'fixed_parameters': list(transform.GetFixedParameters())}
+
+
+def _record_to_transform(record: dict) -> sitk.Transform:
+        """Rebuild a typed SimpleITK transform from _transform_to_record's description"""
+        if record['type'] == 'CompositeTransform':
+                return sitk.CompositeTransform([_record_to_transform(component) for component in record['components']])
+        
+        transform_class = getattr(sitk, record['type'])
+        try:
+                transform = transform_class(record['dimension'])
+        except (TypeError, NotImplementedError, RuntimeError):
+                transform = transform_class()
+        
+        transform.SetFixedParameters(record['fixed_parameters'])
+        transform.SetParameters(record['parameters'])
+        
+        return transform
+
+
+class TransformRegistry(object):
+        """
+        SQLite store of a project's transforms, keyed by the moving image, fixed image, and stage (e.g. initial or
+        the registration's output suffix), that returns typed SimpleITK transforms
+        """
+        def __init__(self, registry_path):
+                """
+                :param registry_path: Path to the .sqlite registry, created if it does not exist
+                """
+                self.registry_path = Path(registry_path)
+                self._connection = sqlite3.connect(str(self.registry_path), timeout=30)
+                self._connection.executescript(
+                        """
+                        CREATE TABLE IF NOT EXISTS transforms (
+                                moving TEXT, fixed TEXT, stage TEXT,
+                                transform_type TEXT, record TEXT, metric REAL, stop TEXT,
+                                PRIMARY KEY (moving, fixed, stage));
+                        CREATE INDEX IF NOT EXISTS transforms_by_stage ON transforms (stage, fixed);
+                        """)
+        
+        def __enter__(self):
+                return self
+        
+        def __exit__(self, exc_type, exc_value, traceback):
+                self.close()
+        
+        def close(self):
+                self._connection.close()
+        
+        def __contains__(self, key):
+                moving, fixed, stage = key
+                return self._connection.execute(
+                        'SELECT 1 FROM transforms WHERE moving = ? AND fixed = ? AND stage = ?',
+                        (str(moving), str(fixed), str(stage))).fetchone() is not None
+        
+        def write(self, moving, fixed, stage, transform: sitk.Transform, metric=None, stop=None):
+                """
+                Record a transform, replacing any recorded under the same key
+                
+                :param moving: Name of the moving image
+                :param fixed: Name of the fixed image
+                :param stage: Which transform of the pair this is
+                :param transform: The transform
+                :param metric: The registration's final metric
+                :param stop: The optimizer's stop condition
+                """
+                self.write_many([(moving, fixed, stage, transform, metric, stop)])
+        
+        def write_many(self, entries):
+                """Record (moving, fixed, stage, transform, metric, stop) entries in a single transaction"""
+                rows = []
+                for moving, fixed, stage, transform, metric, stop in entries:
+                        record = _transform_to_record(transform)
+                        rows.append((str(moving), str(fixed), str(stage), record['type'], json.dumps(record),
+                                     metric, stop))
+                
+                with self._connection:
+                        self._connection.executemany('INSERT OR REPLACE INTO transforms VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                                     rows)
+        
+        def read(self, moving, fixed, stage) -> sitk.Transform:
+                """Read one typed transform, or return None if it has not been recorded"""
+                row = self._connection.execute(
+                        'SELECT record FROM transforms WHERE moving = ? AND fixed = ? AND stage = ?',
+                        (str(moving), str(fixed), str(stage))).fetchone()
+                
+                return None if row is None else _record_to_transform(json.loads(row[0]))
+        
+        def load(self, stage=None, fixed=None) -> dict:
+                """
+                Read many transforms with one query
+                
+                :param stage: Only load this stage, if given
+                :param fixed: Only load transforms to this fixed image, if given
+                :return: Dictionary of (moving, fixed, stage): typed transform
+                """
+                query, arguments = self._filter('SELECT moving, fixed, stage, record FROM transforms', stage, fixed)
+                
+                return {(moving, fixed, stage): _record_to_transform(json.loads(record))
+                        for moving, fixed, stage, record in self._connection.execute(query, arguments)}
+        
+        def entries(self, stage=None, fixed=None) -> pd.DataFrame:
+                """Table of the recorded keys, transform types, metrics, and stop conditions"""
+                query, arguments = self._filter(
+                        'SELECT moving, fixed, stage, transform_type, metric, stop FROM transforms', stage, fixed)
+                
+                return pd.read_sql_query(query, self._connection, params=arguments)
+        
+        @staticmethod
+        def _filter(query, stage, fixed):
+                conditions, arguments = [], []
+                if stage is not None:
+                        conditions.append('stage = ?')
+                        arguments.append(str(stage))
+                if fixed is not None:
+                        conditions.append('fixed = ?')
+                        arguments.append(str(fixed))
+                
+                if conditions:
+                        query += ' WHERE ' + ' AND '.join(conditions)
+                
+                return query, arguments
+        
+        def compose(self, keys) -> sitk.CompositeTransform:
+                """
+                Chain registrations, e.g. [(a, b, stage), (b, c, stage)] resamples image a onto image c
+                
+                :param keys: (moving, fixed, stage) keys ordered from the first moving image to the last fixed image
+                :return: Composite transform mapping points of the last fixed image to the first moving image
+                """
+                transforms = []
+                for key in keys:
+                        transform = self.read(*key)
+                        if transform is None:
+                                raise KeyError('No transform recorded for {0}'.format(key))
+                        transforms.append(transform)
+                
+                return sitk.CompositeTransform(transforms)
+        
+        def inverse(self, moving, fixed, stage) -> sitk.Transform:
+                """The typed inverse of a recorded transform, mapping points of the moving image to the fixed image"""
+                transform = self.read(moving, fixed, stage)
+                if transform is None:
+                        raise KeyError('No transform recorded for {0}'.format((moving, fixed, stage)))
+                
+                return transform.GetInverse().Downcast()
+        
+        def import_transform_files(self, transform_files, stage):
+                """
+                Record existing .tfm files in one transaction
+                
+                :param transform_files: (transform path, moving image name, fixed image name) for each file
+                :param stage: Stage to record the transforms under
+                """
+                self.write_many([(moving, fixed, stage, sitk.ReadTransform(str(path)), None, None)
+                                 for path, moving, fixed in transform_files])
+
+
 def apply_transform_fromfile(fixed_image: sitk.Image, moving_image: sitk.Image, transform_path):
         transform = sitk.ReadTransform(str(transform_path))
         registered_image = sitk.Resample(moving_image, fixed_image, transform,
@@ -120,35 +292,83 @@ def apply_transform_pandas(fixed_image: sitk.Image, moving_image: sitk.Image, re
                              sitk.sitkLinear, 0.0, moving_image.GetPixelID())
 
 
+def _pair_key(moving_name, fixed_name):
+        """Key of an image pair by its core/sample names, shared by the registered, moving, and transform images"""
+        return '{0}/{1}'.format(blk.get_core_file_name(moving_name), blk.get_core_file_name(fixed_name))
+
+
+def apply_transform_to_image_file(fixed_path, moving_path, transform_source_path, registered_path,
+                                  transform_record: dict=None, write_transform_file=True):
+        """
+        Apply the transform of one image onto another image file, and save the result
+        
+        :param transform_record: Record of the transform, as read from a TransformRegistry.  Otherwise the transform
+        is read from the .tfm file written next to the source image
+        :param write_transform_file: Whether to also write the transform next to the registered image
+        """
+        fixed_image = meta.setup_image(fixed_path, query_spacing=False)
+        moving_image = meta.setup_image(moving_path, query_spacing=False)
+        
+        print('\nApplying transform onto {0} based on transform on {1}'.format(
+                str(moving_path.name),
+                str(transform_source_path.name)))
+        
+        if transform_record is not None:
+                transform = _record_to_transform(transform_record)
+        else:
+                transform_path = Path(transform_source_path.parent, transform_source_path.stem + '.tfm')
+                transform = sitk.ReadTransform(str(transform_path))
+        
+        registered_image = sitk.Resample(moving_image, fixed_image, transform,
+                                         sitk.sitkLinear, 0.0, moving_image.GetPixelID())
+        meta.copy_relevant_metadata(registered_image, moving_image)
+        
+        meta.write_image(registered_image, registered_path)
+        if write_transform_file:
+                write_transform(registered_path, transform)
+
+
 def bulk_apply_transform(fixed_dir, moving_dir, transform_dir,
                          output_dir, output_suffix,
-                         skip_existing_images=False):
-        
-        fixed_paths, moving_paths, transform_paths = blk.find_bulk_shared_images(
-                [fixed_dir, moving_dir, transform_dir])
+                         skip_existing_images=False, num_workers=1, use_build_cache=False,
+                         registry_path=None, stage=None, write_transform_files: bool=None):
+        """
+        Apply registered transforms onto other images of the same samples
+        
+        :param registry_path: TransformRegistry written by bulk_register_images.  The stage is read once, and each
+        transform is matched to its images by their core/sample names.  Otherwise the transforms are read from the
+        .tfm files in transform_dir
+        :param stage: Stage of the transforms in the registry, i.e. the registration's output suffix
+        :param write_transform_files: Whether to write each transform next to its registered image.  Defaults to
+        writing them only when the transforms come from .tfm files, so later steps can read them the same way
+        """
+        if write_transform_files is None:
+                write_transform_files = registry_path is None
         
-        for i in range(0, np.size(fixed_paths)):
-                registered_path = blk.create_new_image_path(moving_paths[i],
-                                                            output_dir,
-                                                            output_suffix)
-                
-                if registered_path.exists() and skip_existing_images:
-                        continue
+        transform_records = None
+        if registry_path is not None:
+                with TransformRegistry(registry_path) as registry:
+                        transforms = registry.load(stage=stage)
                 
-                fixed_image = meta.setup_image(fixed_paths[i])
-                moving_image = meta.setup_image(moving_paths[i])
-                
-                print('\nApplying transform onto {0} based on transform on {1}'.format(
-                        str(moving_paths[i].name),
-                        str(transform_paths[i].name)))
-                
-                transform_path = Path(transform_paths[i].parent, transform_paths[i].stem + '.tfm')
-                registered_image = apply_transform_fromfile(fixed_image, moving_image, transform_path)
+                transform_records = {_pair_key(moving, fixed): _transform_to_record(transform)
+                                     for (moving, fixed, _), transform in transforms.items()}
+        
+        def prepare_item(fixed_path, moving_path, transform_source_path):
+                meta.query_missing_spacing(fixed_path, moving_path)
+                if transform_records is None:
+                        return {}
                 
-                meta.write_image(registered_image, registered_path)
-                write_transform(registered_path, sitk.ReadTransform(str(transform_path)))
+                # Only the item's own record, which pickles to workers and is all the build cache signs for it
+                key = _pair_key(transform_source_path.name, fixed_path.name)
+                if key not in transform_records:
+                        raise KeyError('No {0} transform recorded for {1}'.format(stage, key))
+                return {'transform_record': transform_records[key]}
         
-        return
+        return blk.bulk_map(apply_transform_to_image_file, [fixed_dir, moving_dir, transform_dir],
+                            output_dir, output_suffix, output_source=1,
+                            item_kwargs={'write_transform_file': write_transform_files},
+                            skip_existing_images=skip_existing_images, num_workers=num_workers,
+                            use_build_cache=use_build_cache, prepare_item=prepare_item)
 
 
 def resize_image(itk_image, current_spacing, target_spacing):
@@ -178,33 +398,42 @@ def resize_image(itk_image, current_spacing, target_spacing):
         return resized_image
 
 
+def _image_spacing(image_path):
+        """Spacing of an image from the Image Parameters.csv beside it, asking for it if it is not recorded"""
+        return meta.get_image_parameters(image_path, return_origin=False, return_rotation=False)[0][0]
+
+
+def resize_image_file(fixed_path, moving_path, resized_path, spacings: dict=None):
+        """
+        Resize an image file towards the spacing of a reference image file
+        
+        :param spacings: Spacing of each image path, already read, so that worker processes never prompt for it or
+        touch the shared Image Parameters.csv
+        """
+        if spacings is not None:
+                current_spacing = spacings[str(moving_path)]
+                target_spacing = spacings[str(fixed_path)]
+        else:
+                current_spacing = _image_spacing(moving_path)
+                target_spacing = _image_spacing(fixed_path)
+        
+        moving_image = sitk.ReadImage(str(moving_path))
+        resized_image = resize_image(moving_image,
+                                     current_spacing, target_spacing)
+
+        meta.write_image(resized_image, resized_path)
+
+
 def bulk_resize_image(fixed_dir, moving_dir, output_dir, output_suffix,
-                      skip_existing_images=False):
+                      skip_existing_images=False, num_workers=1, use_build_cache=False):
         """Resize multiple images to corresponding reference size"""
-        (fixed_image_path_list, moving_image_path_list) = blk.find_shared_images(
-                fixed_dir, moving_dir)
+        def prepare_item(fixed_path, moving_path):
+                # Read the pair's spacings here, where a missing one can be asked for, and sign only those two
+                return {'spacings': {str(path): _image_spacing(path) for path in [fixed_path, moving_path]}}
         
-        for i in range(0, np.size(fixed_image_path_list)):
-                resized_path = blk.create_new_image_path(moving_image_path_list[i],
-                                                         output_dir, output_suffix)
-                if resized_path.exists() and skip_existing_images:
-                        continue
-                
-                current_spacing = meta.get_image_parameters(
-                        moving_image_path_list[i],
-                        return_origin=True,
-                        return_spacing=True)[0]
-                
-                target_spacing = meta.get_image_parameters(
-                        fixed_image_path_list[i],
-                        return_origin=True,
-                        return_spacing=True)[0]
-                
-                moving_image = sitk.ReadImage(str(moving_image_path_list[i]))
-                resized_image = resize_image(moving_image_path_list[i],
-                                             current_spacing, target_spacing)
-
-                meta.write_image(resized_image, resized_path)
+        return blk.bulk_map(resize_image_file, [fixed_dir, moving_dir], output_dir, output_suffix,
+                            output_source=1, skip_existing_images=skip_existing_images, num_workers=num_workers,
+                            use_build_cache=use_build_cache, prepare_item=prepare_item)
 
 
 def bulk_resize_to_target(image_dir, output_dir, output_suffix,
@@ -1,4 +1,5 @@
 import os
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import SimpleITK as sitk
@@ -36,6 +37,12 @@ def czi_timepoint_to_sitk_image(path_file, position, resolution, resolution_unit
         :return: A SimpleITK image made from the timepoint
         """
         array = bf.load_image(str(path_file), t=position)
+        
+        return _array_to_sitk_image(array, resolution, resolution_unit)
+
+
+def _array_to_sitk_image(array, resolution, resolution_unit='microns'):
+        """Make a decoded timepoint array into an ITK image with the czi resolution"""
         image = sitk.GetImageFromArray(array)
         image.SetSpacing([resolution, resolution])
         image.SetMetaData('Unit', resolution_unit)
@@ -43,6 +50,18 @@ def czi_timepoint_to_sitk_image(path_file, position, resolution, resolution_unit
         return image
 
 
+def czi_timepoints_to_arrays(path_file, positions):
+        """
+        Decode several timepoints from a czi image in a single reader session.  Warning: requires a running javabridge.
+        
+        :param path_file: Path to the czi file
+        :param positions: Timepoints to decode
+        :return: Dictionary of timepoint: numpy array
+        """
+        with bf.ImageReader(str(path_file)) as reader:
+                return {position: reader.read(t=position) for position in positions}
+
+
 def idx_dictionary():
         """Map the polarization state inputs and output states to the t slice from the channel"""
         idx_of_outputs = {
@@ -67,7 +86,7 @@ def idx_dictionary():
 
 def calculate_polarization_state_transforms(path_img: Path, resolution, transform_dir: Path, transform_prefix: str,
                                             skip_finished_transforms=True, registration_parameters: dict=None,
-                                            supervised=True):
+                                            supervised=True, num_workers=None):
         """
         Register based on output polarization state, and save the resulting transform
         :param path_img: path to the image file being used to calculate the transforms
@@ -76,10 +95,14 @@ def calculate_polarization_state_transforms(path_img: Path, resolution, transfor
         :param registration_parameters: dictionary of registration key/value arguments
         :param skip_finished_transforms: whether to skip finding transforms if they already exist or not
         :param supervised: Whether the registration is supervised, or proceeds automatically with no user input
-        :return:
+        :param num_workers: Number of processes for unsupervised registration.  Defaults to the number of cores
+        :return: For unsupervised registration, dictionary of state index: (final metric, optimizer stop condition)
         """
-        idx_dict = idx_dictionary()
-        keys = []
+        if not supervised:
+                return parallel_polarization_state_transforms(path_img, resolution, transform_dir, transform_prefix,
+                                                              skip_finished_transforms=skip_finished_transforms,
+                                                              registration_parameters=registration_parameters,
+                                                              num_workers=num_workers)
         
         fixed_img = czi_timepoint_to_sitk_image(path_img, 0, resolution)
         
@@ -95,18 +118,55 @@ def calculate_polarization_state_transforms(path_img: Path, resolution, transfor
                 print('Registering {0} to 0'.format(idx))
                 
                 moving_img = czi_timepoint_to_sitk_image(path_img, idx, resolution)
-                if supervised:
-                        registered_img, transform, metric, stop = reg.supervised_register_images(
-                                fixed_img, moving_img,
-                                initial_transform=initial_transform, moving_path=transform_path,
-                                registration_parameters=registration_parameters)
-                else:
-                        transform, metric, stop = reg.register(fixed_img, moving_img,
-                                                               initial_transform=initial_transform)
+                registered_img, transform, metric, stop = reg.supervised_register_images(
+                        fixed_img, moving_img,
+                        initial_transform=initial_transform, moving_path=transform_path,
+                        registration_parameters=registration_parameters)
                         
                 tran.write_transform(transform_path, transform)
 
 
+def parallel_polarization_state_transforms(path_img: Path, resolution, transform_dir: Path, transform_prefix: str,
+                                           skip_finished_transforms=True, registration_parameters: dict=None,
+                                           num_workers=None):
+        """
+        Register every polarization state to state 0 without user input.  The czi file is decoded once, and the
+        states are registered concurrently, splitting the cores between the worker processes.
+        
+        :param path_img: path to the image file being used to calculate the transforms
+        :param resolution: resolution of the image file
+        :param transform_dir: Directory that holds the transform files
+        :param transform_prefix: Base name of the transform files
+        :param skip_finished_transforms: whether to skip finding transforms if they already exist or not
+        :param registration_parameters: dictionary of registration key/value arguments
+        :param num_workers: Number of worker processes.  Defaults to the number of cores
+        :return: Dictionary of state index: (final metric, optimizer stop condition), with a nan metric for any
+        state whose registration failed
+        """
+        tasks = {}
+        for idx in range(1, 24):
+                transform_path = Path(transform_dir, transform_prefix + '_' + str(idx + 1) + '.tfm')
+                initial_transform = tran.read_initial_transform(transform_path, sitk.Euler2DTransform)
+                
+                if skip_finished_transforms and transform_path.is_file():
+                        continue
+                
+                tasks[idx] = (initial_transform, transform_path)
+        
+        if not tasks:
+                return {}
+        
+        arrays = czi_timepoints_to_arrays(path_img, [0] + list(tasks))
+        
+        moving_images = {idx: _array_to_sitk_image(arrays[idx], resolution) for idx in tasks}
+        
+        return reg.register_many_to_fixed(_array_to_sitk_image(arrays[0], resolution), moving_images,
+                                          {idx: transform_path for idx, (initial, transform_path) in tasks.items()},
+                                          {idx: initial for idx, (initial, transform_path) in tasks.items()},
+                                          registration_parameters=registration_parameters,
+                                          num_workers=num_workers)
+
+
 def apply_polarization_transforms(path_image, output_dir, transform_dir, transform_prefix, resolution,
                                   skip_existing_images=True):
         """
@@ -136,8 +196,57 @@ def apply_polarization_transforms(path_image, output_dir, transform_dir, transfo
                         meta.write_image(registered_image, output_path)
 
 
+def _resample_polarization_state(fixed_image, moving_image, transform, num_threads):
+        """Resample one polarization state onto the fixed image, using a limited number of ITK threads"""
+        resampler = sitk.ResampleImageFilter()
+        resampler.SetReferenceImage(fixed_image)
+        resampler.SetTransform(transform)
+        resampler.SetInterpolator(sitk.sitkLinear)
+        resampler.SetDefaultPixelValue(0.0)
+        resampler.SetOutputPixelType(moving_image.GetPixelID())
+        resampler.SetNumberOfThreads(num_threads)
+        
+        return resampler.Execute(moving_image)
+
+
+def apply_polarization_transforms_stack(path_image, output_path, transform_dir, transform_prefix, resolution,
+                                        num_threads=None):
+        """
+        Apply pre-calculated transforms onto a single mueller polarimetry image, writing every registered state
+        into one compressed, state-indexed image instead of one image per state
+
+        :param path_image: path to the image being processed
+        :param output_path: path of the stacked image, with the state index as the third dimension
+        :param transform_dir: Directory that holds the transform files
+        :param transform_prefix: Base name of the transform files
+        :param resolution: resolution of the image file
+        :param num_threads: Number of states resampled at once.  Defaults to the number of cores
+        :return:
+        """
+        print('Applying transforms to {0}'.format(path_image.stem))
+        
+        arrays = czi_timepoints_to_arrays(path_image, range(24))
+        images = [_array_to_sitk_image(arrays[num], resolution) for num in range(24)]
+        transforms = [sitk.ReadTransform(str(Path(transform_dir, transform_prefix + '_' + str(num + 1) + '.tfm')))
+                      for num in range(1, 24)]
+        
+        if num_threads is None:
+                num_threads = os.cpu_count() or 1
+        itk_threads = reg.itk_threads_per_worker(num_threads)
+        
+        with ThreadPoolExecutor(max_workers=num_threads) as pool:
+                registered_images = list(pool.map(
+                        lambda moving_image, transform: _resample_polarization_state(images[0], moving_image,
+                                                                                     transform, itk_threads),
+                        images[1:], transforms))
+        
+        stack = sitk.JoinSeries([images[0]] + registered_images)
+        stack.SetMetaData('Unit', images[0].GetMetaData('Unit'))
+        meta.write_image(stack, output_path, use_compression=True)
+
+
 def bulk_apply_polarization_transforms(dir_input, dir_output, transform_dir, transform_prefix,
-                                       resolution, skip_existing_images=True):
+                                       resolution, skip_existing_images=True, stacked=False, num_threads=None):
         """
         Apply pre-calculated transforms onto a whole directory of mueller polarimetry images
 
@@ -145,12 +254,23 @@ def bulk_apply_polarization_transforms(dir_input, dir_output, transform_dir, tra
         :param dir_output: Directory to write resulting images to
         :param resolution: Resolution of the image files
         :param skip_existing_images: Whether to skip applying the transform if files already exist
+        :param stacked: Whether to write each image as a single compressed state-indexed stack
+        :param num_threads: Number of states resampled at once when stacked
         :return:
         """
         file_list = util.list_filetype_in_dir(dir_input, 'tif')
         for file in file_list:
+                if stacked:
+                        output_path = Path(dir_output, file.stem + '_states.tif')
+                        if skip_existing_images and output_path.is_file():
+                                continue
+                        
+                        apply_polarization_transforms_stack(file, output_path, transform_dir, transform_prefix,
+                                                            resolution, num_threads=num_threads)
+                        continue
+                
                 dir_output_file = Path(dir_output, file.stem)
                 os.makedirs(dir_output_file, exist_ok=True)
                 
                 apply_polarization_transforms(file, dir_output_file, transform_dir, transform_prefix, resolution,
-                                              skip_existing_images=skip_existing_images)
\ No newline at end of file
+                                              skip_existing_images=skip_existing_images)
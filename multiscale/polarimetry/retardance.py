@@ -1,14 +1,15 @@
 import multiscale.tiling as til
 import multiscale.bulk_img_processing as blk
 import multiscale.itk.metadata as meta
-import multiscale.utility_functions as util
 
 import scipy.stats as st
 import numpy as np
+import pandas as pd
 import SimpleITK as sitk
 import os
-
-import csv
+import warnings
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
 
 
 def calculate_retardance_over_area(retardance, orientation, ret_thresh=0):
@@ -70,6 +71,260 @@ def calculate_alignment(orient_tile):
         return alignment
 
 
+def _complex_orientation_fields(retardance, orientation):
+        """
+        Calculate the per-pixel fields whose sums give the retardance, orientation, and alignment of a region
+
+        :param retardance: Retardance array in degrees
+        :param orientation: Slow-axis orientation array in degrees
+        :return: retardance weighted by the doubled orientation, the doubled orientation over nonzero pixels,
+        and a mask of the nonzero orientation pixels
+        """
+        complex_orientation = np.exp(-1j * (2 * np.pi / 180) * orientation)
+        weighted_retardance = retardance * complex_orientation
+
+        nonzero_orientation = orientation > 0
+        complex_orientation[~nonzero_orientation] = 0
+
+        return weighted_retardance, complex_orientation, nonzero_orientation
+
+
+def _statistics_from_sums(retardance_sum, orientation_sum, orientation_count, num_pixels, ret_thresh=0):
+        """
+        Convert summed complex fields into average retardance, orientation, and alignment
+
+        :param retardance_sum: Sum of the orientation-weighted retardance over each region
+        :param orientation_sum: Sum of the complex orientation over the nonzero pixels of each region
+        :param orientation_count: Number of nonzero orientation pixels in each region
+        :param num_pixels: Number of pixels in each region
+        :param ret_thresh: Regions with an average retardance below this value are set to nan
+        :return: Retardance, orientation, and alignment arrays with the shape of the sums
+        """
+        average_retardance = np.asarray(retardance_sum / num_pixels)
+
+        retardance = np.absolute(average_retardance)
+        orientation = (np.angle(average_retardance, deg=True) + 180) / 2
+
+        below_threshold = retardance < ret_thresh
+        retardance[below_threshold] = np.nan
+        orientation[below_threshold] = np.nan
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+                alignment = np.absolute(np.asarray(orientation_sum) / orientation_count)
+        alignment[np.asarray(orientation_count) == 0] = np.nan
+
+        return retardance, orientation, alignment
+
+
+def calculate_block_statistics(ret_array, orient_array, tile_size, tile_separation=None, roi_size=None,
+                               ret_thresh=0):
+        """
+        Calculate the average retardance, orientation, and alignment of every tile, or every ROI within each tile,
+        using strided block views of the image instead of iterating over tiles.
+
+        :param ret_array: Retardance array in degrees
+        :param orient_array: Slow-axis orientation array in degrees
+        :param tile_size: Size in pixels of the tile
+        :param tile_separation: Distance between tiles, defaults to the tile size
+        :param roi_size: Size of regions of interest within tiles
+        :param ret_thresh: Regions with an average retardance below this value are set to nan
+        :return: Retardance, orientation, and alignment arrays of shape (tiles x, tiles y) or
+        (tiles x, tiles y, rois x, rois y)
+        """
+        weighted_retardance, complex_orientation, nonzero_orientation = _complex_orientation_fields(
+                ret_array, orient_array)
+
+        fields = [weighted_retardance, complex_orientation, nonzero_orientation]
+        blocks = [til.tile_view(field, tile_size, tile_separation) for field in fields]
+
+        if roi_size is not None:
+                blocks = [til.tile_view(block, roi_size) for block in blocks]
+
+        pixel_axes = (-2, -1)
+        num_pixels = np.prod(blocks[0].shape[-2:])
+        retardance_sum, orientation_sum, orientation_count = [
+                np.sum(block, axis=pixel_axes) for block in blocks]
+
+        return _statistics_from_sums(retardance_sum, orientation_sum, orientation_count, num_pixels,
+                                     ret_thresh=ret_thresh)
+
+
+def _summed_area_table(array, dtype):
+        """Cumulative sum over both axes, zero padded so that table[i, j] is the sum of array[:i, :j]"""
+        table = np.zeros(np.add(np.shape(array), 1), dtype=dtype)
+        np.cumsum(array, axis=0, dtype=dtype, out=table[1:, 1:])
+        np.cumsum(table[1:, 1:], axis=1, out=table[1:, 1:])
+        return table
+
+
+class OrientationIntegralImage(object):
+        def __init__(self, ret_array, orient_array):
+                """
+                Summed-area tables of the complex orientation fields of a retardance/orientation image pair.
+                
+                Once built, the retardance, orientation, and alignment of any rectangular region costs four lookups
+                per table, so many tile sizes and separations can be evaluated from a single pass over the image.
+                The tables are held in double precision, so they take roughly 40 bytes per pixel.
+                
+                :param ret_array: Retardance array in degrees
+                :param orient_array: Slow-axis orientation array in degrees
+                """
+                weighted_retardance, complex_orientation, nonzero_orientation = _complex_orientation_fields(
+                        ret_array, orient_array)
+                
+                self.shape = np.shape(ret_array)
+                self._retardance_table = _summed_area_table(weighted_retardance, np.complex128)
+                self._orientation_table = _summed_area_table(complex_orientation, np.complex128)
+                self._count_table = _summed_area_table(nonzero_orientation, np.int64)
+        
+        @staticmethod
+        def _box_sum(table, start_x, start_y, end_x, end_y):
+                return table[end_x, end_y] - table[start_x, end_y] - table[end_x, start_y] + table[start_x, start_y]
+        
+        def region_sums(self, start_x, start_y, end_x, end_y):
+                """
+                Sum the complex fields over rectangular regions.  Indices broadcast against each other, and
+                the end indices are exclusive.
+                
+                :return: Summed weighted retardance, summed nonzero complex orientation, and nonzero pixel counts
+                """
+                return [self._box_sum(table, start_x, start_y, end_x, end_y)
+                        for table in (self._retardance_table, self._orientation_table, self._count_table)]
+        
+        def region_statistics(self, start_x, start_y, end_x, end_y, ret_thresh=0):
+                """
+                Calculate the average retardance, orientation, and alignment over rectangular regions
+                
+                :return: Retardance, orientation, and alignment arrays with the broadcast shape of the indices
+                """
+                retardance_sum, orientation_sum, orientation_count = self.region_sums(
+                        start_x, start_y, end_x, end_y)
+                num_pixels = (np.asarray(end_x) - start_x) * (np.asarray(end_y) - start_y)
+                
+                return _statistics_from_sums(retardance_sum, orientation_sum, orientation_count, num_pixels,
+                                             ret_thresh=ret_thresh)
+        
+        def tile_statistics(self, tile_size, tile_separation=None, roi_size=None, ret_thresh=0):
+                """
+                Calculate the average retardance, orientation, and alignment of every tile, or every ROI within
+                each tile.  Gives the same result as calculate_block_statistics.
+                
+                :param tile_size: Size in pixels of the tile
+                :param tile_separation: Distance between tiles, defaults to the tile size
+                :param roi_size: Size of regions of interest within tiles
+                :param ret_thresh: Regions with an average retardance below this value are set to nan
+                :return: Retardance, orientation, and alignment arrays of shape (tiles x, tiles y) or
+                (tiles x, tiles y, rois x, rois y)
+                """
+                tile_start_x, tile_start_y = til.tile_start_indices(self.shape, tile_size, tile_separation)
+                
+                if roi_size is None:
+                        start_x = tile_start_x[:, np.newaxis]
+                        start_y = tile_start_y[np.newaxis, :]
+                        region_size = np.asarray(tile_size, dtype=int)
+                else:
+                        roi_start_x, roi_start_y = til.tile_start_indices(tile_size, roi_size)
+                        start_x = tile_start_x[:, None, None, None] + roi_start_x[None, None, :, None]
+                        start_y = tile_start_y[None, :, None, None] + roi_start_y[None, None, None, :]
+                        region_size = np.asarray(roi_size, dtype=int)
+                
+                return self.region_statistics(start_x, start_y,
+                                              start_x + region_size[0], start_y + region_size[1],
+                                              ret_thresh=ret_thresh)
+
+
+def orientation_alignment_columns(roi=False):
+        """Column names and types of the orientation/alignment results, for blk.ResultsWriter"""
+        columns = {'Mouse': 'str', 'Slide': 'str', 'Modality': 'str', 'Tile': 'str'}
+        
+        if roi:
+                columns['ROI'] = 'str'
+        
+        columns.update({'Retardance': 'float', 'Orientation': 'float', 'Alignment': 'float'})
+        return columns
+
+
+def _index_labels(shape, label_format):
+        """Create a flat list of labels for every index in an array shape, in C order"""
+        return [label_format.format(*index) for index in np.ndindex(*shape)]
+
+
+def orientation_alignment_dataframe(retardance, orientation, alignment, mouse, slide, modality):
+        """
+        Convert tile or ROI statistic arrays into a results dataframe
+
+        :param retardance: Array of shape (tiles x, tiles y) or (tiles x, tiles y, rois x, rois y)
+        :param orientation: Array with the same shape as retardance
+        :param alignment: Array with the same shape as retardance
+        :param mouse: Mouse identifier of the sample
+        :param slide: Slide identifier of the sample
+        :param modality: Name of the imaging modality
+        :return: Dataframe with one row per tile or ROI, dropping regions that fell below the retardance threshold
+        """
+        shape = np.shape(retardance)
+        tile_shape = shape[:2]
+
+        tile_labels = _index_labels(tile_shape, '{0}x-{1}y')
+
+        if len(shape) > 2:
+                rois_per_tile = int(np.prod(shape[2:]))
+                columns = {
+                        'Tile': np.repeat(tile_labels, rois_per_tile),
+                        'ROI': np.tile(_index_labels(shape[2:], 'ROI{0}x{1}y'), len(tile_labels))
+                }
+        else:
+                columns = {'Tile': tile_labels}
+
+        df = pd.DataFrame(columns)
+        df.insert(0, 'Mouse', mouse)
+        df.insert(1, 'Slide', slide)
+        df.insert(2, 'Modality', modality)
+
+        df['Retardance'] = np.ravel(retardance)
+        df['Orientation'] = np.ravel(orientation)
+        df['Alignment'] = np.ravel(alignment)
+
+        return df[df['Retardance'].notna()].reset_index(drop=True)
+
+
+def _read_retardance_orientation(ret_image_path, orient_image_path):
+        """Read a retardance/orientation image pair into numpy arrays"""
+        ret_array = sitk.GetArrayFromImage(sitk.ReadImage(str(ret_image_path)))
+        orient_array = sitk.GetArrayFromImage(sitk.ReadImage(str(orient_image_path)))
+        return ret_array, orient_array
+
+
+def _sample_labels(ret_image_path, sample):
+        """Get the mouse, slide, and modality labels for a results file"""
+        modality = blk.file_name_parts(ret_image_path)[1] + '-O'
+        mouse, slide = sample.split('-')
+        return mouse, slide, modality
+
+
+def calculate_orientation_alignment(ret_image_path, orient_image_path, sample,
+                                    tile_size, tile_separation=None, roi_size=None, ret_thresh=0):
+        """
+        Calculate the average retardance, orientation, and alignment of tiles/ROIs in one image pair
+
+        :param ret_image_path: Path to the retardance image
+        :param orient_image_path: Path to the orientation image
+        :param sample: Sample name, in the format Mouse-Slide
+        :param tile_size: Size in pixels of the tile
+        :param tile_separation: Distance between tiles, defaults to the tile size
+        :param roi_size: Size of regions of interest within tiles
+        :param ret_thresh: Regions with an average retardance below this value are dropped
+        :return: Dataframe with one row per tile or ROI
+        """
+        mouse, slide, modality = _sample_labels(ret_image_path, sample)
+        ret_array, orient_array = _read_retardance_orientation(ret_image_path, orient_image_path)
+
+        retardance, orientation, alignment = calculate_block_statistics(
+                ret_array, orient_array, tile_size, tile_separation=tile_separation, roi_size=roi_size,
+                ret_thresh=ret_thresh)
+
+        return orientation_alignment_dataframe(retardance, orientation, alignment, mouse, slide, modality)
+
+
 def process_orientation_alignment(ret_image_path, orient_image_path,
                                   output_path,
                                   tile_size, tile_separation=None,
@@ -80,7 +335,7 @@ def process_orientation_alignment(ret_image_path, orient_image_path,
         
         :param ret_image_path: Path to the retardance image
         :param orient_image_path:  path to the orientaiton image
-        :param output_path: Path to save the output csv file
+        :param output_path: Path to save the output file.  A .parquet or .arrow extension writes a columnar file
         :param tile_size: Size in pixels of the tile
         :param tile_separation: Distance between tiles, defaults to 0
         :param roi_size: Size of regions of interest within tiles
@@ -88,139 +343,242 @@ def process_orientation_alignment(ret_image_path, orient_image_path,
         :param number_thresh:
         :return:
         """
+        if roi_size is None:
+                print('\nWriting average retardance file for {} at tile size {}'.format(
+                        ret_image_path.name, tile_size[0]))
+        else:
+                print('\nWriting average retardance file for {} at tile size {} and roi size {}'.format(
+                        ret_image_path.name, tile_size[0], roi_size[0]))
+
+        sample = blk.get_core_file_name(output_path)
+        df = calculate_orientation_alignment(ret_image_path, orient_image_path, sample,
+                                             tile_size, tile_separation=tile_separation, roi_size=roi_size)
+
+        # Write through a temporary file so an interrupted run never leaves a partial output behind
+        partial_path = Path(output_path.parent, output_path.stem + '_partial' + output_path.suffix)
+        blk.write_results(df, partial_path, orientation_alignment_columns(roi=roi_size is not None))
+        os.replace(str(partial_path), str(output_path))
+
+
+def orientation_alignment_suffix(output_suffix, tile_size, tile_separation=None, roi_size=None):
+        """Name an orientation/alignment results file by its tile size, roi size, and tile separation"""
+        suffix = output_suffix + '_' + str(tile_size[0])
         
-        modality = blk.file_name_parts(ret_image_path)[1] + '-O'
-        
-        ret_image = sitk.ReadImage(str(ret_image_path))
-        ret_array = sitk.GetArrayFromImage(ret_image)
-        ret_max = np.max(ret_array)
+        if roi_size is not None:
+                suffix = suffix + '_' + str(roi_size[0])
         
-        orient_image = sitk.ReadImage(str(orient_image_path))
-        orient_array = sitk.GetArrayFromImage(orient_image)
+        if tile_separation is not None and not np.array_equal(tile_separation, tile_size):
+                suffix = suffix + '_SimRes-' + str(tile_separation[0]) + 'x'
         
-        array_shape = np.shape(orient_array)
+        return suffix
+
+
+def _process_orientation_alignment_shard(ret_image_path, orient_image_path, output_path,
+                                         tile_size, tile_separation, roi_size):
+        """Process one image pair in a worker process and return the path of its results shard"""
+        process_orientation_alignment(ret_image_path, orient_image_path, output_path, tile_size,
+                                      tile_separation=tile_separation, roi_size=roi_size)
+        return output_path
+
+
+def merge_orientation_alignment_shards(shard_paths, merged_path):
+        """
+        Combine per-image orientation/alignment results files into a single file
         
-        pixel_num, offset = til.calculate_number_of_tiles(
-                array_shape, tile_size, tile_separation)
+        :param shard_paths: List of per-image results files
+        :param merged_path: Path to write the combined results file to
+        :return:
+        """
+        shards = [blk.read_results(path, dtype={'Mouse': str, 'Slide': str}) for path in shard_paths]
         
-        if roi_size is None:
-                with open(output_path, 'w', newline='') as csvfile:
-                        print('\nWriting average retardance file for {} at tile size {}'.format(
-                                ret_image_path.name, tile_size[0]))
-                        writer = csv.writer(csvfile)
-                        writer.writerow(['Mouse', 'Slide', 'Modality', 'Tile',
-                                         'Retardance', 'Orientation', 'Alignment'])
-                        
-                        for start, end, tile_number in til.generate_tile_start_end_index(
-                                    pixel_num, tile_size, tile_offset=offset,
-                                    tile_separation=tile_separation):
-                                
-                                ret_tile = ret_array[start[0]:end[0],
-                                           start[1]:end[1]]
-                                
-                                orient_tile = orient_array[start[0]:end[0],
-                                              start[1]:end[1]]
-                                
-                                retardance, orientation = calculate_retardance_over_area(
-                                        ret_tile, orient_tile)
-                                
-                                if retardance is np.nan:
-                                        continue
-                                
-                                alignment = calculate_alignment(orient_tile)
-                                
-                                sample = blk.get_core_file_name(output_path)
-                                mouse, slide = sample.split('-')
-                                
-                                tile = str(tile_number[0]) + 'x-' + str(tile_number[1]) + 'y'
-                                
-                                writer.writerow([mouse, slide, modality, tile,
-                                                 retardance, orientation, alignment])
+        if not shards:
+                return
         
-        else:
-                num_rois, roi_offset = til.calculate_number_of_tiles(tile_size, roi_size)
-                
-                with open(output_path, 'w', newline='') as csvfile:
-                        print('\nWriting average retardance file for {} at tile size {} and roi size {}'.format(
-                                ret_image_path.name, tile_size[0], roi_size[0]))
-                        writer = csv.writer(csvfile)
-                        writer.writerow(['Mouse', 'Slide', 'Modality', 'Tile', 'ROI',
-                                         'Retardance', 'Orientation', 'Alignment'])
-                        
-                        for start, end, tile_number in til.generate_tile_start_end_index(
-                                    pixel_num, tile_size, tile_offset=offset,
-                                    tile_separation=tile_separation):
-                                
-                                ret_tile = ret_array[start[0]:end[0],
-                                           start[1]:end[1]]
-                                
-                                orient_tile = orient_array[start[0]:end[0],
-                                              start[1]:end[1]]
-                                
-                                tile = str(tile_number[0]) + 'x-' + str(tile_number[1]) + 'y'
-                                
-                                for start_roi, end_roi, roi_number in til.generate_tile_start_end_index(
-                                            num_rois, roi_size, tile_offset=roi_offset):
-                                        
-                                        ret_roi = ret_tile[start_roi[0]:end_roi[0],
-                                                  start_roi[1]:end_roi[1]]
-                                        
-                                        orient_roi = orient_tile[start_roi[0]:end_roi[0],
-                                                     start_roi[1]:end_roi[1]]
-                                        
-                                        retardance, orientation = calculate_retardance_over_area(
-                                                ret_roi, orient_roi)
-                                        
-                                        if retardance is np.nan:
-                                                continue
-                                        
-                                        alignment = calculate_alignment(orient_roi)
-                                        
-                                        sample = blk.get_core_file_name(output_path)
-                                        mouse, slide = sample.split('-')
-                                        
-                                        roi = 'ROI' + str(roi_number[0]) + 'x' + str(roi_number[1]) + 'y'
-                                        
-                                        writer.writerow([mouse, slide, modality, tile, roi,
-                                                         retardance, orientation, alignment])
+        print('\nMerging {0} results files into {1}'.format(len(shards), Path(merged_path).name))
+        merged = pd.concat(shards, ignore_index=True)
+        blk.write_results(merged, merged_path, orientation_alignment_columns(roi='ROI' in merged.columns))
 
 
 def bulk_process_orientation_alignment(
             ret_dir, orient_dir, output_dir, output_suffix,
             tile_size,
             tile_separation=None, skip_existing_images=True,
-            roi_size=None):
-        """Calculate average retardance images
+            roi_size=None, num_workers=None, merge_shards=True, extension='.csv'):
         """
-        # todo: add ROI capability
-        
-        output_suffix_with_tilenum = output_suffix + '_' + str(tile_size[0])
+        Calculate average retardance, orientation, and alignment for every image pair in two directories.
         
-        if roi_size is not None:
-                output_suffix_with_tilenum = output_suffix_with_tilenum + '_' + str(roi_size[0])
+        Image pairs are processed on a pool of worker processes, each writing its own per-image results shard.
+        Finished shards are skipped when the run is restarted, and the shards are merged into one file at the end.
         
-        if tile_separation and tile_separation != tile_size:
-                output_suffix = (output_suffix + '_SimRes-' + str(tile_separation) + 'x')
+        :param ret_dir: Directory holding the retardance images
+        :param orient_dir: Directory holding the orientation images
+        :param output_dir: Directory to save the output results files
+        :param output_suffix: Base name of the output files, followed by the tile/roi sizes and separation
+        :param tile_size: Size in pixels of the tile
+        :param tile_separation: Distance between tiles, defaults to the tile size
+        :param skip_existing_images: Whether to skip image pairs whose results shard already exists
+        :param roi_size: Size of regions of interest within tiles
+        :param num_workers: Number of worker processes.  Defaults to the number of CPUs, 1 runs in this process
+        :param merge_shards: Whether to merge the per-image shards into a single output_suffix file
+        :param extension: Results file extension: .csv, or .parquet/.arrow for columnar output
+        :return: Path to the merged results file, or None if the shards were not merged
+        """
+        output_suffix_with_tilenum = orientation_alignment_suffix(output_suffix, tile_size,
+                                                                  tile_separation, roi_size)
         
         ret_image_path_list, orient_image_path_list = blk.find_shared_images(
                 ret_dir, orient_dir)
         
+        shard_paths = []
+        jobs = []
         for i in range(0, np.size(ret_image_path_list)):
                 
                 output_path = blk.create_new_image_path(
                         orient_image_path_list[i], output_dir,
                         output_suffix_with_tilenum,
-                        extension='.csv')
+                        extension=extension)
+                shard_paths.append(output_path)
                 
                 if output_path.exists() and skip_existing_images:
                         continue
                 
-                process_orientation_alignment(ret_image_path_list[i],
-                                              orient_image_path_list[i],
-                                              output_path,
-                                              tile_size,
-                                              tile_separation=tile_separation,
-                                              roi_size=roi_size)
+                jobs.append((ret_image_path_list[i], orient_image_path_list[i], output_path,
+                             tile_size, tile_separation, roi_size))
+        
+        if num_workers is None:
+                num_workers = os.cpu_count()
+        
+        if num_workers == 1 or len(jobs) < 2:
+                for number, job in enumerate(jobs, 1):
+                        try:
+                                _process_orientation_alignment_shard(*job)
+                                print('Finished {0} ({1}/{2})'.format(job[0].name, number, len(jobs)))
+                        except Exception as error:
+                                warnings.warn('Processing {0} failed: {1}'.format(job[0].name, error))
+        else:
+                with ProcessPoolExecutor(max_workers=num_workers) as executor:
+                        futures = {executor.submit(_process_orientation_alignment_shard, *job): job[0]
+                                   for job in jobs}
+                        
+                        for number, future in enumerate(as_completed(futures), 1):
+                                try:
+                                        future.result()
+                                        print('Finished {0} ({1}/{2})'.format(futures[future].name, number,
+                                                                             len(jobs)))
+                                except Exception as error:
+                                        warnings.warn('Processing {0} failed: {1}'.format(futures[future].name,
+                                                                                         error))
+        
+        if not merge_shards:
+                return None
+        
+        merged_path = Path(output_dir, output_suffix_with_tilenum + extension)
+        merge_orientation_alignment_shards([path for path in shard_paths if path.exists()], merged_path)
+        
+        return merged_path
+
+
+def sweep_orientation_alignment(ret_image_path, orient_image_path, output_dir, output_suffix,
+                                tile_settings, skip_existing_images=True, extension='.csv'):
+        """
+        Calculate the average retardance, orientation, and alignment for several tile settings of one image pair.
+        
+        The image pair is read and integrated once, after which each setting costs O(1) per tile or ROI.
+        
+        :param ret_image_path: Path to the retardance image
+        :param orient_image_path: Path to the orientation image
+        :param output_dir: Directory to save the output results files
+        :param output_suffix: Base name of the output files, followed by the tile/roi sizes and separation
+        :param tile_settings: List of dictionaries with a 'tile_size' key and optional 'tile_separation'/'roi_size'
+        :param skip_existing_images: Whether to skip settings whose output file already exists
+        :param extension: Results file extension: .csv, or .parquet/.arrow for columnar output
+        :return:
+        """
+        integral_image = None
+        sample = blk.get_core_file_name(orient_image_path)
+        mouse, slide, modality = _sample_labels(ret_image_path, sample)
+        
+        for settings in tile_settings:
+                tile_size = settings['tile_size']
+                tile_separation = settings.get('tile_separation')
+                roi_size = settings.get('roi_size')
+                
+                suffix = orientation_alignment_suffix(output_suffix, tile_size, tile_separation, roi_size)
+                output_path = blk.create_new_image_path(orient_image_path, output_dir, suffix, extension=extension)
+                
+                if output_path.exists() and skip_existing_images:
+                        continue
+                
+                if integral_image is None:
+                        print('\nIntegrating {} for a sweep over {} tile settings'.format(
+                                ret_image_path.name, len(tile_settings)))
+                        integral_image = OrientationIntegralImage(
+                                *_read_retardance_orientation(ret_image_path, orient_image_path))
+                
+                retardance, orientation, alignment = integral_image.tile_statistics(
+                        tile_size, tile_separation=tile_separation, roi_size=roi_size)
+                
+                df = orientation_alignment_dataframe(retardance, orientation, alignment, mouse, slide, modality)
+                blk.write_results(df, output_path, orientation_alignment_columns(roi=roi_size is not None))
+
+
+def bulk_sweep_orientation_alignment(ret_dir, orient_dir, output_dir, output_suffix, tile_settings,
+                                     skip_existing_images=True, extension='.csv'):
+        """Sweep several tile settings over every retardance/orientation image pair in two directories"""
+        ret_image_path_list, orient_image_path_list = blk.find_shared_images(ret_dir, orient_dir)
+        
+        for ret_image_path, orient_image_path in zip(ret_image_path_list, orient_image_path_list):
+                sweep_orientation_alignment(ret_image_path, orient_image_path, output_dir, output_suffix,
+                                            tile_settings, skip_existing_images=skip_existing_images,
+                                            extension=extension)
+
+
+def _retardance_scale_factor(ret_ceiling=35, wavelength=549, nm_input=True, deg_output=True):
+        """Factor that converts 16 bit retardance intensities into retardance in degrees or nm"""
+        pixel_type_factor = ret_ceiling / 65535
+        
+        if nm_input and deg_output:
+                wavelength_factor = 360 / wavelength
+        elif nm_input is False and deg_output is False:
+                wavelength_factor = wavelength / 360
+        else:
+                wavelength_factor = 1
+        
+        return pixel_type_factor * wavelength_factor
+
+
+def intensity_to_retardance_array(array: np.ndarray, ret_ceiling=35, wavelength=549,
+                                  nm_input=True, deg_output=True):
+        """
+        Scale a float32 retardance intensity array into retardance values in place
+        
+        :param array: float32 array of retardance intensities, which is overwritten
+        :param ret_ceiling:  The retardance value corresponding to max intensity
+        :param wavelength:  The wavelength of light used to image, for converting between degrees and retardance.
+        :param nm_input:  The input ret_ceiling is in nm if true, degrees if false
+        :param deg_output:  The output is in degrees if true, nm if false
+        :return: The same array, holding retardance values
+        """
+        array *= np.float32(_retardance_scale_factor(ret_ceiling, wavelength, nm_input, deg_output))
+        return array
+
+
+def orientation_to_degrees_array(array: np.ndarray):
+        """
+        Convert a float32 slow-axis array from hundredths of a degree into degrees rotated by 90, in place
+        
+        :param array: float32 array of slow-axis orientations in hundredths of a degree, which is overwritten
+        :return: The same array, holding orientations in degrees
+        """
+        array /= 100
+        return _rotate_90_degrees_array(array)
+
+
+def _rotate_90_degrees_array(array: np.ndarray):
+        """Rotate orientations by 90 degrees in place, wrapping values above 180 back into range"""
+        array += 90
+        array[array > 180] -= 180
+        return array
 
 
 def convert_intensity_to_retardance(itk_image,
@@ -237,122 +595,265 @@ def convert_intensity_to_retardance(itk_image,
         :return A new ITK image with retardance values either in degrees or in nm
         """
         
-        input_array = sitk.GetArrayFromImage(itk_image)
-        
         # todo: implement a check for pixel type
         
-        pixel_type_factor = ret_ceiling / 65535
-        
-        if nm_input and deg_output:
-                wavelength_factor = 360 / wavelength
-        elif nm_input is False and deg_output is False:
-                wavelength_factor = wavelength / 360
-        else:
-                wavelength_factor = 1
-        
-        output_array = input_array * pixel_type_factor * wavelength_factor
+        output_array = sitk.GetArrayFromImage(sitk.Cast(itk_image, sitk.sitkFloat32))
+        intensity_to_retardance_array(output_array, ret_ceiling, wavelength, nm_input, deg_output)
         
         output_image = sitk.GetImageFromArray(output_array)
-        output_image = sitk.Cast(output_image, sitk.sitkFloat32)
+        output_image.CopyInformation(itk_image)
         meta.copy_relevant_metadata(output_image, itk_image)
         
         return output_image
 
 
-def bulk_intensity_to_retardance(input_dir, output_dir, output_suffix,
-                                 skip_existing_images=True):
-        path_list = util.list_filetype_in_dir(input_dir, '.tif')
+def intensity_image_to_retardance(image_path, output_path):
+        """Convert one retardance intensity image file to degrees linear retardance"""
+        print('Converting {} to degrees linear retardance'.format(image_path.name))
         
-        for i in range(len(path_list)):
-                output_path = blk.create_new_image_path(
-                        path_list[i], output_dir, output_suffix)
-                if output_path.exists() and skip_existing_images:
-                        continue
-                
-                print('Converting {} to degrees linear retardance'.format(path_list[i].name))
-                
-                int_image = meta.setup_image(path_list[i])
-                ret_image = convert_intensity_to_retardance(int_image)
+        int_image = meta.setup_image(image_path, query_spacing=False)
+        ret_image = convert_intensity_to_retardance(int_image)
+
+        meta.write_image(ret_image, output_path)
 
-                meta.write_image(ret_image, output_path)
+
+def bulk_intensity_to_retardance(input_dir, output_dir, output_suffix,
+                                 skip_existing_images=True, num_workers=1, use_build_cache=False):
+        return blk.bulk_map(intensity_image_to_retardance, [input_dir], output_dir, output_suffix,
+                            skip_existing_images=skip_existing_images, num_workers=num_workers,
+                            use_build_cache=use_build_cache,
+                            prepare_item=meta.query_missing_spacing)
 
 
 def rotate_90_degrees(img: sitk.Image):
+        """Rotate an orientation image in degrees by 90 degrees, keeping its spacing, origin, and metadata"""
         array = sitk.GetArrayFromImage(img)
-        above = array > 90
-        below = array <= 90
-        array[above] = array[above] - 90
-        array[below] = array[below] + 90
-        img = sitk.GetImageFromArray(array)
-        return img
+        _rotate_90_degrees_array(array)
+        
+        rotated_img = sitk.GetImageFromArray(array)
+        rotated_img.CopyInformation(img)
+        meta.copy_relevant_metadata(rotated_img, img)
+        
+        return rotated_img
+
+
+def convert_orientation_to_degrees(itk_image):
+        """Convert a slow-axis image in hundredths of a degree into a float32 image in degrees rotated by 90"""
+        output_array = sitk.GetArrayFromImage(sitk.Cast(itk_image, sitk.sitkFloat32))
+        orientation_to_degrees_array(output_array)
+        
+        output_image = sitk.GetImageFromArray(output_array)
+        output_image.CopyInformation(itk_image)
+        meta.copy_relevant_metadata(output_image, itk_image)
+        
+        return output_image
+
+
+def orientation_image_to_proper_degrees(image_path, output_path):
+        """Convert one slow-axis image file to degrees rotated by 90"""
+        print('Converting {} to degrees proper'.format(image_path.name))
+        orient_img = meta.setup_image(image_path, query_spacing=False)
+        img = convert_orientation_to_degrees(orient_img)
+        
+        meta.write_image(img, output_path)
 
 
 def bulk_orientation_to_proper_degrees(input_dir, output_dir, output_suffix,
-                                       skip_existing_images=True):
-        path_list = util.list_filetype_in_dir(input_dir, '.tif')
-        for i in range(len(path_list)):
-                output_path = blk.create_new_image_path(
-                        path_list[i], output_dir, output_suffix)
+                                       skip_existing_images=True, num_workers=1, use_build_cache=False):
+        return blk.bulk_map(orientation_image_to_proper_degrees, [input_dir], output_dir, output_suffix,
+                            skip_existing_images=skip_existing_images, num_workers=num_workers,
+                            use_build_cache=use_build_cache,
+                            prepare_item=meta.query_missing_spacing)
+
+
+def read_converted_pair(ret_image_path, orient_image_path, ret_ceiling=35, wavelength=549):
+        """
+        Read a raw retardance intensity/slow-axis image pair once and convert it in place to float32 degrees
+        
+        :param ret_image_path: Path to the 16 bit retardance intensity image
+        :param orient_image_path: Path to the slow-axis image in hundredths of a degree
+        :param ret_ceiling: The retardance value in nm corresponding to max intensity
+        :param wavelength: The wavelength of light used to image
+        :return: Retardance and orientation arrays in degrees
+        """
+        ret_array = sitk.GetArrayFromImage(sitk.ReadImage(str(ret_image_path), sitk.sitkFloat32))
+        orient_array = sitk.GetArrayFromImage(sitk.ReadImage(str(orient_image_path), sitk.sitkFloat32))
+        
+        intensity_to_retardance_array(ret_array, ret_ceiling=ret_ceiling, wavelength=wavelength)
+        orientation_to_degrees_array(orient_array)
+        
+        return ret_array, orient_array
+
+
+def bulk_raw_to_orientation_alignment(ret_dir, orient_dir, output_dir, output_suffix,
+                                      tile_size, tile_separation=None, roi_size=None,
+                                      skip_existing_images=True, extension='.csv',
+                                      ret_ceiling=35, wavelength=549):
+        """
+        Calculate tile/ROI retardance, orientation, and alignment straight from raw retardance intensity and
+        slow-axis images.  Each pair is read and converted once in memory, without writing intermediate images.
+        
+        :param ret_dir: Directory holding the 16 bit retardance intensity images
+        :param orient_dir: Directory holding the slow-axis images in hundredths of a degree
+        :param output_dir: Directory to save the output results files
+        :param output_suffix: Base name of the output files, followed by the tile/roi sizes and separation
+        :param tile_size: Size in pixels of the tile
+        :param tile_separation: Distance between tiles, defaults to the tile size
+        :param roi_size: Size of regions of interest within tiles
+        :param skip_existing_images: Whether to skip image pairs whose results file already exists
+        :param extension: Results file extension: .csv, or .parquet/.arrow for columnar output
+        :param ret_ceiling: The retardance value in nm corresponding to max intensity
+        :param wavelength: The wavelength of light used to image
+        :return:
+        """
+        output_suffix_with_tilenum = orientation_alignment_suffix(output_suffix, tile_size,
+                                                                  tile_separation, roi_size)
+        
+        ret_image_path_list, orient_image_path_list = blk.find_shared_images(ret_dir, orient_dir)
+        
+        for ret_image_path, orient_image_path in zip(ret_image_path_list, orient_image_path_list):
+                output_path = blk.create_new_image_path(orient_image_path, output_dir,
+                                                        output_suffix_with_tilenum, extension=extension)
+                
                 if output_path.exists() and skip_existing_images:
                         continue
                 
-                print('Converting {} to degrees proper'.format(path_list[i].name))
-                orient_img = meta.setup_image(path_list[i])
-                deg_img = sitk.Divide(orient_img, 100)
-                img = rotate_90_degrees(deg_img)
+                print('\nConverting and averaging {0}'.format(ret_image_path.name))
+                
+                mouse, slide, modality = _sample_labels(ret_image_path, blk.get_core_file_name(output_path))
+                ret_array, orient_array = read_converted_pair(ret_image_path, orient_image_path,
+                                                              ret_ceiling=ret_ceiling, wavelength=wavelength)
+                
+                retardance, orientation, alignment = calculate_block_statistics(
+                        ret_array, orient_array, tile_size, tile_separation=tile_separation, roi_size=roi_size)
                 
-                meta.write_image(img, output_path)
+                df = orientation_alignment_dataframe(retardance, orientation, alignment, mouse, slide, modality)
+                blk.write_results(df, output_path, orientation_alignment_columns(roi=roi_size is not None))
+
+
+def _read_image_with_metadata(image_path):
+        """Read an image without user queries, applying its metadata file if one exists"""
+        image = sitk.ReadImage(str(image_path))
+        metadata = meta.read_metadata(Path(image_path))
+        
+        if metadata is not None:
+                for key in metadata:
+                        image.SetMetaData(key, metadata[key])
+        
+        return image
+
+
+def _downsampled_image(array, reference_image: sitk.Image, tile_size, tile_separation, tile_start):
+        """
+        Convert a tile statistic array into an image on the downsampled grid of a reference image
+        
+        :param array: Tile statistic array, in numpy axis order
+        :param reference_image: The full resolution image
+        :param tile_size: Size in pixels of the averaging window, in numpy axis order
+        :param tile_separation: Distance in pixels between windows, in numpy axis order
+        :param tile_start: Index of the first window, in numpy axis order
+        :return: A SimpleITK image with the pixel type, spacing, and origin of the downsampled grid
+        """
+        image = sitk.GetImageFromArray(array)
+        image = sitk.Cast(image, reference_image.GetPixelID())
+        
+        # SimpleITK orders spacing/origin as x, y while numpy orders axes as row, column
+        spacing = np.array(reference_image.GetSpacing())
+        window_center = (np.array(tile_start) + (np.array(tile_size) - 1) / 2)[::-1]
+        
+        image.SetSpacing(spacing * np.array(tile_separation)[::-1])
+        image.SetOrigin(np.array(reference_image.GetOrigin()) + window_center * spacing)
+        image.SetDirection(reference_image.GetDirection())
+        meta.copy_relevant_metadata(image, reference_image)
+        
+        return image
+
+
+def _window_and_step(scale_factor, simulated_resolution_factor=None):
+        """Convert a downsampling factor and simulated resolution into a 2D window size and step"""
+        tile_separation = np.array([scale_factor, scale_factor], dtype=int)
+        
+        if simulated_resolution_factor:
+                tile_size = np.array([simulated_resolution_factor, simulated_resolution_factor], dtype=int)
+        else:
+                tile_size = tile_separation
+        
+        return tile_size, tile_separation
 
 
 def downsample_retardance_image(ret_image_path, orient_image_path,
                                 tile_size,
                                 tile_separation=None):
-        if not tile_separation:
+        """
+        Downsample a retardance/orientation image pair by averaging the orientation-weighted retardance over blocks
+        
+        :param ret_image_path: Path to the retardance image
+        :param orient_image_path: Path to the orientation image
+        :param tile_size: Size in pixels of the averaging window
+        :param tile_separation: Distance in pixels between windows, which sets the downsampled spacing.
+        Defaults to the tile size
+        :return: Downsampled retardance and orientation images
+        """
+        tile_size = np.asarray(tile_size, dtype=int)
+        if tile_separation is None:
                 tile_separation = tile_size
+        tile_separation = np.asarray(tile_separation, dtype=int)
         
-        ret_image = sitk.ReadImage(ret_image_path)
-        orient_image = sitk.ReadImage(orient_image_path)
+        ret_image = _read_image_with_metadata(ret_image_path)
+        orient_image = _read_image_with_metadata(orient_image_path)
         
         ret_array = sitk.GetArrayFromImage(ret_image)
         orient_array = sitk.GetArrayFromImage(orient_image)
         
-        array_size = np.shape(ret_array)
+        down_ret_array, down_orient_array = calculate_block_statistics(
+                ret_array, orient_array, tile_size, tile_separation=tile_separation)[:2]
+        
+        tile_start = [starts[0] for starts in til.tile_start_indices(np.shape(ret_array), tile_size,
+                                                                       tile_separation)]
+        
+        down_ret_image = _downsampled_image(down_ret_array, ret_image, tile_size, tile_separation, tile_start)
+        down_orient_image = _downsampled_image(down_orient_array, orient_image, tile_size, tile_separation,
+                                               tile_start)
+        
+        return down_ret_image, down_orient_image
+
+
+def downsample_retardance_pyramid(ret_image_path, orient_image_path, scale_factors,
+                                  simulated_resolution_factor=None):
+        """
+        Downsample a retardance/orientation image pair to several scales from a single read of the images
         
-        pixel_num, offset = til.calculate_number_of_tiles(
-                array_size, tile_size, tile_separation)
+        :param ret_image_path: Path to the retardance image
+        :param orient_image_path: Path to the orientation image
+        :param scale_factors: List of downsampling factors, e.g. [2, 4, 8]
+        :param simulated_resolution_factor: Averaging window size in pixels, if it should differ from the scale
+        :return: Dictionary mapping each scale factor to a (retardance image, orientation image) tuple
+        """
+        ret_image = _read_image_with_metadata(ret_image_path)
+        orient_image = _read_image_with_metadata(orient_image_path)
         
-        down_ret_array = np.zeros(pixel_num)
-        down_orient_array = np.zeros(pixel_num)
+        ret_array = sitk.GetArrayFromImage(ret_image)
+        integral_image = OrientationIntegralImage(ret_array, sitk.GetArrayFromImage(orient_image))
         
-        for start, end, tile_number in til.generate_tile_start_end_index(
-                    pixel_num, tile_size, tile_offset=offset,
-                    tile_separation=tile_separation):
-                ret_tile = ret_array[range(start[0], end[0]),
-                                     range(start[1], end[1])]
+        pyramid = {}
+        for scale_factor in scale_factors:
+                tile_size, tile_separation = _window_and_step(scale_factor, simulated_resolution_factor)
                 
-                orient_tile = orient_array[range(start[0], end[0]),
-                                           range(start[1], end[1])]
+                down_ret_array, down_orient_array = integral_image.tile_statistics(
+                        tile_size, tile_separation=tile_separation)[:2]
                 
-                ret_pixel, orient_pixel = calculate_retardance_over_area(
-                        ret_tile, orient_tile)
+                tile_start = [starts[0] for starts in til.tile_start_indices(np.shape(ret_array), tile_size,
+                                                                               tile_separation)]
                 
-                down_ret_array[tile_number[0], tile_number[1]] = ret_pixel
-                down_orient_array[tile_number[0], tile_number[1]] = orient_pixel
-        
-        down_ret_image = sitk.GetImageFromArray(down_ret_array)
-        down_ret_image = sitk.Cast(down_ret_image, ret_image.GetPixelID())
-        down_ret_image.SetMetaData(ret_image.GetMetaData())
+                pyramid[scale_factor] = (
+                        _downsampled_image(down_ret_array, ret_image, tile_size, tile_separation, tile_start),
+                        _downsampled_image(down_orient_array, orient_image, tile_size, tile_separation,
+                                           tile_start))
         
-        down_orient_image = sitk.GetImageFromArray(down_orient_array)
-        down_orient_image = sitk.Cast(down_orient_image, orient_image.GetPixelID())
-        down_orient_image.GetMetaData(orient_image.GetMetaData())
-        
-        return down_ret_image, down_orient_image
+        return pyramid
 
 
-def batch_downsample_retardance(ret_dir, orient_dir, output_dir,
-                                scale_factor,
-                                simulated_resolution_factor=None):
+def _downsample_suffix(scale_factor, simulated_resolution_factor=None):
         output_suffix = 'DownSample-' + str(scale_factor) + 'x'
         
         if (simulated_resolution_factor
@@ -360,25 +861,49 @@ def batch_downsample_retardance(ret_dir, orient_dir, output_dir,
                 output_suffix = (output_suffix + '_SimRes-'
                                  + str(simulated_resolution_factor) + 'x')
         
+        return output_suffix
+
+
+def batch_downsample_retardance(ret_dir, orient_dir, output_dir,
+                                scale_factors,
+                                simulated_resolution_factor=None):
+        """
+        Downsample every retardance/orientation image pair in two directories to one or more scales
+        
+        :param ret_dir: Directory holding the retardance images
+        :param orient_dir: Directory holding the orientation images
+        :param output_dir: Directory to write the downsampled images to, in a subdirectory per scale
+        :param scale_factors: Downsampling factor, or a list of factors to write as a pyramid, e.g. [2, 4, 8]
+        :param simulated_resolution_factor: Averaging window size in pixels, if it should differ from the scale
+        :return:
+        """
+        scale_factors = np.atleast_1d(scale_factors).tolist()
+        
         (ret_image_path_list, orient_image_path_list) = blk.find_shared_images(
                 ret_dir, orient_dir)
         
         for i in range(0, np.size(ret_image_path_list)):
-                (down_ret_image, down_orient_image) = downsample_retardance_image(
-                        ret_image_path_list[i], orient_image_path_list[i],
-                        scale_factor, simulated_resolution_factor)
-                
-                down_ret_dir = os.path.join(output_dir, output_suffix, '_ret', )
-                down_orient_dir = os.path.join(output_dir, output_suffix, 'SlowAxis', )
+                print('Downsampling {0} by {1}'.format(ret_image_path_list[i].name, scale_factors))
                 
-                down_ret_path = blk.create_new_image_path(ret_image_path_list[i],
-                                                          down_ret_dir,
-                                                          '__ret_' + output_suffix)
+                pyramid = downsample_retardance_pyramid(ret_image_path_list[i], orient_image_path_list[i],
+                                                        scale_factors, simulated_resolution_factor)
                 
-                down_orient_path = blk.create_new_image_path(
-                        orient_image_path_list[i],
-                        down_orient_dir,
-                        '_SlowAxis_' + output_suffix)
-                
-                meta.write_image(down_ret_image, down_ret_path)
-                meta.write_image(down_orient_image, down_orient_path)
+                for scale_factor, (down_ret_image, down_orient_image) in pyramid.items():
+                        output_suffix = _downsample_suffix(scale_factor, simulated_resolution_factor)
+                        
+                        down_ret_dir = Path(output_dir, output_suffix, 'ret')
+                        down_orient_dir = Path(output_dir, output_suffix, 'SlowAxis')
+                        os.makedirs(down_ret_dir, exist_ok=True)
+                        os.makedirs(down_orient_dir, exist_ok=True)
+                        
+                        down_ret_path = blk.create_new_image_path(ret_image_path_list[i],
+                                                                  down_ret_dir,
+                                                                  'ret_' + output_suffix)
+                        
+                        down_orient_path = blk.create_new_image_path(
+                                orient_image_path_list[i],
+                                down_orient_dir,
+                                'SlowAxis_' + output_suffix)
+                        
+                        meta.write_image(down_ret_image, down_ret_path)
+                        meta.write_image(down_orient_image, down_orient_path)
@@ -12,10 +12,8 @@ Created on Wed Jul 18 16:18:01 2018
 # Compare to analyzed data
 
 import multiscale.polarimetry.task_scripts.dir_dictionary as dird
-import multiscale.utility_functions as util
 import multiscale.polarimetry.retardance as pol
 import pandas as pd
-import re
 
 from pathlib import Path
 
@@ -27,20 +25,22 @@ def convert_ps_to_retardance(dir_dict):
 
 def average_images(dir_dict):
         
-        pol.bulk_process_orientation_alignment(
+        merged_mhr = pol.bulk_process_orientation_alignment(
                 dir_dict['mhr_large_reg'], dir_dict['mhr_large_reg_orient'], dir_dict['avg_ret'],
                 'MHR', [512, 512], roi_size=[64, 64])
         
-        pol.bulk_process_orientation_alignment(
+        merged_mlr = pol.bulk_process_orientation_alignment(
                 dir_dict['mlr_large_reg'], dir_dict['mlr_large_reg_orient'], dir_dict['avg_ret'],
                 'MLR', [512, 512], roi_size=[64, 64])
         
-        pol.bulk_process_orientation_alignment(dir_dict['ps_reg'], dir_dict['ps_reg_orient'], dir_dict['avg_ret'],
-                                               'PS', [512, 512], roi_size=[64, 64])
+        merged_ps = pol.bulk_process_orientation_alignment(dir_dict['ps_reg'], dir_dict['ps_reg_orient'],
+                                                           dir_dict['avg_ret'], 'PS', [512, 512], roi_size=[64, 64])
+        
+        return [merged_mhr, merged_mlr, merged_ps]
+
 
-def scrape_averaged_files_to_df(dir_avg):
-        list_csvs = util.list_filetype_in_dir(dir_avg, 'csv')
-        list_dfs = [pd.read_csv(item) for item in list_csvs if re.search('64', str(item))]
+def scrape_averaged_files_to_df(list_merged_csvs):
+        list_dfs = [pd.read_csv(item, dtype={'Mouse': str, 'Slide': str}) for item in list_merged_csvs]
         
         df_avg_raw = pd.concat(list_dfs)
         
@@ -53,17 +53,17 @@ def scrape_averaged_files_to_df(dir_avg):
         return df_avg
 
 
-dir_dict = dird.create_dictionary()
+if __name__ == '__main__':
+        dir_dict = dird.create_dictionary()
 
-convert_ps_to_retardance(dir_dict)
+        convert_ps_to_retardance(dir_dict)
 
-average_images(dir_dict)
+        list_merged_csvs = average_images(dir_dict)
 
-dir_avg = dir_dict['avg_ret']
-df_avg = scrape_averaged_files_to_df(dir_avg)
+        df_avg = scrape_averaged_files_to_df(list_merged_csvs)
 
 
-path_avg = Path('F:\Research\Polarimetry\Data 04 - Analysis results and graphics',
-                'ROIs_averaged_from_base_image_old2.csv')
+        path_avg = Path('F:\Research\Polarimetry\Data 04 - Analysis results and graphics',
+                        'ROIs_averaged_from_base_image_old2.csv')
 
-df_avg.to_csv(path_avg)
\ No newline at end of file
+        df_avg.to_csv(path_avg)
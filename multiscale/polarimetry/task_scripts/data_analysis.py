@@ -7,17 +7,15 @@ Created on Tue Jun 19 16:11:52 2018
 
 import multiscale.polarimetry.analysis as an
 import multiscale.statistics as stat
+import multiscale.bulk_img_processing as blk
 import pandas as pd
 from pathlib import Path
 
 
 def get_tile_roi_cyto_df(tile_path, roi_path, cyto_path):
-        tile_df = pd.read_csv(tile_path, header=[0, 1], index_col=[0, 1, 2],
-                              low_memory=False)
-        roi_df = pd.read_csv(roi_path, header=[0, 1], index_col=[0, 1, 2, 3],
-                             low_memory=False)
-        cyto_df = pd.read_csv(cyto_path, header=[0, 1], index_col=[0, 1, 2],
-                              low_memory=False)
+        tile_df = blk.read_results(tile_path, index_levels=3, column_levels=2)
+        roi_df = blk.read_results(roi_path, index_levels=4, column_levels=2)
+        cyto_df = blk.read_results(cyto_path, index_levels=3, column_levels=2)
         
         return tile_df, roi_df, cyto_df
 
@@ -115,10 +113,9 @@ def get_average_dfs(path_shg: Path, path_average: Path, ret_thresh: float) -> (p
         #                      low_memory=False)
         # df_shg = df_rois.xs('SHG', level=1, axis=1)
         
-        df_shg = pd.read_csv(path_shg, header=[0, 1], index_col=[0, 1, 2, 3], low_memory=False)
+        df_shg = blk.read_results(path_shg, index_levels=4, column_levels=2)
         
-        df_average = pd.read_csv(path_average, header=[0, 1], index_col=[0, 1, 2, 3],
-                                 low_memory=False)
+        df_average = blk.read_results(path_average, index_levels=4, column_levels=2)
         
         df_average.rename(index=str, columns={'MHR-O': 'MHR', 'MLR-O': 'MLR', 'PS-O': 'PS'}, inplace=True)
         
@@ -174,7 +171,7 @@ def fib_comparison(ret_thresh: float, fib_thresh: int, seg_thresh: int):
                          'CA_FibNum_SHG.csv')
         
         df_orient, df_align, df_ret = get_average_dfs(path_shg, path_average, ret_thresh)
-        df_fibs = pd.read_csv(path_fibs, index_col=[0, 1, 2, 3], low_memory=False)
+        df_fibs = blk.read_results(path_fibs, index_levels=4)
         
         df_orient_merged = pd.concat([df_orient, df_fibs], axis=1, join='inner')
         df_orient_thresh_1 = threshold_by_fiber_num(df_orient_merged, fib_thresh)
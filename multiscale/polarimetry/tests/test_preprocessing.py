@@ -0,0 +1,67 @@
+import pytest
+import numpy as np
+import SimpleITK as sitk
+from pathlib import Path
+
+pytest.importorskip('bioformats')
+import multiscale.polarimetry.preprocessing as pre
+import multiscale.itk.registration as reg
+
+
+class TestParallelPolarizationStateTransforms(object):
+        def test_registers_every_state_and_survives_failures(self, tmpdir, monkeypatch):
+                coordinates = np.mgrid[0:64, 0:64]
+                array = np.exp(-((coordinates[0] - 30) ** 2 + (coordinates[1] - 34) ** 2) / 200).astype(np.float32)
+                states = {idx: np.roll(array, idx % 3, axis=1) for idx in range(24)}
+                states[5] = np.zeros([3, 3], dtype=np.float32)
+                
+                monkeypatch.setattr(pre, 'czi_timepoints_to_arrays',
+                                    lambda path, positions: {position: states[position] for position in positions})
+                
+                with pytest.warns(UserWarning):
+                        results = pre.calculate_polarization_state_transforms(
+                                Path('synthetic.czi'), 1.0, Path(str(tmpdir)), 'T', supervised=False, num_workers=2,
+                                registration_parameters=reg.setup_registration_parameters(sampling_percentage=0.5))
+                
+                assert sorted(results) == list(range(1, 24))
+                assert results[5][1].startswith('Failed')
+                assert not tmpdir.join('T_6.tfm').check()
+                
+                for idx in [1, 2, 4]:
+                        transform = sitk.ReadTransform(str(tmpdir.join('T_{0}.tfm'.format(idx + 1))))
+                        assert transform.GetParameters()[-2] == pytest.approx(idx % 3, abs=0.5)
+
+
+class TestStackedPolarizationTransforms(object):
+        def test_writes_one_compressed_stack_per_image(self, tmpdir, monkeypatch):
+                tifffile = pytest.importorskip('tifffile')
+                dir_input = Path(str(tmpdir.mkdir('input')))
+                dir_transforms = Path(str(tmpdir.mkdir('transforms')))
+                dir_output = Path(str(tmpdir.mkdir('output')))
+                for name in ['first.tif', 'second.tif']:
+                        Path(dir_input, name).touch()
+                identity = sitk.Transform(2, sitk.sitkIdentity)
+                for idx in range(2, 25):
+                        sitk.WriteTransform(identity, str(Path(dir_transforms, 'T_{0}.tfm'.format(idx))))
+                
+                monkeypatch.setattr(pre, 'czi_timepoints_to_arrays',
+                                    lambda path, positions: {position: np.full([16, 16], position, dtype=np.float32)
+                                                             for position in positions})
+                
+                pre.bulk_apply_polarization_transforms(dir_input, dir_output, dir_transforms, 'T', 0.5,
+                                                       stacked=True, num_threads=2)
+                
+                outputs = sorted(path.name for path in dir_output.iterdir() if path.suffix == '.tif')
+                assert outputs == ['first_states.tif', 'second_states.tif']
+                
+                for name in outputs:
+                        stack = sitk.ReadImage(str(Path(dir_output, name)))
+                        assert stack.GetSize() == (16, 16, 24)
+                        assert stack.GetSpacing()[:2] == pytest.approx((0.5, 0.5))
+                        
+                        array = sitk.GetArrayFromImage(stack)
+                        for state in range(24):
+                                assert np.all(array[state] == state)
+                        
+                        with tifffile.TiffFile(str(Path(dir_output, name))) as tif:
+                                assert tif.pages[0].compression != 1
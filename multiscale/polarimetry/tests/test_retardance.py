@@ -85,4 +85,167 @@
 #                         inputImg, deg_output = False, nm_input = False), outputImg)
 #
 # if __name__ == '__main__':
-#         unittest.main(verbosity=2)
\ No newline at end of file
+#         unittest.main(verbosity=2)
+
+import pytest
+import numpy as np
+import pandas as pd
+import multiscale.polarimetry.retardance as ret
+import SimpleITK as sitk
+from pathlib import Path
+
+
+@pytest.fixture()
+def retardance_orientation_arrays():
+        rng = np.random.RandomState(0)
+        retardance = rng.rand(40, 52) * 30
+        orientation = rng.rand(40, 52) * 180
+        orientation[:10, :12] = 0
+        return retardance, orientation
+
+
+class TestCalculateBlockStatistics(object):
+        def test_tiles_match_single_area_calculation(self, retardance_orientation_arrays):
+                retardance, orientation = retardance_orientation_arrays
+                tile_size = np.array([8, 8])
+                
+                ret_blocks, orient_blocks, align_blocks = ret.calculate_block_statistics(
+                        retardance, orientation, tile_size)
+                
+                # 40x52 leaves a 4 pixel remainder along y, centered as a 2 pixel offset
+                ret_tile, orient_tile = ret.calculate_retardance_over_area(retardance[8:16, 10:18],
+                                                                           orientation[8:16, 10:18])
+                
+                assert ret_blocks.shape == (5, 6)
+                assert np.isclose(ret_blocks[1, 1], ret_tile)
+                assert np.isclose(orient_blocks[1, 1], orient_tile)
+                assert np.isclose(align_blocks[1, 1], ret.calculate_alignment(orientation[8:16, 10:18]))
+        
+        def test_rois_within_tiles(self, retardance_orientation_arrays):
+                retardance, orientation = retardance_orientation_arrays
+                
+                ret_blocks, orient_blocks, align_blocks = ret.calculate_block_statistics(
+                        retardance, orientation, np.array([8, 8]), roi_size=np.array([4, 4]))
+                
+                ret_roi, orient_roi = ret.calculate_retardance_over_area(retardance[12:16, 6:10],
+                                                                         orientation[12:16, 6:10])
+                
+                assert ret_blocks.shape == (5, 6, 2, 2)
+                assert np.isclose(ret_blocks[1, 0, 1, 1], ret_roi)
+        
+        def test_empty_orientation_gives_nan_alignment(self, retardance_orientation_arrays):
+                retardance, orientation = retardance_orientation_arrays
+                
+                align_blocks = ret.calculate_block_statistics(retardance, orientation, np.array([8, 8]))[2]
+                
+                assert np.isnan(align_blocks[0, 0])
+
+
+class TestOrientationAlignmentDataframe(object):
+        def test_tile_and_roi_labels(self):
+                values = np.arange(8, dtype=float).reshape([1, 2, 2, 2]) + 1
+                df = ret.orientation_alignment_dataframe(values, values, values, '1045', '1', 'MHR-O')
+                
+                assert list(df.columns) == ['Mouse', 'Slide', 'Modality', 'Tile', 'ROI',
+                                            'Retardance', 'Orientation', 'Alignment']
+                assert list(df['Tile'][:5]) == ['0x-0y'] * 4 + ['0x-1y']
+                assert list(df['ROI'][:4]) == ['ROI0x0y', 'ROI0x1y', 'ROI1x0y', 'ROI1x1y']
+
+
+class TestOrientationIntegralImage(object):
+        @pytest.mark.parametrize('tile_size, tile_separation, roi_size', [
+                ([8, 8], None, None), ([8, 8], None, [4, 4]), ([8, 8], [5, 5], None), ([6, 10], [12, 7], None)
+        ])
+        def test_matches_block_statistics(self, retardance_orientation_arrays,
+                                          tile_size, tile_separation, roi_size):
+                retardance, orientation = retardance_orientation_arrays
+                integral_image = ret.OrientationIntegralImage(retardance, orientation)
+                
+                expected = ret.calculate_block_statistics(retardance, orientation, tile_size,
+                                                          tile_separation=tile_separation, roi_size=roi_size)
+                output = integral_image.tile_statistics(tile_size, tile_separation=tile_separation,
+                                                        roi_size=roi_size)
+                
+                for expected_values, output_values in zip(expected, output):
+                        np.testing.assert_allclose(output_values, expected_values)
+
+
+class TestDownsampleRetardance(object):
+        @pytest.fixture()
+        def image_paths(self, tmpdir, retardance_orientation_arrays):
+                paths = []
+                for name, array in zip(['ret', 'orient'], retardance_orientation_arrays):
+                        image = sitk.GetImageFromArray(array.astype(np.float32))
+                        image.SetSpacing([0.5, 0.5])
+                        path = Path(str(tmpdir.join('1045-1_' + name + '.tif')))
+                        sitk.WriteImage(image, str(path))
+                        paths.append(path)
+                return paths
+        
+        def test_blocks_are_averaged_not_diagonals(self, image_paths, retardance_orientation_arrays):
+                retardance, orientation = retardance_orientation_arrays
+                down_ret, down_orient = ret.downsample_retardance_image(image_paths[0], image_paths[1], [4, 4])
+                
+                expected_ret, expected_orient = ret.calculate_retardance_over_area(retardance[4:8, 4:8],
+                                                                                   orientation[4:8, 4:8])
+                
+                assert down_ret.GetSize() == (13, 10)
+                assert down_ret.GetSpacing() == pytest.approx((2, 2))
+                assert sitk.GetArrayFromImage(down_ret)[1, 1] == pytest.approx(expected_ret, rel=1e-5)
+                assert sitk.GetArrayFromImage(down_orient)[1, 1] == pytest.approx(expected_orient, rel=1e-5)
+        
+        def test_pyramid_matches_single_scale(self, image_paths):
+                pyramid = ret.downsample_retardance_pyramid(image_paths[0], image_paths[1], [2, 4])
+                down_ret = ret.downsample_retardance_image(image_paths[0], image_paths[1], [4, 4])[0]
+                
+                np.testing.assert_allclose(sitk.GetArrayFromImage(pyramid[4][0]),
+                                           sitk.GetArrayFromImage(down_ret), rtol=1e-5)
+
+
+
+class TestBulkProcessOrientationAlignment(object):
+        def test_failed_pair_does_not_stop_the_others(self, tmpdir, retardance_orientation_arrays):
+                ret_dir = tmpdir.mkdir('ret')
+                orient_dir = tmpdir.mkdir('orient')
+                output_dir = tmpdir.mkdir('output')
+                for sample in ['1045-1', '1046-1']:
+                        for directory, name, array in zip([ret_dir, orient_dir], ['ret', 'orient'],
+                                                          retardance_orientation_arrays):
+                                image = sitk.GetImageFromArray(array.astype(np.float32))
+                                image.SetSpacing([0.5, 0.5])
+                                sitk.WriteImage(image, str(directory.join(sample + '_' + name + '.tif')))
+                orient_dir.join('1045-1_orient.tif').write('not an image')
+                
+                with pytest.warns(UserWarning):
+                        merged_path = ret.bulk_process_orientation_alignment(
+                                str(ret_dir), str(orient_dir), str(output_dir), 'OA', [8, 8], num_workers=1)
+                
+                merged = pd.read_csv(str(merged_path), dtype={'Mouse': str})
+                assert set(merged['Mouse']) == {'1046'}
+
+
+class TestRawConversion(object):
+        def test_orientation_conversion_keeps_fractions_and_spacing(self):
+                image = sitk.GetImageFromArray(np.array([[0, 4550], [9000, 17999]], dtype=np.uint16))
+                image.SetSpacing([3, 3])
+                
+                degrees = ret.convert_orientation_to_degrees(image)
+                
+                np.testing.assert_allclose(sitk.GetArrayFromImage(degrees), [[90, 135.5], [180, 89.99]], rtol=1e-5)
+                assert degrees.GetSpacing() == (3, 3)
+        
+        def test_fused_pair_matches_image_conversion(self, tmpdir):
+                ret_image = sitk.GetImageFromArray(np.array([[0, 4550], [65535, 1000]], dtype=np.uint16))
+                orient_image = sitk.GetImageFromArray(np.array([[0, 4550], [9000, 17999]], dtype=np.uint16))
+                ret_path = str(tmpdir.join('ret.tif'))
+                orient_path = str(tmpdir.join('orient.tif'))
+                sitk.WriteImage(ret_image, ret_path)
+                sitk.WriteImage(orient_image, orient_path)
+                
+                ret_array, orient_array = ret.read_converted_pair(ret_path, orient_path)
+                
+                np.testing.assert_allclose(
+                        ret_array, sitk.GetArrayFromImage(ret.convert_intensity_to_retardance(ret_image)))
+                np.testing.assert_allclose(
+                        orient_array, sitk.GetArrayFromImage(ret.convert_orientation_to_degrees(orient_image)))
+                assert ret_array[1, 0] == pytest.approx(35 * 360 / 549, rel=1e-5)
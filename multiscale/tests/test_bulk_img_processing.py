@@ -1,7 +1,10 @@
 # -*- coding: utf-8 -*-
 
 import multiscale.bulk_img_processing as blk
+from concurrent.futures import ThreadPoolExecutor
+import os
 from pathlib import Path
+import tempfile
 import unittest
 
 
@@ -75,6 +78,279 @@ class create_new_image_path_TestSuite(unittest.TestCase):
                                              extension = extension)
         self.assertEqual(new_path, expected)
 
+
+
+class dataframe_generator_csv_TestSuite(unittest.TestCase):
+    
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.file_list = []
+        for index in range(3):
+            file_path = Path(self.temp_dir.name, 'results{0}.csv'.format(index))
+            file_path.write_text('Image,Alignment,Orientation\nimg{0}.tif,{0},90\n'.format(index))
+            self.file_list.append(file_path)
+    
+    def tearDown(self):
+        self.temp_dir.cleanup()
+    
+    def test_prefetched_frames_keep_order_and_selected_columns(self):
+        frames = list(blk.dataframe_generator_csv(self.file_list, relevant_cols=['Image', 'Alignment']))
+        
+        self.assertEqual([list(df.columns) for df in frames], [['Image', 'Alignment']] * 3)
+        self.assertEqual([df['Alignment'][0] for df in frames], [0, 1, 2])
+    
+    def test_pyarrow_engine(self):
+        try:
+            import pyarrow
+        except ImportError:
+            self.skipTest('pyarrow is not installed')
+        
+        frames = list(blk.dataframe_generator_csv(self.file_list, engine='pyarrow', prefetch=False))
+        self.assertEqual(list(frames[2]['Image']), ['img2.tif'])
+
+
+class ResultsWriter_TestSuite(unittest.TestCase):
+    
+    columns = {'Mouse': 'str', 'Tile': 'str', 'Alignment': 'float'}
+    rows = [['1045', '0x-0y', 0.5], ['WT1', '0x-1y', 0.25], ['1045', '1x-0y', 1]]
+    
+    def write_and_read(self, extension):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = Path(tmpdir, 'results' + extension)
+            with blk.ResultsWriter(path, self.columns, batch_size=2) as writer:
+                writer.write_rows(self.rows)
+            return blk.read_results(path, dtype={'Mouse': str})
+    
+    def test_csv_round_trip(self):
+        df = self.write_and_read('.csv')
+        self.assertEqual(list(df.columns), list(self.columns))
+        self.assertEqual(list(df['Mouse']), ['1045', 'WT1', '1045'])
+        self.assertEqual(list(df['Alignment']), [0.5, 0.25, 1.0])
+    
+    def test_parquet_round_trip(self):
+        try:
+            import pyarrow
+        except ImportError:
+            self.skipTest('pyarrow is not installed')
+        
+        df = self.write_and_read('.parquet')
+        self.assertEqual(list(df['Tile']), ['0x-0y', '0x-1y', '1x-0y'])
+        self.assertEqual(list(df['Alignment']), [0.5, 0.25, 1.0])
+
+
+
+class ResultsStore_TestSuite(unittest.TestCase):
+    
+    column_labels = ['Spacing', 'X Origin', 'Y Origin', 'Rotation']
+    
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+    
+    def tearDown(self):
+        self.temp_dir.cleanup()
+    
+    def test_buffered_writes_match_unbuffered_file(self):
+        unbuffered = Path(self.temp_dir.name, 'unbuffered.csv')
+        buffered = Path(self.temp_dir.name, 'buffered.csv')
+        
+        for index in range(4):
+            blk.write_pandas_row(unbuffered, 'img{0}.tif'.format(index), [1.0, index, 2 * index, 0],
+                                 'Image', self.column_labels)
+        blk.write_pandas_value(unbuffered, 'img2.tif', 'note', 'Extra', 'Image')
+        
+        with blk.buffered_results(flush_every=3):
+            for index in range(4):
+                blk.write_pandas_row(buffered, 'img{0}.tif'.format(index), [1.0, index, 2 * index, 0],
+                                     'Image', self.column_labels)
+            blk.write_pandas_value(buffered, 'img2.tif', 'note', 'Extra', 'Image')
+            self.assertEqual(blk.read_pandas_row(buffered, 'img3.tif', 'Image')['Y Origin'], 6)
+        
+        self.assertEqual(unbuffered.read_text(), buffered.read_text())
+    
+    def test_reads_rows_before_the_file_is_flushed(self):
+        file_path = Path(self.temp_dir.name, 'new.csv')
+        
+        with blk.buffered_results(flush_every=100):
+            blk.write_pandas_row(file_path, 'img0.tif', [1.0, 4, 5, 0], 'Image', self.column_labels)
+            self.assertFalse(file_path.is_file())
+            self.assertEqual(blk.read_pandas_row(file_path, 'img0.tif', 'Image')['X Origin'], 4)
+        
+        self.assertTrue(file_path.is_file())
+    
+    def test_threads_share_buffered_stores(self):
+        file_path = Path(self.temp_dir.name, 'threaded.csv')
+        
+        def write(index):
+            blk.write_pandas_row(file_path, 'img{0}.tif'.format(index), [1.0, index, 2 * index, 0],
+                                 'Image', self.column_labels)
+        
+        with blk.buffered_results(flush_every=7):
+            with ThreadPoolExecutor(max_workers=8) as pool:
+                list(pool.map(write, range(200)))
+        
+        results = blk.read_results(file_path, index_levels=1)
+        self.assertEqual(len(results), 200)
+        self.assertEqual(results.loc['img150.tif', 'Y Origin'], 300)
+    
+    def test_existing_rows_are_updated(self):
+        file_path = Path(self.temp_dir.name, 'Transforms.csv')
+        blk.write_pandas_row(file_path, 'img0.tif', [1.0, 0, 0, 0], 'Image', self.column_labels)
+        
+        with blk.ResultsStore(file_path, 'Image') as store:
+            store.write_row('img0.tif', [2.0, 1, 1, 0])
+            store.write_row('img1.tif', [3.0, 1, 1, 0])
+        
+        data = blk.read_results(file_path, index_levels=1)
+        self.assertEqual(list(data['Spacing']), [2.0, 3.0])
+
+
+def copy_text(input_path, output_path):
+    if input_path.read_text() == 'broken':
+        raise ValueError('broken input')
+    output_path.write_text(input_path.read_text())
+
+
+def prefix_text(input_path, output_path, prefix=''):
+    output_path.write_text(prefix + input_path.read_text())
+
+
+class bulk_map_TestSuite(unittest.TestCase):
+    
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.input_dir = Path(self.temp_dir.name, 'input')
+        self.output_dir = Path(self.temp_dir.name, 'output')
+        self.input_dir.mkdir()
+        self.output_dir.mkdir()
+        for name, text in [('1045_SHG.tif', 'a'), ('1046_SHG.tif', 'broken'), ('1047_SHG.tif', 'c')]:
+            Path(self.input_dir, name).write_text(text)
+    
+    def tearDown(self):
+        blk.clear_catalog_cache()
+        self.temp_dir.cleanup()
+    
+    def test_failures_are_isolated(self):
+        with self.assertWarns(UserWarning):
+            failures = blk.bulk_map(copy_text, [self.input_dir], self.output_dir, 'Copy',
+                                    num_workers=2, use_threads=True)
+        
+        self.assertEqual([paths[0].name for paths, error in failures], ['1046_SHG.tif'])
+        self.assertEqual(sorted(path.name for path in self.output_dir.iterdir()),
+                         ['1045_Copy.tif', '1047_Copy.tif'])
+    
+    def test_existing_outputs_are_skipped(self):
+        Path(self.output_dir, '1045_Copy.tif').write_text('done')
+        Path(self.input_dir, '1046_SHG.tif').write_text('b')
+        
+        failures = blk.bulk_map(copy_text, [self.input_dir], self.output_dir, 'Copy')
+        
+        self.assertEqual(failures, [])
+        self.assertEqual(Path(self.output_dir, '1045_Copy.tif').read_text(), 'done')
+        self.assertEqual(Path(self.output_dir, '1046_Copy.tif').read_text(), 'b')
+    
+    def test_items_are_prepared_before_dispatch(self):
+        Path(self.input_dir, '1046_SHG.tif').write_text('b')
+        prepared = []
+        
+        def prepare_item(input_path):
+            prepared.append(input_path.name)
+            return {'prefix': blk.get_core_file_name(input_path)}
+        
+        failures = blk.bulk_map(prefix_text, [self.input_dir], self.output_dir, 'Copy', num_workers=2,
+                                use_threads=True, prepare_item=prepare_item)
+        
+        self.assertEqual(failures, [])
+        self.assertEqual(sorted(prepared), ['1045_SHG.tif', '1046_SHG.tif', '1047_SHG.tif'])
+        self.assertEqual(Path(self.output_dir, '1046_Copy.tif').read_text(), '1046b')
+
+
+class BuildCache_TestSuite(unittest.TestCase):
+    
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.input_dir = Path(self.temp_dir.name, 'input')
+        self.output_dir = Path(self.temp_dir.name, 'output')
+        self.input_dir.mkdir()
+        for name, text in [('1045_SHG.tif', 'a'), ('1046_SHG.tif', 'b')]:
+            Path(self.input_dir, name).write_text(text)
+    
+    def tearDown(self):
+        blk.clear_catalog_cache()
+        self.temp_dir.cleanup()
+    
+    def test_only_changed_inputs_are_recomputed(self):
+        blk.bulk_map(copy_text, [self.input_dir], self.output_dir, 'Copy', use_build_cache=True,
+                     content_hash=True)
+        Path(self.output_dir, '1045_Copy.tif').write_text('untouched')
+        Path(self.output_dir, '1046_Copy.tif').write_text('untouched')
+        Path(self.input_dir, '1046_SHG.tif').write_text('changed')
+        
+        blk.bulk_map(copy_text, [self.input_dir], self.output_dir, 'Copy', use_build_cache=True,
+                     content_hash=True)
+        
+        self.assertEqual(Path(self.output_dir, '1045_Copy.tif').read_text(), 'untouched')
+        self.assertEqual(Path(self.output_dir, '1046_Copy.tif').read_text(), 'changed')
+    
+    def test_prepared_parameters_are_signed_per_item(self):
+        prefixes = {'1045_SHG.tif': 'x', '1046_SHG.tif': 'y'}
+        
+        def prepare_item(input_path):
+            return {'prefix': prefixes[input_path.name]}
+        
+        blk.bulk_map(prefix_text, [self.input_dir], self.output_dir, 'Copy', use_build_cache=True,
+                     prepare_item=prepare_item)
+        Path(self.output_dir, '1045_Copy.tif').write_text('untouched')
+        Path(self.output_dir, '1046_Copy.tif').write_text('untouched')
+        prefixes['1046_SHG.tif'] = 'z'
+        
+        blk.bulk_map(prefix_text, [self.input_dir], self.output_dir, 'Copy', use_build_cache=True,
+                     prepare_item=prepare_item)
+        
+        self.assertEqual(Path(self.output_dir, '1045_Copy.tif').read_text(), 'untouched')
+        self.assertEqual(Path(self.output_dir, '1046_Copy.tif').read_text(), 'zb')
+    
+    def test_parameter_changes_invalidate_outputs(self):
+        output_path = Path(self.temp_dir.name, 'out.tif')
+        output_path.write_text('x')
+        inputs = [Path(self.input_dir, '1045_SHG.tif')]
+        
+        with blk.BuildCache(Path(self.temp_dir.name, 'cache.sqlite')) as cache:
+            cache.record(output_path, inputs, {'threshold': 1})
+            self.assertTrue(cache.is_current(output_path, inputs, {'threshold': 1}))
+            self.assertFalse(cache.is_current(output_path, inputs, {'threshold': 2}))
+            self.assertFalse(cache.is_current(output_path, inputs, {'threshold': 1}, code_version='0.0'))
+
+
+class DatasetCatalog_TestSuite(unittest.TestCase):
+    
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.dir_one = Path(self.temp_dir.name, 'one')
+        self.dir_two = Path(self.temp_dir.name, 'two')
+        for directory, names in [(self.dir_one, ['1045_SHG.tif', '1046_SHG.tif', '1047_SHG.txt']),
+                                 (self.dir_two, ['1046_PS.tif', '1045_PS.tif', '1045_PS_2.tif'])]:
+            directory.mkdir()
+            for name in names:
+                Path(directory, name).touch()
+    
+    def tearDown(self):
+        blk.clear_catalog_cache()
+        self.temp_dir.cleanup()
+    
+    def test_pairs_every_shared_core_name(self):
+        one, two = blk.find_shared_images(self.dir_one, self.dir_two)
+        pairs = sorted((path_one.name, path_two.name) for path_one, path_two in zip(one, two))
+        self.assertEqual(pairs, [('1045_SHG.tif', '1045_PS.tif'), ('1045_SHG.tif', '1045_PS_2.tif'),
+                                 ('1046_SHG.tif', '1046_PS.tif')])
+    
+    def test_cached_catalog_is_rescanned_after_changes(self):
+        catalog = blk.get_catalog(self.dir_one)
+        self.assertIs(blk.get_catalog(self.dir_one), catalog)
+        
+        Path(self.dir_one, '1048_SHG.tif').touch()
+        os.utime(str(self.dir_one), ns=(0, 0))
+        self.assertEqual(len(blk.get_catalog(self.dir_one)), 3)
+
     
 if __name__ == '__main__':
     unittest.main(verbosity=2)
@@ -113,4 +113,305 @@
 #         self.assertFalse(til.tile_passes_threshold(self.test_tile, 99, 90))
 #
 # if __name__ == '__main__':
-#     unittest.main()
\ No newline at end of file
+#     unittest.main()
+
+import pytest
+import numpy as np
+import pandas as pd
+import SimpleITK as sitk
+import tifffile
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+import multiscale.tiling as til
+
+
+class TestTileView(object):
+        def test_tiles_are_views_of_the_array(self):
+                array = np.arange(100).reshape([10, 10])
+                tiles = til.tile_view(array, np.array([4, 4]))
+                
+                assert tiles.shape == (2, 2, 4, 4)
+                assert np.shares_memory(tiles, array)
+                np.testing.assert_array_equal(tiles[1, 0], array[5:9, 1:5])
+        
+        def test_overlapping_tiles_respect_border(self):
+                array = np.arange(225).reshape([15, 15])
+                tiles = til.tile_view(array, np.array([5, 5]), np.array([2, 2]))
+                
+                assert tiles.shape == (4, 4, 5, 5)
+                np.testing.assert_array_equal(tiles[1, 2], array[5:10, 7:12])
+
+        
+        def test_tile_larger_than_image_has_no_tiles(self):
+                array = np.arange(100).reshape([10, 10])
+                
+                assert til.tile_view(array, np.array([12, 12])).shape == (0, 0, 12, 12)
+                assert til.tile_view(array, np.array([12, 12]), np.array([4, 4])).shape == (0, 0, 12, 12)
+                assert len(til.TileGrid(array, 12, 4)) == 0
+
+
+class TestTileGrid(object):
+        def test_threshold_matches_per_tile_check(self):
+                array = np.random.RandomState(0).randint(0, 256, [50, 70])
+                grid = til.TileGrid(array, np.array([8, 8]), np.array([6, 6]))
+                
+                passes = grid.passes_threshold(60, 40, input_max_value=255)
+                expected = [til.tile_passes_threshold(tile, 60, 40, input_max_value=255) for tile, number in grid]
+                
+                assert passes.shape == tuple(grid.number_of_tiles)
+                np.testing.assert_array_equal(passes.ravel(), expected)
+        
+        def test_iterates_like_start_end_indices(self):
+                array = np.arange(130 * 90).reshape([130, 90])
+                grid = til.TileGrid(array, 16)
+                starts = grid.start_indices()
+                
+                for tile, tile_number in grid:
+                        start = [starts[dim][tile_number[dim]] for dim in range(2)]
+                        np.testing.assert_array_equal(tile, array[start[0]:start[0] + 16, start[1]:start[1] + 16])
+                assert len(grid) == 8 * 5
+        
+        def test_keeps_color_channels_whole(self):
+                array = np.random.RandomState(5).randint(0, 256, [64, 64, 3]).astype(np.uint8)
+                
+                tiles = list(til.generate_tile(array, np.array([32, 32])))
+                grid = til.TileGrid(array, np.array([32, 32]))
+                passes = grid.passes_threshold(60, 40, input_max_value=255)
+                expected = [til.tile_passes_threshold(tile, 60, 40, input_max_value=255) for tile, number in tiles]
+                
+                assert len(tiles) == 4
+                np.testing.assert_array_equal(tiles[1][0], array[0:32, 32:64])
+                np.testing.assert_array_equal(passes.ravel(), expected)
+
+
+class TestRegionTiles(object):
+        def test_region_tiles_match_in_memory_tiles(self, tmpdir):
+                array = np.random.RandomState(1).randint(0, 4000, [70, 45]).astype(np.uint16)
+                path = str(tmpdir.join('mosaic.tif'))
+                sitk.WriteImage(sitk.GetImageFromArray(array), path)
+                
+                region_tiles = list(til.generate_region_tile(path, np.array([16, 16]), np.array([12, 12])))
+                memory_tiles = list(til.generate_tile(array, np.array([16, 16]), np.array([12, 12])))
+                
+                assert len(region_tiles) == len(memory_tiles)
+                for (region_tile, region_number), (memory_tile, memory_number) in zip(region_tiles, memory_tiles):
+                        np.testing.assert_array_equal(region_number, memory_number)
+                        np.testing.assert_array_equal(region_tile, memory_tile)
+        
+        def test_streaming_max(self, tmpdir):
+                array = np.zeros([50, 30], dtype=np.uint16)
+                array[47, 3] = 900
+                path = str(tmpdir.join('mosaic.tif'))
+                sitk.WriteImage(sitk.GetImageFromArray(array), path)
+                
+                assert til.streaming_image_max(path, strip_rows=8) == 900
+        
+        def test_uncompressed_tiff_is_never_decoded_in_full(self, tmpdir, monkeypatch):
+                array = np.random.RandomState(2).randint(0, 255, [64, 48]).astype(np.uint8)
+                path = str(tmpdir.join('mosaic.tif'))
+                sitk.WriteImage(sitk.GetImageFromArray(array), path)
+                
+                full_reads = []
+                monkeypatch.setattr(til.sitk, 'ReadImage', lambda *args: full_reads.append(args))
+                
+                regions = til.ImageRegions(path)
+                tiles = list(til.generate_region_tile(path, np.array([16, 16]), regions=regions))
+                
+                assert regions.access == 'memmap'
+                assert full_reads == []
+                np.testing.assert_array_equal(tiles[-1][0], array[48:64, 32:48])
+        
+        def test_compressed_tiff_is_read_by_strip(self, tmpdir, monkeypatch):
+                array = np.random.RandomState(3).randint(0, 255, [64, 48]).astype(np.uint8)
+                path = str(tmpdir.join('mosaic.tif'))
+                sitk.WriteImage(sitk.GetImageFromArray(array), path, True)
+                
+                full_reads = []
+                monkeypatch.setattr(til.sitk, 'ReadImage', lambda *args: full_reads.append(args))
+                
+                regions = til.ImageRegions(path)
+                max_value = til.streaming_image_max(path, strip_rows=8, regions=regions)
+                tiles = list(til.generate_region_tile(path, np.array([16, 16]), regions=regions))
+                
+                assert regions.access == 'segments'
+                assert full_reads == []
+                assert max_value == array.max()
+                np.testing.assert_array_equal(tiles[5][0], array[16:32, 32:48])
+        
+        def test_tiled_tiff_decodes_each_tile_once(self, tmpdir):
+                array = np.random.RandomState(4).randint(0, 255, [64, 48, 3]).astype(np.uint8)
+                path = str(tmpdir.join('mosaic.tif'))
+                tifffile.imwrite(path, array, compression='zlib', tile=(16, 16))
+                
+                regions = til.ImageRegions(path)
+                page_decode = regions._page.decode
+                decoded = []
+                
+                def counted_decode(data, index, **kwargs):
+                        decoded.append(index)
+                        return page_decode(data, index, **kwargs)
+                
+                regions._page.decode = counted_decode
+                tiles = list(til.generate_region_tile(path, np.array([16, 16]), regions=regions))
+                region = regions.read([10, 20], [30, 20])
+                
+                assert sorted(decoded[:12]) == list(range(12))
+                assert len(decoded) == 12 + 6
+                np.testing.assert_array_equal(tiles[-1][0], array[48:64, 32:48])
+                np.testing.assert_array_equal(region, array[10:40, 20:40])
+        
+        def test_other_files_are_read_in_full_with_a_warning(self, tmpdir):
+                array = np.arange(64 * 48, dtype=np.uint16).reshape([64, 48])
+                path = str(tmpdir.join('mosaic.mha'))
+                sitk.WriteImage(sitk.GetImageFromArray(array), path)
+                
+                with pytest.warns(UserWarning):
+                        regions = til.ImageRegions(path)
+                
+                assert regions.access == 'full'
+                np.testing.assert_array_equal(regions.read([8, 4], [4, 4]), array[8:12, 4:8])
+
+
+class TestTileStore(object):
+        def test_tiles_read_back_by_tile_number(self, tmpdir):
+                path = str(tmpdir.join('mosaic_tiles.h5'))
+                tiles = {(x, y): np.full([4, 4], 10 * x + y, dtype=np.uint8) for x in range(3) for y in range(2)}
+                
+                with til.TileStore(path, tile_shape=[4, 4]) as store:
+                        for (x, y), tile in tiles.items():
+                                store.write(tile, x, y)
+                
+                with til.TileStore(path, mode='r') as store:
+                        assert sorted(store.keys()) == sorted(tiles)
+                        assert (2, 1) in store
+                        np.testing.assert_array_equal(store.read(2, 1), tiles[(2, 1)])
+        
+        def test_extract_tiles_into_store(self, tmpdir):
+                array = np.zeros([32, 32], dtype=np.uint16)
+                array[16:, :16] = 1000
+                image_path = tmpdir.join('1045_SHG.tif')
+                sitk.WriteImage(sitk.GetImageFromArray(array), str(image_path))
+                
+                til.extract_image_tiles(Path(str(image_path)), str(tmpdir), 'Tile', tile_size=np.array([16, 16]),
+                                        intensity_threshold=10, number_threshold=50, use_tile_store=True)
+                
+                with til.TileStore(str(tmpdir.join('1045_Tile_IntThresh10-NumThresh50.h5')), mode='r') as store:
+                        assert store.keys() == [(1, 0)]
+                        assert store.read(1, 0).dtype == np.uint8
+
+
+class TestValuesToImage(object):
+        def test_roi_values_scatter_into_image(self):
+                index = pd.MultiIndex.from_tuples([
+                        ('1045', '1', '0x-1y', 'Full-tile'),
+                        ('1045', '1', '0x-1y', 'ROI2x3y'),
+                        ('1045', '1', '1x-0y', 'ROI0x1y'),
+                        ('1045', '1', '1x-0y', 'ROI1x1y')], names=['Mouse', 'Slide', 'Tile', 'ROI'])
+                series = pd.Series([5.0, 0.7, 0.2, -1.0], index=index)
+                
+                img = til.roi_values_to_sitk_image_array(series, [16, 16], 'SHG', rois_per_tile=4)
+                
+                expected = np.zeros([16, 16])
+                expected[4 + 3, 0 + 2] = 0.7
+                expected[0 + 1, 4 + 0] = 0.2
+                np.testing.assert_array_equal(img, expected)
+        
+        def test_tile_values_from_dataframe(self):
+                index = pd.MultiIndex.from_tuples([('1045', '1', '1x-2y'), ('1045', '1', '3x-1y')])
+                df = pd.DataFrame({'Alignment': [0.5, 0.25]}, index=index)
+                
+                img = til.tile_values_to_image(df, [3, 2], 'Alignment')
+                
+                assert img[0, 1] == 0.5
+                assert img[2, 0] == 0.25
+                assert np.count_nonzero(img) == 2
+
+
+def record_manifest_tiles(manifest_path, image_path):
+        with til.TileManifest(manifest_path) as manifest:
+                for intensity_threshold in range(20):
+                        manifest.record_tiles(image_path, [np.arange(4), np.arange(4)], [2, 2], None,
+                                              intensity_threshold, 50, np.ones([4, 4], dtype=bool))
+
+
+class TestTileManifest(object):
+        def test_records_every_tile_and_skips_unchanged_images(self, tmpdir):
+                array = np.zeros([32, 48], dtype=np.uint16)
+                array[:16, 16:32] = 1000
+                image_path = Path(str(tmpdir.join('1045_SHG.tif')))
+                sitk.WriteImage(sitk.GetImageFromArray(array), str(image_path))
+                
+                with til.TileManifest(str(tmpdir.join('tile_manifest.sqlite'))) as manifest:
+                        til.extract_image_tiles(image_path, str(tmpdir), 'Tile', tile_size=np.array([16, 16]),
+                                                intensity_threshold=10, number_threshold=50, manifest=manifest)
+                        
+                        tiles = manifest.tiles(source=image_path)
+                        assert len(tiles) == 6
+                        
+                        passed = manifest.tiles(passed=True)
+                        assert passed[['x', 'y', 'row_start', 'col_start', 'row_end', 'col_end']].values.tolist() == \
+                                [[0, 1, 0, 16, 16, 32]]
+                        assert Path(passed['tile_path'][0]).exists()
+                        
+                        assert manifest.is_current(image_path, np.array([16, 16]), None, 10, 50)
+                        assert not manifest.is_current(image_path, np.array([16, 16]), None, 20, 50)
+                        assert manifest.stale_sources([image_path], np.array([16, 16]), None, 10, 50) == []
+        
+        def test_concurrent_processes_share_the_manifest(self, tmpdir):
+                manifest_path = str(tmpdir.join('tile_manifest.sqlite'))
+                image_paths = []
+                for number in range(4):
+                        image_path = Path(str(tmpdir.join('{0}_SHG.tif'.format(number))))
+                        sitk.WriteImage(sitk.Image(8, 8, sitk.sitkUInt8), str(image_path))
+                        image_paths.append(image_path)
+                
+                with ProcessPoolExecutor(max_workers=4) as pool:
+                        list(pool.map(record_manifest_tiles, [manifest_path] * 4, image_paths))
+                
+                with til.TileManifest(manifest_path) as manifest:
+                        assert len(manifest.tiles()) == 4 * 20 * 16
+        
+        def test_tiled_images_are_never_dispatched(self, tmpdir, monkeypatch):
+                image_dir = tmpdir.mkdir('images')
+                for sample in ['1045', '1046']:
+                        sitk.WriteImage(sitk.Image(32, 32, sitk.sitkUInt8), str(image_dir.join(sample + '_SHG.tif')))
+                tile_dir = str(tmpdir.join('tiles'))
+                
+                def tile():
+                        til.bulk_extract_image_tiles(str(image_dir), tile_dir, 'Tile', tile_size=np.array([16, 16]),
+                                                     intensity_threshold=10, number_threshold=50, use_manifest=True)
+                
+                tile()
+                sitk.WriteImage(sitk.Image(48, 48, sitk.sitkUInt8), str(image_dir.join('1046_SHG.tif')))
+                
+                extract = til._extract_image_tiles_to_subdir
+                dispatched = []
+                
+                def counted_extract(image_path, *args, **kwargs):
+                        dispatched.append(image_path.name)
+                        return extract(image_path, *args, **kwargs)
+                
+                monkeypatch.setattr(til, '_extract_image_tiles_to_subdir', counted_extract)
+                tile()
+                
+                assert dispatched == ['1046_SHG.tif']
+        
+        def test_pairs_tiles_across_datasets(self, tmpdir):
+                tile_dirs = []
+                for modality, columns in [('SHG', slice(16, 48)), ('PS', slice(0, 32))]:
+                        array = np.zeros([32, 48], dtype=np.uint16)
+                        array[:16, columns] = 1000
+                        image_dir = tmpdir.mkdir(modality)
+                        sitk.WriteImage(sitk.GetImageFromArray(array), str(image_dir.join('1045_' + modality + '.tif')))
+                        
+                        tile_dir = str(tmpdir.join(modality + '_tiles'))
+                        til.bulk_extract_image_tiles(str(image_dir), tile_dir, 'Tile', tile_size=np.array([16, 16]),
+                                                     intensity_threshold=10, number_threshold=50, use_manifest=True)
+                        tile_dirs.append(tile_dir)
+                
+                shg_tiles, ps_tiles = til.find_shared_tiles(tile_dirs)
+                
+                assert [path.name for path in shg_tiles] == ['1045_Tile_IntThresh10-NumThresh50_0x-1y.tif']
+                assert [path.name for path in ps_tiles] == ['1045_Tile_IntThresh10-NumThresh50_0x-1y.tif']
+                assert shg_tiles[0].parent.name == '1045_SHG' and ps_tiles[0].parent.name == '1045_PS'
+                assert all(path.is_file() for path in shg_tiles + ps_tiles)
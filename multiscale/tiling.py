@@ -1,10 +1,17 @@
 import os
 
 import numpy as np
+import pandas as pd
 import SimpleITK as sitk
+import h5py
+import tifffile
 from pathlib import Path
 import itertools
+import queue
 import re
+import sqlite3
+import threading
+import warnings
 
 import multiscale.utility_functions as util
 import multiscale.bulk_img_processing as blk
@@ -46,15 +53,8 @@ def generate_tile_start_end_index(total_num_tiles, tile_size,
 
 
 def generate_tile(input_array, tile_size, tile_separation=None):
-        image_dimens = np.shape(input_array)
-        
-        total_num_tiles, tile_offset = calculate_number_of_tiles(
-                image_dimens, tile_size, tile_separation=tile_separation)
-        
-        for start, end, tile_number in generate_tile_start_end_index(
-                    total_num_tiles, tile_size,
-                    tile_offset=tile_offset, tile_separation=tile_separation):
-                yield input_array[start[0]:end[0], start[1]:end[1]], tile_number
+        for tile, tile_number in TileGrid(input_array, tile_size, tile_separation=tile_separation):
+                yield tile, tile_number
 
 
 def calculate_number_of_tiles(size_of_image_dimension, tile_size,
@@ -76,7 +76,8 @@ def calculate_number_of_tiles(size_of_image_dimension, tile_size,
         for i in range(np.size(tile_size)):
                 idx_range = size_of_image_dimension[i] - 2 * border[i]
                 
-                num_tiles = np.fix(idx_range / tile_separation[i])
+                # A tile larger than the image leaves a negative range, which holds no tiles
+                num_tiles = max(np.fix(idx_range / tile_separation[i]), 0)
                 number_of_tiles.append(int(num_tiles))
                 
                 remainder = np.remainder(idx_range, tile_separation[i])
@@ -85,6 +86,310 @@ def calculate_number_of_tiles(size_of_image_dimension, tile_size,
         return number_of_tiles, offset
 
 
+def tile_start_indices(image_shape, tile_size, tile_separation=None):
+        """
+        Calculate the starting index of every tile along each dimension of an image
+
+        :param image_shape: Shape of the image being tiled
+        :param tile_size: Size in pixels of the tile
+        :param tile_separation: Distance between the starts of neighboring tiles, defaults to the tile size
+        :return: List with a 1D array of tile start indices for each dimension
+        """
+        tile_size = np.atleast_1d(np.asarray(tile_size, dtype=int))
+
+        if tile_separation is None:
+                tile_separation = tile_size
+        tile_separation = np.atleast_1d(np.asarray(tile_separation, dtype=int))
+
+        number_of_tiles, offset = calculate_number_of_tiles(image_shape, tile_size, tile_separation)
+
+        return [offset[dim] + np.arange(number_of_tiles[dim]) * tile_separation[dim]
+                for dim in range(np.size(tile_size))]
+
+
+def tile_view(input_array, tile_size, tile_separation=None):
+        """
+        View an array as a grid of tiles without copying, following the offset and border rules of
+        calculate_number_of_tiles.  Tiles are taken along the last len(tile_size) axes of the array.
+
+        :param input_array: numpy array to tile
+        :param tile_size: Size in pixels of the tile
+        :param tile_separation: Distance between the starts of neighboring tiles, defaults to the tile size
+        :return: read-only view with shape (leading axes, number of tiles in each dim, tile size in each dim)
+        """
+        input_array = np.asarray(input_array)
+        tile_size = np.atleast_1d(np.asarray(tile_size, dtype=int))
+
+        if tile_separation is None:
+                tile_separation = tile_size
+        tile_separation = np.atleast_1d(np.asarray(tile_separation, dtype=int))
+
+        tile_dims = np.size(tile_size)
+        image_shape = input_array.shape[-tile_dims:]
+
+        number_of_tiles, offset = calculate_number_of_tiles(image_shape, tile_size, tile_separation)
+
+        first_tile = input_array[(Ellipsis,) + tuple(slice(start, None) for start in offset)]
+
+        leading_strides = first_tile.strides[:-tile_dims]
+        pixel_strides = first_tile.strides[-tile_dims:]
+        tile_strides = tuple(stride * separation for stride, separation in zip(pixel_strides, tile_separation))
+
+        shape = first_tile.shape[:-tile_dims] + tuple(number_of_tiles) + tuple(tile_size)
+        strides = leading_strides + tile_strides + pixel_strides
+
+        return np.lib.stride_tricks.as_strided(first_tile, shape=shape, strides=strides, writeable=False)
+
+
+class TileGrid(object):
+        """
+        All tiles of an image as a single zero-copy view, following the offset and border rules of
+        calculate_number_of_tiles
+        """
+        def __init__(self, input_array, tile_size, tile_separation=None):
+                """
+                :param input_array: numpy array to tile
+                :param tile_size: Size in pixels of the tile, either one value for every dimension or one per leading
+                dimension, with any trailing dimensions, e.g. color channels, kept whole in each tile
+                :param tile_separation: Distance between the starts of neighboring tiles, defaults to the tile size
+                """
+                self.input_array = np.asarray(input_array)
+                
+                tile_size = np.asarray(tile_size, dtype=int)
+                tile_dims = self.input_array.ndim if tile_size.ndim == 0 else tile_size.size
+                
+                self.tile_size = np.broadcast_to(tile_size, (tile_dims,)).copy()
+                if tile_separation is None:
+                        tile_separation = self.tile_size
+                self.tile_separation = np.broadcast_to(np.asarray(tile_separation, dtype=int), (tile_dims,)).copy()
+                
+                self.number_of_tiles, self.offset = calculate_number_of_tiles(
+                        self.input_array.shape[:tile_dims], self.tile_size, self.tile_separation)
+                self.tiles = self._tile_view(self.input_array)
+        
+        def _tile_view(self, array):
+                """View an array with the image's shape as tiles, keeping the trailing dimensions last in each tile"""
+                tile_dims = self.tile_size.size
+                trailing_dims = array.ndim - tile_dims
+                
+                trailing_first = np.moveaxis(array, list(range(tile_dims, array.ndim)), list(range(trailing_dims)))
+                tiles = tile_view(trailing_first, self.tile_size, self.tile_separation)
+                
+                return np.moveaxis(tiles, list(range(trailing_dims)),
+                                   list(range(tiles.ndim - trailing_dims, tiles.ndim)))
+        
+        def __len__(self):
+                return int(np.prod(self.number_of_tiles))
+        
+        def __getitem__(self, tile_number):
+                return self.tiles[tuple(tile_number)]
+        
+        def __iter__(self):
+                for tile_number in np.ndindex(*self.number_of_tiles):
+                        yield self.tiles[tile_number], np.array(tile_number)
+        
+        def start_indices(self):
+                """Starting index of every tile along each dimension"""
+                return [self.offset[dim] + np.arange(self.number_of_tiles[dim]) * self.tile_separation[dim]
+                        for dim in range(self.tile_size.size)]
+        
+        def passes_threshold(self, intensity_threshold, number_threshold, input_max_value=255):
+                """
+                Evaluate tile_passes_threshold for every tile at once
+                
+                :param intensity_threshold: The percentage of the max value above which pixels are considered signal
+                :param number_threshold: Percentage of pixels above the intensity threshold needed to pass
+                :param input_max_value: The max value of the image
+                :return: Boolean array with one entry per tile
+                """
+                perc_int = input_max_value * 0.01 * intensity_threshold
+                
+                # Threshold the image once and view the mask as tiles, rather than copying the overlapping tiles
+                signal = self._tile_view(~(self.input_array <= perc_int))
+                
+                pixel_axes = tuple(range(self.tile_size.size, signal.ndim))
+                perc_num = np.prod(signal.shape[self.tile_size.size:]) * 0.01 * number_threshold
+                num_values = np.count_nonzero(signal, axis=pixel_axes)
+                
+                return num_values >= perc_num
+        
+        def passing_tiles(self, intensity_threshold, number_threshold, input_max_value=255):
+                """Yield the tiles and tile numbers that pass the intensity/number threshold"""
+                passes = self.passes_threshold(intensity_threshold, number_threshold, input_max_value)
+                for tile_number in np.argwhere(passes):
+                        yield self.tiles[tuple(tile_number)], tile_number
+
+
+class ImageRegions(object):
+        """
+        The pixels of an image file, set up for reading one region at a time without decoding the whole file.
+        Uncompressed TIFFs are memory mapped, so a region read only touches its own rows on disk.  Compressed or
+        tiled TIFFs are read one strip or tile at a time, decoding only the segments that overlap the region and
+        keeping the last region's segments for the next read.  Other files are read in full, once.
+        """
+        def __init__(self, image_path):
+                """
+                :param image_path: Path to the image file
+                """
+                self.image_path = Path(image_path)
+                self._tiff = None
+                self._segments = {}
+                
+                try:
+                        self.array = tifffile.memmap(str(image_path), mode='r')
+                        self.access = 'memmap'
+                        self.shape = self.array.shape
+                        return
+                except (ValueError, tifffile.TiffFileError):
+                        pass
+                
+                try:
+                        self._tiff = tifffile.TiffFile(str(image_path))
+                except tifffile.TiffFileError:
+                        pass
+                else:
+                        page = self._tiff.pages[0]
+                        if page.shaped[:2] == (1, 1):
+                                self._page = page
+                                self.access = 'segments'
+                                self.shape = page.shape
+                                return
+                        self.close()
+                
+                warnings.warn('{0} cannot be read by region, so it is read in full'.format(self.image_path.name))
+                self.array = sitk.GetArrayFromImage(sitk.ReadImage(str(image_path)))
+                self.access = 'full'
+                self.shape = self.array.shape
+        
+        def __enter__(self):
+                return self
+        
+        def __exit__(self, exc_type, exc_value, traceback):
+                self.close()
+        
+        def close(self):
+                if self._tiff is not None:
+                        self._tiff.close()
+                        self._tiff = None
+        
+        def read(self, start_index, size):
+                """
+                Read one region into memory
+                
+                :param start_index: Starting index of the region, in numpy (row, column) order
+                :param size: Size of the region, in numpy (row, column) order
+                :return: numpy array of the region
+                """
+                region = tuple(slice(int(start), int(start) + int(length)) for start, length in zip(start_index, size))
+                if self.access != 'segments':
+                        return np.array(self.array[region])
+                
+                rows, columns = [range(*dim_slice.indices(dim_size))
+                                 for dim_slice, dim_size in zip(region[:2], self.shape[:2])]
+                output = np.zeros([len(rows), len(columns)] + list(self._page.shaped[4:]), dtype=self._page.dtype)
+                
+                chunk_rows, chunk_columns = self._page.chunks[:2]
+                chunks_per_row = -(-self.shape[1] // chunk_columns)
+                segments = {}
+                for chunk_row in range(rows.start // chunk_rows, -(-rows.stop // chunk_rows)):
+                        for chunk_column in range(columns.start // chunk_columns, -(-columns.stop // chunk_columns)):
+                                index = chunk_row * chunks_per_row + chunk_column
+                                segment, (row, column) = segments[index] = self._read_segment(index)
+                                
+                                # Copy the overlap of the segment and the region
+                                top, left = max(row, rows.start), max(column, columns.start)
+                                bottom = min(row + segment.shape[0], rows.stop)
+                                right = min(column + segment.shape[1], columns.stop)
+                                output[top - rows.start:bottom - rows.start,
+                                       left - columns.start:right - columns.start] = \
+                                        segment[top - row:bottom - row, left - column:right - column]
+                
+                # Neighboring tiles usually share strips, so keep this region's segments for the next read
+                self._segments = segments
+                
+                return output.reshape(output.shape[:2] + self.shape[2:])[(Ellipsis,) + region[2:len(self.shape)]]
+        
+        def _read_segment(self, index):
+                """Decode one strip or tile of the TIFF, returning it with the index of its top left pixel"""
+                if index in self._segments:
+                        return self._segments[index]
+                
+                page = self._page
+                data = None
+                if page.databytecounts[index]:
+                        file_handle = self._tiff.filehandle
+                        with file_handle.lock:
+                                file_handle.seek(page.dataoffsets[index])
+                                data = file_handle.read(page.databytecounts[index])
+                
+                segment, indices, shape = page.decode(data, index, jpegtables=page.jpegtables)
+                if segment is None:
+                        # Segments missing from sparse files hold the fill value
+                        return np.full(shape[1:], page.nodata, dtype=page.dtype), indices[2:4]
+                
+                return segment.reshape(shape[1:]), indices[2:4]
+
+
+def read_image_region(image_path, start_index, size, regions=None):
+        """
+        Read only one region of an image file
+        
+        :param image_path: Path to the image file
+        :param start_index: Starting index of the region, in numpy (row, column) order
+        :param size: Size of the region, in numpy (row, column) order
+        :param regions: An existing ImageRegions for the file, to skip opening it again
+        :return: numpy array of the region
+        """
+        if regions is None:
+                regions = ImageRegions(image_path)
+        
+        return regions.read(start_index, size)
+
+
+def streaming_image_max(image_path, strip_rows=1024, regions=None):
+        """
+        Find the max value of an image file by reading it in horizontal strips, never holding the whole image
+        
+        :param image_path: Path to the image file
+        :param strip_rows: Number of rows to read at once
+        :param regions: An existing ImageRegions for the file, to skip opening it again
+        :return: The max value of the image
+        """
+        if regions is None:
+                regions = ImageRegions(image_path)
+        shape = regions.shape
+        
+        max_value = None
+        for row in range(0, shape[0], strip_rows):
+                rows = min(strip_rows, shape[0] - row)
+                strip_max = np.max(regions.read([row, 0], [rows, shape[1]]))
+                if max_value is None or strip_max > max_value:
+                        max_value = strip_max
+        
+        return max_value
+
+
+def generate_region_tile(image_path, tile_size, tile_separation=None, regions=None):
+        """
+        Yield the tiles of an image file one region read at a time, following the same layout as generate_tile
+        
+        :param image_path: Path to the image file
+        :param tile_size: Size in pixels of the tile
+        :param tile_separation: Distance between the starts of neighboring tiles, defaults to the tile size
+        :param regions: An existing ImageRegions for the file, to skip opening it again
+        :return: Generator of tile arrays and tile numbers
+        """
+        if regions is None:
+                regions = ImageRegions(image_path)
+        
+        tile_size = np.asarray(tile_size, dtype=int)
+        starts = tile_start_indices(regions.shape[:np.size(tile_size)], tile_size, tile_separation)
+        
+        for tile_number in np.ndindex(*[len(dim_starts) for dim_starts in starts]):
+                start = [starts[dim][tile_number[dim]] for dim in range(len(starts))]
+                yield regions.read(start, tile_size), np.array(tile_number)
+
+
 def tile_passes_threshold(tile, intensity_threshold, number_threshold,
                           input_max_value=255):
         """Given a np array, check if it has enough entries larger than a value"""
@@ -101,6 +406,293 @@ def tile_passes_threshold(tile, intensity_threshold, number_threshold,
                 return False
 
 
+class TileStore(object):
+        """
+        One chunked HDF5 container holding the tiles of a source image, indexed by tile (x, y) number.
+        Writes are queued and appended by a single background writer thread.
+        """
+        def __init__(self, store_path, tile_shape=None, dtype=np.uint8, mode='a', queue_size=64):
+                """
+                :param store_path: Path to the .h5 tile store
+                :param tile_shape: Shape of every tile, required when creating a new store
+                :param dtype: Data type of the stored tiles
+                :param mode: h5py file mode.  'r' opens the store read-only without a writer thread
+                :param queue_size: Maximum number of tiles waiting to be written
+                """
+                self.store_path = Path(store_path)
+                self._file = h5py.File(str(self.store_path), mode)
+                
+                if 'tiles' not in self._file:
+                        if tile_shape is None:
+                                raise ValueError('A tile shape is needed to create the tile store {0}'.format(
+                                        self.store_path))
+                        tile_shape = tuple(int(length) for length in tile_shape)
+                        self._file.create_dataset('tiles', shape=(0,) + tile_shape, maxshape=(None,) + tile_shape,
+                                                  chunks=(1,) + tile_shape, dtype=dtype, compression='gzip')
+                        self._file.create_dataset('index', shape=(0, 2), maxshape=(None, 2), dtype=np.int64)
+                
+                self._tiles = self._file['tiles']
+                self._index_data = self._file['index']
+                self._index = {(int(x), int(y)): row for row, (x, y) in enumerate(self._index_data[:])}
+                
+                self._error = None
+                self._queue = None
+                self._writer = None
+                if mode != 'r':
+                        self._queue = queue.Queue(maxsize=queue_size)
+                        self._writer = threading.Thread(target=self._write_queued_tiles, daemon=True)
+                        self._writer.start()
+        
+        def __enter__(self):
+                return self
+        
+        def __exit__(self, exc_type, exc_value, traceback):
+                self.close()
+        
+        def __contains__(self, tile_number):
+                return (int(tile_number[0]), int(tile_number[1])) in self._index
+        
+        def __len__(self):
+                return len(self._index)
+        
+        def keys(self):
+                """The (x, y) tile numbers held in the store"""
+                return list(self._index)
+        
+        def _write_queued_tiles(self):
+                while True:
+                        item = self._queue.get()
+                        try:
+                                if item is None:
+                                        return
+                                if self._error is None:
+                                        self._append(*item)
+                        except Exception as error:
+                                self._error = error
+                        finally:
+                                self._queue.task_done()
+        
+        def _append(self, tile, x, y):
+                if (x, y) in self._index:
+                        self._tiles[self._index[(x, y)]] = tile
+                        return
+                
+                row = self._tiles.shape[0]
+                self._tiles.resize(row + 1, axis=0)
+                self._index_data.resize(row + 1, axis=0)
+                self._tiles[row] = tile
+                self._index_data[row] = [x, y]
+                self._index[(x, y)] = row
+        
+        def write(self, tile, x, y):
+                """Queue a tile to be written at tile number (x, y)"""
+                if self._queue is None:
+                        raise IOError('{0} was opened read-only'.format(self.store_path))
+                self._raise_writer_error()
+                self._queue.put((np.array(tile), int(x), int(y)))
+        
+        def read(self, x, y):
+                """Read the tile at tile number (x, y)"""
+                self.flush()
+                return self._tiles[self._index[(int(x), int(y))]]
+        
+        def flush(self):
+                """Wait until every queued tile has been written"""
+                if self._queue is not None:
+                        self._queue.join()
+                        self._raise_writer_error()
+                        self._file.flush()
+        
+        def _raise_writer_error(self):
+                if self._error is not None:
+                        raise self._error
+        
+        def close(self):
+                """Write any queued tiles, stop the writer thread, and close the store"""
+                try:
+                        if self._writer is not None:
+                                self._queue.put(None)
+                                self._writer.join()
+                                self._writer = None
+                                self._raise_writer_error()
+                finally:
+                        self._queue = None
+                        self._file.close()
+
+
+class TileManifest(object):
+        """
+        SQLite index of every tile considered while tiling a dataset.  Each tile is recorded with its source
+        image, grid coordinates, pixel bounds, threshold parameters, and whether it passed the threshold.
+        """
+        _tile_columns = ['source', 'x', 'y', 'row_start', 'col_start', 'row_end', 'col_end',
+                         'tile_size', 'tile_separation', 'intensity_threshold', 'number_threshold',
+                         'passed', 'tile_path']
+        
+        def __init__(self, manifest_path, timeout=60):
+                """
+                :param manifest_path: Path to the .sqlite manifest, created if it does not exist
+                :param timeout: Seconds to wait for another process's write to finish before giving up
+                """
+                self.manifest_path = Path(manifest_path)
+                
+                # Worker processes tiling different images share the manifest, so wait on each other's writes.  The
+                # default rollback journal is kept, as write-ahead logging does not work on network filesystems
+                self._connection = sqlite3.connect(str(self.manifest_path), timeout=timeout)
+                self._connection.executescript(
+                        """
+                        CREATE TABLE IF NOT EXISTS sources (
+                                source TEXT, settings TEXT, size INTEGER, mtime REAL,
+                                PRIMARY KEY (source, settings));
+                        CREATE TABLE IF NOT EXISTS tiles (
+                                source TEXT, x INTEGER, y INTEGER,
+                                row_start INTEGER, col_start INTEGER, row_end INTEGER, col_end INTEGER,
+                                tile_size TEXT, tile_separation TEXT,
+                                intensity_threshold REAL, number_threshold REAL,
+                                passed INTEGER, tile_path TEXT,
+                                PRIMARY KEY (source, x, y, tile_size, tile_separation,
+                                             intensity_threshold, number_threshold));
+                        """)
+        
+        def __enter__(self):
+                return self
+        
+        def __exit__(self, exc_type, exc_value, traceback):
+                self.close()
+        
+        def close(self):
+                self._connection.close()
+        
+        @staticmethod
+        def _size_string(size):
+                return 'x'.join(str(int(length)) for length in np.atleast_1d(size))
+        
+        @classmethod
+        def _settings(cls, tile_size, tile_separation, intensity_threshold, number_threshold):
+                if tile_separation is None:
+                        tile_separation = tile_size
+                return '{0}_{1}_{2}_{3}'.format(cls._size_string(tile_size), cls._size_string(tile_separation),
+                                                intensity_threshold, number_threshold)
+        
+        def is_current(self, image_path, tile_size, tile_separation, intensity_threshold, number_threshold):
+                """Whether the image was tiled with these settings and has not changed on disk since"""
+                stat = os.stat(str(image_path))
+                settings = self._settings(tile_size, tile_separation, intensity_threshold, number_threshold)
+                row = self._connection.execute(
+                        'SELECT size, mtime FROM sources WHERE source = ? AND settings = ?',
+                        (str(image_path), settings)).fetchone()
+                
+                return row is not None and row[0] == stat.st_size and row[1] == stat.st_mtime
+        
+        def stale_sources(self, image_paths, tile_size, tile_separation, intensity_threshold, number_threshold):
+                """The images that are new or have changed since they were last tiled with these settings"""
+                return [path for path in image_paths
+                        if not self.is_current(path, tile_size, tile_separation,
+                                               intensity_threshold, number_threshold)]
+        
+        def record_tiles(self, image_path, tile_starts, tile_size, tile_separation,
+                         intensity_threshold, number_threshold, passes, tile_paths=None):
+                """
+                Record every tile of a source image, replacing anything recorded for it with the same settings
+                
+                :param image_path: Path to the source image
+                :param tile_starts: Starting index of every tile along each dimension, as from tile_start_indices
+                :param tile_size: Size in pixels of the tile
+                :param tile_separation: Distance between the starts of neighboring tiles
+                :param intensity_threshold: The intensity threshold used for the tiles
+                :param number_threshold: The number threshold used for the tiles
+                :param passes: Boolean array with one entry per tile, whether it passed the threshold
+                :param tile_paths: Dictionary of (x, y): path where each passing tile was written
+                :return:
+                """
+                if tile_separation is None:
+                        tile_separation = tile_size
+                if tile_paths is None:
+                        tile_paths = {}
+                
+                tile_size = np.asarray(tile_size, dtype=int)
+                size_string = self._size_string(tile_size)
+                separation_string = self._size_string(tile_separation)
+                
+                rows = []
+                for x, y in np.ndindex(*np.shape(passes)):
+                        row_start, col_start = int(tile_starts[0][x]), int(tile_starts[1][y])
+                        path = tile_paths.get((x, y))
+                        rows.append((str(image_path), x, y, row_start, col_start,
+                                     row_start + int(tile_size[0]), col_start + int(tile_size[1]),
+                                     size_string, separation_string, intensity_threshold, number_threshold,
+                                     int(passes[x, y]), None if path is None else str(path)))
+                
+                stat = os.stat(str(image_path))
+                settings = self._settings(tile_size, tile_separation, intensity_threshold, number_threshold)
+                with self._connection:
+                        self._connection.execute(
+                                'DELETE FROM tiles WHERE source = ? AND tile_size = ? AND tile_separation = ? '
+                                'AND intensity_threshold = ? AND number_threshold = ?',
+                                (str(image_path), size_string, separation_string,
+                                 intensity_threshold, number_threshold))
+                        self._connection.executemany(
+                                'INSERT INTO tiles VALUES ({0})'.format(', '.join('?' * len(self._tile_columns))),
+                                rows)
+                        self._connection.execute('INSERT OR REPLACE INTO sources VALUES (?, ?, ?, ?)',
+                                                 (str(image_path), settings, stat.st_size, stat.st_mtime))
+        
+        def tiles(self, source=None, passed=None):
+                """
+                Query the recorded tiles
+                
+                :param source: Only return tiles from this source image
+                :param passed: Only return tiles that passed (True) or failed (False) the threshold
+                :return: Dataframe with one row per tile
+                """
+                conditions = []
+                parameters = []
+                if source is not None:
+                        conditions.append('source = ?')
+                        parameters.append(str(source))
+                if passed is not None:
+                        conditions.append('passed = ?')
+                        parameters.append(int(passed))
+                
+                query = 'SELECT * FROM tiles'
+                if conditions:
+                        query += ' WHERE ' + ' AND '.join(conditions)
+                
+                df = pd.read_sql_query(query + ' ORDER BY source, x, y', self._connection, params=parameters)
+                df['passed'] = df['passed'].astype(bool)
+                return df
+
+
+def tile_manifest_path(tile_dir):
+        """Path of the tile manifest that bulk_extract_image_tiles keeps for a directory of tiles"""
+        return Path(tile_dir, 'tile_manifest.sqlite')
+
+
+def find_shared_tiles(tile_dirs):
+        """
+        Pair the written tiles of the same sample and grid position across several tiled datasets, by querying
+        each dataset's tile manifest instead of listing and parsing the tile files
+        
+        :param tile_dirs: Directories tiled by bulk_extract_image_tiles with use_manifest=True
+        :return: A list of tile path lists, one per directory, in corresponding order
+        """
+        tables = []
+        for tile_dir in tile_dirs:
+                with TileManifest(tile_manifest_path(tile_dir)) as manifest:
+                        tiles = manifest.tiles(passed=True)
+                
+                tiles = tiles[tiles['tile_path'].notnull()]
+                tiles.index = pd.MultiIndex.from_arrays(
+                        [tiles['source'].map(blk.get_core_file_name), tiles['x'], tiles['y']])
+                tables.append(tiles[~tiles.index.duplicated()])
+        
+        shared = tables[0].index
+        for tiles in tables[1:]:
+                shared = shared[shared.isin(tiles.index)]
+        
+        return [[Path(tile_path) for tile_path in tiles.loc[shared, 'tile_path']] for tiles in tables]
+
+
 def query_tile_size_and_separation(diff_separation=False):
         message_tile_size = 'How many pixels should the tile width/height be? >>>'
         tile_size = util.query_int(message_tile_size)
@@ -124,13 +716,27 @@ def query_tile_thresholds():
         return intensity_threshold, number_threshold
 
 
+def tile_image_path(image_path, output_dir, output_suffix, x, y):
+        """Path of the tiff file for tile (x, y) of an image"""
+        tile_suffix = output_suffix + '_' + str(x) + 'x-' + str(y) + 'y'
+        return blk.create_new_image_path(image_path, output_dir, tile_suffix)
+
+
 def write_tile(tile, image_path, output_dir, output_suffix, x, y,
-               skip_existing_images=True, convert_to_8bit=True):
+               skip_existing_images=True, convert_to_8bit=True, tile_store: TileStore=None):
         tile_image = sitk.GetImageFromArray(tile)
         
-        tile_suffix = output_suffix + '_' + str(x) + 'x-' + str(y) + 'y'
-        tile_path = blk.create_new_image_path(image_path, output_dir,
-                                              tile_suffix)
+        if tile_store is not None:
+                if (x, y) in tile_store and skip_existing_images:
+                        return
+                
+                if convert_to_8bit:
+                        tile_image = sitk.Cast(sitk.RescaleIntensity(tile_image), sitk.sitkUInt8)
+                
+                tile_store.write(sitk.GetArrayFromImage(tile_image), x, y)
+                return
+        
+        tile_path = tile_image_path(image_path, output_dir, output_suffix, x, y)
         
         if tile_path.exists() and skip_existing_images:
                 return
@@ -147,33 +753,110 @@ def extract_image_tiles(image_path, output_dir, output_suffix,
                         tile_size=None, tile_separation=None,
                         intensity_threshold=None,
                         number_threshold=None,
-                        skip_existing_images=True):
-        print('Extracting tiles from {0}'.format(image_path.name))
-        
-        if not tile_size:
+                        skip_existing_images=True, read_regions=False, use_tile_store=False,
+                        manifest: TileManifest=None):
+        """
+        Write out the tiles of an image that pass the intensity/number threshold
+        
+        :param image_path: Path to the image being tiled
+        :param output_dir: Directory to write the tiles to
+        :param output_suffix: Base name of the tiles, followed by the thresholds and tile number
+        :param diff_separation: Whether to query for a tile separation different from the tile size
+        :param tile_size: Size in pixels of the tile
+        :param tile_separation: Distance between the starts of neighboring tiles
+        :param intensity_threshold: The percentage of the max value above which pixels are considered signal
+        :param number_threshold: Percentage of pixels above the intensity threshold needed to write the tile
+        :param skip_existing_images: Whether to skip tiles that have already been written
+        :param read_regions: Read the image one tile region at a time, for images too large to hold in memory
+        :param use_tile_store: Write the tiles into one HDF5 tile store per image instead of separate tiff files
+        :param manifest: Tile manifest to record every tile in, and to check for images that are already tiled
+        """
+        if tile_size is None:
                 tile_size, tile_separation = query_tile_size_and_separation(diff_separation)
         
         if not intensity_threshold or not number_threshold:
                 intensity_threshold, number_threshold = query_tile_thresholds()
         
+        if manifest is not None and skip_existing_images and manifest.is_current(
+                    image_path, tile_size, tile_separation, intensity_threshold, number_threshold):
+                return
+        
+        print('Extracting tiles from {0}'.format(image_path.name))
+        
         output_suffix_with_thresholds = (output_suffix +
                                          '_IntThresh{0}-NumThresh{1}'.format(
                                                  intensity_threshold,
                                                  number_threshold))
         
-        input_image = sitk.ReadImage(str(image_path))
-        input_array = sitk.GetArrayFromImage(input_image)
-        input_max_value = np.max(input_array)
-        
-        for tile, tile_number in generate_tile(input_array, tile_size,
-                                               tile_separation=tile_separation):
-                if tile_passes_threshold(tile,
-                                         intensity_threshold, number_threshold,
-                                         input_max_value=input_max_value):
+        if read_regions:
+                regions = ImageRegions(image_path)
+                input_max_value = streaming_image_max(image_path, regions=regions)
+                image_shape = regions.shape
+                tiles = (
+                        (tile, tile_number, tile_passes_threshold(tile, intensity_threshold, number_threshold,
+                                                                  input_max_value=input_max_value))
+                        for tile, tile_number in
+                        generate_region_tile(image_path, tile_size, tile_separation=tile_separation,
+                                             regions=regions))
+        else:
+                input_image = sitk.ReadImage(str(image_path))
+                input_array = sitk.GetArrayFromImage(input_image)
+                input_max_value = np.max(input_array)
+                image_shape = input_array.shape
+                
+                grid = TileGrid(input_array, tile_size, tile_separation=tile_separation)
+                grid_passes = grid.passes_threshold(intensity_threshold, number_threshold,
+                                                    input_max_value=input_max_value)
+                tiles = ((grid[tile_number], np.array(tile_number), grid_passes[tile_number])
+                         for tile_number in np.ndindex(*grid.number_of_tiles))
+        
+        tile_store = None
+        if use_tile_store:
+                store_path = blk.create_new_image_path(image_path, output_dir, output_suffix_with_thresholds,
+                                                       extension='.h5')
+                tile_store = TileStore(store_path, tile_shape=tile_size)
+        
+        tile_starts = tile_start_indices(image_shape, tile_size, tile_separation)
+        passes = np.zeros([len(dim_starts) for dim_starts in tile_starts], dtype=bool)
+        tile_paths = {}
+        
+        try:
+                for tile, tile_number, passed in tiles:
+                        if not passed:
+                                continue
+                        
+                        x, y = int(tile_number[0]), int(tile_number[1])
+                        passes[x, y] = True
                         write_tile(tile, image_path, output_dir,
                                    output_suffix_with_thresholds,
-                                   tile_number[0], tile_number[1],
-                                   skip_existing_images=skip_existing_images)
+                                   x, y,
+                                   skip_existing_images=skip_existing_images, tile_store=tile_store)
+                        
+                        if tile_store is not None:
+                                tile_paths[(x, y)] = tile_store.store_path
+                        else:
+                                tile_paths[(x, y)] = tile_image_path(image_path, output_dir,
+                                                                     output_suffix_with_thresholds, x, y)
+        finally:
+                if tile_store is not None:
+                        tile_store.close()
+        
+        if manifest is not None:
+                manifest.record_tiles(image_path, tile_starts, tile_size, tile_separation,
+                                      intensity_threshold, number_threshold, passes, tile_paths)
+
+
+def _extract_image_tiles_to_subdir(image_path, output_dir, output_suffix, manifest_path=None, **kwargs):
+        """Extract the tiles of one image into its own output subdirectory"""
+        output_dir_sub = os.path.join(output_dir, image_path.stem)
+        os.makedirs(output_dir_sub, exist_ok=True)
+        
+        if manifest_path is None:
+                extract_image_tiles(image_path, output_dir_sub, output_suffix, **kwargs)
+                return
+        
+        with TileManifest(manifest_path) as manifest:
+                extract_image_tiles(image_path, output_dir_sub, output_suffix, manifest=manifest, **kwargs)
 
 
 def bulk_extract_image_tiles(input_dir, output_dir, output_suffix,
@@ -182,28 +865,43 @@ def bulk_extract_image_tiles(input_dir, output_dir, output_suffix,
                              tile_size=None, tile_separation=None,
                              intensity_threshold=None,
                              number_threshold=None,
-                             skip_existing_images=True):
-        if not tile_size:
+                             skip_existing_images=True, read_regions=False, use_tile_store=False,
+                             use_manifest=False, num_workers=1):
+        """
+        Extract tiles from every image in a directory, each into its own output subdirectory
+        
+        :param use_manifest: Record every tile in output_dir/tile_manifest.sqlite, and only re-tile images that
+        are new or have changed since they were last tiled with the same settings
+        :param num_workers: Number of images tiled at once
+        """
+        if tile_size is None:
                 tile_size, tile_separation = query_tile_size_and_separation(diff_separation)
-        if not tile_separation:
+        if tile_separation is None:
                 tile_separation = tile_size
         if not intensity_threshold or not number_threshold:
                 intensity_threshold, number_threshold = query_tile_thresholds()
         
-        if search_subdirs:
-                image_path_list = util.list_filetype_in_subdirs(input_dir, '.tif')
-        else:
-                image_path_list = util.list_filetype_in_dir(input_dir, '.tif')
-        
-        for path in image_path_list:
-                output_dir_sub = os.path.join(output_dir, path.stem)
-                os.makedirs(output_dir_sub, exist_ok=True)
+        manifest_path = None
+        items = None
+        if use_manifest:
+                os.makedirs(output_dir, exist_ok=True)
+                manifest_path = tile_manifest_path(output_dir)
                 
-                extract_image_tiles(path, output_dir_sub,
-                                    output_suffix,
-                                    diff_separation, tile_size, tile_separation,
-                                    intensity_threshold, number_threshold,
-                                    skip_existing_images=skip_existing_images)
+                if skip_existing_images:
+                        # Filter out the images already tiled with these settings before any is dispatched
+                        image_paths = [paths[0] for paths in blk.pair_bulk_images([input_dir], subdirs=search_subdirs)]
+                        with TileManifest(manifest_path) as manifest:
+                                items = [(path,) for path in manifest.stale_sources(
+                                        image_paths, tile_size, tile_separation, intensity_threshold, number_threshold)]
+        
+        item_kwargs = {'output_dir': output_dir, 'output_suffix': output_suffix, 'manifest_path': manifest_path,
+                       'diff_separation': diff_separation, 'tile_size': tile_size,
+                       'tile_separation': tile_separation, 'intensity_threshold': intensity_threshold,
+                       'number_threshold': number_threshold, 'skip_existing_images': skip_existing_images,
+                       'read_regions': read_regions, 'use_tile_store': use_tile_store}
+        
+        return blk.bulk_map(_extract_image_tiles_to_subdir, [input_dir], item_kwargs=item_kwargs,
+                            subdirs=search_subdirs, num_workers=num_workers, items=items)
 
 
 def get_tile_indices(str_indices):
@@ -214,6 +912,19 @@ def get_tile_indices(str_indices):
         return x, y
 
 
+def _label_coordinates(labels):
+        """Parse the first two integers out of every tile or ROI label, e.g. '3x-4y' or 'ROI3x4y'"""
+        coordinates = pd.Index(labels).astype(str).str.extract(r'(\d+)\D+(\d+)').astype(int)
+        return coordinates[0].to_numpy(), coordinates[1].to_numpy()
+
+
+def _values_from_series(pd_series, col_label):
+        """Values of the column being reconstructed, from either a dataframe or a single series"""
+        if isinstance(pd_series, pd.DataFrame):
+                return pd_series[col_label].to_numpy()
+        return pd_series.to_numpy()
+
+
 def tile_values_to_image(pd_series, img_dims, col_label):
         """
         Inputs: number of x, and y tiles in xy dims
@@ -222,12 +933,8 @@ def tile_values_to_image(pd_series, img_dims, col_label):
         
         img = np.zeros(img_dims)
         
-        for i in pd_series.index:
-                indexes = re.findall(r'(\d+)', i[2])
-                x = int(indexes[0]) - 1
-                y = int(indexes[1]) - 1
-                
-                img[x, y] = pd_series.get_value(i, col_label)
+        x, y = _label_coordinates(pd_series.index.get_level_values(2))
+        img[x - 1, y - 1] = _values_from_series(pd_series, col_label)
         
         return img
 
@@ -250,29 +957,18 @@ def get_roi_indices(multi_index, rois_per_tile=8):
 def roi_values_to_sitk_image_array(pd_series, img_dims, col_label, rois_per_tile=8, threshold=0):
         img = np.zeros(img_dims)
         
-        for i in pd_series.index:
-                if i[3] == 'Full-tile':
-                        continue
-                
-                tile_locs = re.findall(r'(\d+)', i[2])
-                tile_x = int(tile_locs[0])
-                tile_y = int(tile_locs[1])
-                
-                roi_locs = re.findall(r'(\d+)', i[3])
-                roi_x = int(roi_locs[0])
-                roi_y = int(roi_locs[1])
-                
-                x = tile_x * rois_per_tile + roi_x
-                y = tile_y * rois_per_tile + roi_y
-                
-                value = pd_series.get_value(i, col_label)
-
-                # The xy values are switched when converting back to a sitk image, and were flipped in the roi names earlier
-                try:
-                        if value > threshold:
-                                img[y, x] = value
-                except:
-                        if value[0] > threshold:
-                                img[y, x] = value[0]
+        roi_labels = pd_series.index.get_level_values(3)
+        keep = np.asarray((roi_labels != 'Full-tile') & ~pd_series.index.duplicated(keep='first'))
+        
+        values = _values_from_series(pd_series, col_label)[keep]
+        tile_x, tile_y = _label_coordinates(pd_series.index.get_level_values(2)[keep])
+        roi_x, roi_y = _label_coordinates(roi_labels[keep])
+        
+        x = tile_x * rois_per_tile + roi_x
+        y = tile_y * rois_per_tile + roi_y
+        
+        # The xy values are switched when converting back to a sitk image, and were flipped in the roi names earlier
+        above = values > threshold
+        img[y[above], x[above]] = values[above]
         
         return img
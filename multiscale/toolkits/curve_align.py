@@ -17,7 +17,6 @@ import scipy.io as sio
 from pathlib import Path
 import datetime
 import tarfile
-import csv
 
 
 def create_rois_from_tile(tile, roi_size):
@@ -105,7 +104,7 @@ def process_image_to_rois(image_path, output_dir, output_suffix='Tile',
                           tile_size=np.array([512, 512]), tile_separation=np.array([512, 512]),
                           roi_size=np.array([64, 64]),
                           intensity_threshold=1, number_threshold=10,
-                          skip_existing_images=True):
+                          skip_existing_images=True, read_regions=False):
         """
         Separate a large stitched image into curve align tiles and ROIs, thresohlding out blank tiles
 
@@ -118,24 +117,35 @@ def process_image_to_rois(image_path, output_dir, output_suffix='Tile',
         :param intensity_threshold: The pixel value above which pixels are conisdered signal
         :param number_threshold: Percentage of pixels above the threshold needed to write out the tile
         :param skip_existing_images: Whether or not to overwrite existing outputs
+        :param read_regions: Read the image one tile region at a time, for images too large to hold in memory
 
         :return:
         """
-        image = sitk.ReadImage(str(image_path))
-        image_array = sitk.GetArrayFromImage(image)
-        max_value = np.max(image_array)
+        if read_regions:
+                regions = til.ImageRegions(image_path)
+                max_value = til.streaming_image_max(image_path, regions=regions)
+                tiles = (
+                        (tile, tile_number) for tile, tile_number in
+                        til.generate_region_tile(image_path, tile_size, tile_separation=tile_separation,
+                                                 regions=regions)
+                        if til.tile_passes_threshold(tile, intensity_threshold, number_threshold, max_value))
+        else:
+                image = sitk.ReadImage(str(image_path))
+                image_array = sitk.GetArrayFromImage(image)
+                max_value = np.max(image_array)
+                
+                grid = til.TileGrid(image_array, tile_size, tile_separation=tile_separation)
+                tiles = grid.passing_tiles(intensity_threshold, number_threshold, max_value)
         
-        for tile, tile_number in til.generate_tile(image_array, tile_size, tile_separation=tile_separation):
+        for tile, tile_number in tiles:
+                separate_rois = {'separate_rois': create_rois_from_tile(tile, roi_size)}
+                save_rois(image_path, output_dir, output_suffix,
+                          tile_number, separate_rois,
+                          skip_existing_images=skip_existing_images)
                 
-                if til.tile_passes_threshold(tile, intensity_threshold, number_threshold, max_value):
-                        separate_rois = {'separate_rois': create_rois_from_tile(tile, roi_size)}
-                        save_rois(image_path, output_dir, output_suffix,
-                                  tile_number, separate_rois,
-                                  skip_existing_images=skip_existing_images)
-                        
-                        til.write_tile(tile, image_path, output_dir, output_suffix,
-                                       tile_number[0], tile_number[1],
-                                       skip_existing_images=skip_existing_images)
+                til.write_tile(tile, image_path, output_dir, output_suffix,
+                               tile_number[0], tile_number[1],
+                               skip_existing_images=skip_existing_images)
 
 
 def construct_job_file(tile_list, job_path):
@@ -241,7 +251,7 @@ def create_batches_for_chtc(input_dir, output_dir, output_suffix,
 
 
 def read_stats_file(stats_file):
-        dirty_df = pd.read_csv(stats_file, delimiter='\t', header=None)
+        dirty_df = pd.read_csv(stats_file, delimiter='\t', header=None, usecols=[1], nrows=5)
         orientation = dirty_df[1].loc[0]
         alignment = dirty_df[1].loc[4]
         
@@ -281,52 +291,52 @@ def bulk_extract_tar(tar_dir: Path, output_dir: Path):
                 os.remove(tar)
 
 
-def scrape_tiles(tile_dir, tile_output_dir, output_suffix):
+def scrape_tiles(tile_dir, tile_output_dir, output_suffix, extension='.csv'):
         """
         Convert a mass of CurveAlign tile output into a single file holding
         :param tile_dir:
         :param tile_output_dir:
         :param output_suffix:
+        :param extension: Results file extension: .csv, or .parquet/.arrow for columnar output
         :return:
         """
         tile_files = util.list_filetype_in_dir(tile_dir, 'stats.csv')
-        csv_path = Path(tile_output_dir, 'Curve_Align_results_Tiles_' + output_suffix + '.csv')
+        results_path = Path(tile_output_dir, 'Curve_Align_results_Tiles_' + output_suffix + extension)
         print('Scraping results from {0}'.format(tile_dir))
         
-        with open(csv_path, 'w', newline='') as csvfile:
-                writer = csv.writer(csvfile)
-                writer.writerow(['Sample', 'Modality', 'Tile', 'Orientation', 'Alignment'])
-                
-                for tile_path in tile_files:
+        columns = {'Sample': 'str', 'Modality': 'str', 'Tile': 'str', 'Orientation': 'float', 'Alignment': 'float'}
+        
+        with blk.ResultsWriter(results_path, columns) as writer:
+                for tile_path, (orientation, alignment) in zip(tile_files,
+                                                               blk.prefetched(read_stats_file, tile_files)):
                         sample, modality, tile = blk.file_name_parts(tile_path)[:3]
-                        orientation, alignment = read_stats_file(tile_path)
                         if 'NaN' in str(alignment):
                                 continue
                                 
-                        writer.writerow([sample, modality, tile, orientation, alignment])
+                        writer.write_row([sample, modality, tile, orientation, alignment])
 
 
-def scrape_rois(roi_dir, roi_output_dir, output_suffix):
+def scrape_rois(roi_dir, roi_output_dir, output_suffix, extension='.csv'):
         roi_files = util.list_filetype_in_dir(roi_dir, 'stats.csv')
-        csv_path = Path(roi_output_dir, 'Curve_Align_results_ROIs_' + output_suffix + '.csv')
+        results_path = Path(roi_output_dir, 'Curve_Align_results_ROIs_' + output_suffix + extension)
         print('Scraping results from {0}'.format(roi_dir))
         
-        with open(csv_path, 'w', newline='') as csvfile:
-                writer = csv.writer(csvfile)
-                writer.writerow(['Sample', 'Modality', 'Tile', 'ROI', 'Orientation', 'Alignment'])
-                
-                for roi_path in roi_files:
+        columns = {'Sample': 'str', 'Modality': 'str', 'Tile': 'str', 'ROI': 'str',
+                   'Orientation': 'float', 'Alignment': 'float'}
+        
+        with blk.ResultsWriter(results_path, columns) as writer:
+                for roi_path, (orientation, alignment) in zip(roi_files,
+                                                              blk.prefetched(read_stats_file, roi_files)):
                         sample, modality, tile, roi = blk.file_name_parts(roi_path)[:4]
-                        orientation, alignment = read_stats_file(roi_path)
                         if 'NaN' in str(alignment):
                                 continue
                                 
-                        writer.writerow([sample, modality, tile, roi, orientation, alignment])
+                        writer.write_row([sample, modality, tile, roi, orientation, alignment])
 
 
 def read_features_file(file_path):
         try:
-                df_features = pd.read_csv(file_path, header=None)
+                df_features = pd.read_csv(file_path, header=None, usecols=[0])
         except ValueError:
                 return np.nan, np.nan
         
@@ -337,22 +347,22 @@ def read_features_file(file_path):
         return num_fibers, fib_segments
 
 
-def scrape_roi_fiber_nums(roi_dir, roi_output_dir, output_suffix):
+def scrape_roi_fiber_nums(roi_dir, roi_output_dir, output_suffix, extension='.csv'):
         roi_files = util.list_filetype_in_dir(roi_dir, 'fibFeatures.csv')
-        csv_path = Path(roi_output_dir, 'Curve_Align_results_ROIs_' + output_suffix + '.csv')
+        results_path = Path(roi_output_dir, 'Curve_Align_results_ROIs_' + output_suffix + extension)
         print('Scraping results from {0}'.format(roi_dir))
         
-        with open(csv_path, 'w', newline='') as csvfile:
-                writer = csv.writer(csvfile)
-                writer.writerow(['Sample', 'Modality', 'Tile', 'ROI', 'Number of fibers', 'Fiber segments'])
-                
-                for roi_path in roi_files:
+        columns = {'Sample': 'str', 'Modality': 'str', 'Tile': 'str', 'ROI': 'str',
+                   'Number of fibers': 'float', 'Fiber segments': 'float'}
+        
+        with blk.ResultsWriter(results_path, columns) as writer:
+                for roi_path, (num_fibers, fib_segments) in zip(roi_files,
+                                                                blk.prefetched(read_features_file, roi_files)):
                         sample, modality, tile, roi = blk.file_name_parts(roi_path)[:4]
-                        num_fibers, fib_segments = read_features_file(roi_path)
                         if num_fibers is np.nan:
                                 continue
                         
-                        writer.writerow([sample, modality, tile, roi, num_fibers, fib_segments])
+                        writer.write_row([sample, modality, tile, roi, num_fibers, fib_segments])
 
 
 def scrape_features(curve_dir, modality_str, output_suffix):
@@ -362,19 +372,20 @@ def scrape_features(curve_dir, modality_str, output_suffix):
         scrape_roi_fiber_nums(roi_dir, roi_output_dir, output_suffix)
 
 
-def scrape_results(curve_dir, modality_str, output_suffix):
+def scrape_results(curve_dir, modality_str, output_suffix, extension='.csv'):
         """
         Convert CurveAlign ROI and Tile analysis files into a single csv document for orientation and alignment
         :param curve_dir: Directory where the CurveAlign output was printed to
         :param modality_str: What modality was used to take the data, in format (Sample-name_Modality_...tif)
         :param output_suffix: What to label the output csv file
+        :param extension: Results file extension: .csv, or .parquet/.arrow for columnar output
         :return:
         """
         tile_dir = Path(curve_dir, r'images\CA_Out')
         if tile_dir.exists():
                 tile_output_dir = Path(curve_dir, 'Tile')
                 os.makedirs(tile_output_dir, exist_ok=True)
-                scrape_tiles(tile_dir, tile_output_dir, output_suffix)
+                scrape_tiles(tile_dir, tile_output_dir, output_suffix, extension=extension)
                 print('Done')
         
         roi_dir = Path(curve_dir, r'images\CA_ROI\Batch\ROI_post_analysis')
@@ -385,11 +396,11 @@ def scrape_results(curve_dir, modality_str, output_suffix):
                 
         roi_output_dir = Path(curve_dir, 'ROI')
         os.makedirs(roi_output_dir, exist_ok=True)
-        scrape_rois(roi_dir, roi_output_dir, output_suffix)
+        scrape_rois(roi_dir, roi_output_dir, output_suffix, extension=extension)
 
 
 def load_dataframe(csv_path):
-        raw_df = pd.read_csv(csv_path)
+        raw_df = blk.read_results(csv_path)
         
         clean_df = pd.pivot_table(raw_df, index=['Sample', 'Tile', 'ROI'],
                                   values=['Alignment', 'Orientation'],
@@ -8,10 +8,10 @@ Created on Tue Mar 20 10:50:24 2018
 """
 
 import multiscale.bulk_img_processing as blk
+import multiscale.tiling as til
 import os
 from PIL import Image
 from ssim.ssimlib import SSIM
-import csv
 
 
 def compare_ssim(one_path, two_path):
@@ -54,27 +54,28 @@ def bulk_compare_ssim(dir_list,
         
         output_path = os.path.join(output_dir, output_name)
         
-        for image_index in range(num_images):
+        with blk.buffered_results():
+                for image_index in range(num_images):
                 
-                core_name = blk.get_core_file_name(path_lists[0][image_index])
+                        core_name = blk.get_core_file_name(path_lists[0][image_index])
                 
-                for index_one in range(num_dirs - 1):
-                        for index_two in range(index_one + 1, num_dirs):
-                                ssim = compare_ssim(path_lists[index_one][image_index],
-                                                    path_lists[index_two][image_index])
+                        for index_one in range(num_dirs - 1):
+                                for index_two in range(index_one + 1, num_dirs):
+                                        ssim = compare_ssim(path_lists[index_one][image_index],
+                                                            path_lists[index_two][image_index])
                                 
-                                modality_one = blk.file_name_parts(
-                                        path_lists[index_one][image_index])[1]
-                                modality_two = blk.file_name_parts(
-                                        path_lists[index_two][image_index])[1]
+                                        modality_one = blk.file_name_parts(
+                                                path_lists[index_one][image_index])[1]
+                                        modality_two = blk.file_name_parts(
+                                                path_lists[index_two][image_index])[1]
                                 
-                                column = modality_one + '-' + modality_two
+                                        column = modality_one + '-' + modality_two
                                 
-                                blk.write_pandas_value(output_path, core_name, ssim, column,
-                                                       'Sample')
+                                        blk.write_pandas_value(output_path, core_name, ssim, column,
+                                                               'Sample')
 
 
-def calculate_ssim_across_two_lists(list_one: list, list_two: list, writer: csv.writer):
+def calculate_ssim_across_two_lists(list_one: list, list_two: list, writer: blk.ResultsWriter):
         num_images = len(list_one)
         for image_index in range(num_images):
                 ssim_value = compare_ssim(list_one[image_index], list_two[image_index])
@@ -85,7 +86,7 @@ def calculate_ssim_across_two_lists(list_one: list, list_two: list, writer: csv.
                 mouse, slide = sample.split('-')
                 modality_pair = modality_one + '-' + modality_two
                 
-                writer.writerow([mouse, slide, tile, modality_pair, ssim_value])
+                writer.write_row([mouse, slide, tile, modality_pair, ssim_value])
 
 
 def calculate_ssim_across_multiple_directories(list_input_dirs, dir_output, name_output, file_parts_to_compare=[0]):
@@ -94,18 +95,21 @@ def calculate_ssim_across_multiple_directories(list_input_dirs, dir_output, name
         Inputs:
         dir_list -- The list of dirs to compare between
         output_dir -- Directory to save the cw-ssim values
-        output_name -- Filename for the CW-SSIM value file
+        output_name -- Filename for the CW-SSIM value file.  A .parquet or .arrow extension writes a columnar file
+        
+        Directories tiled with a tile manifest are paired through their manifests, by sample and tile position
         """
-        path_lists = blk.find_bulk_shared_images(list_input_dirs, file_parts_to_compare=file_parts_to_compare,
-                                                 subdirs=True)
+        if all(til.tile_manifest_path(input_dir).is_file() for input_dir in list_input_dirs):
+                path_lists = til.find_shared_tiles(list_input_dirs)
+        else:
+                path_lists = blk.find_bulk_shared_images(list_input_dirs, file_parts_to_compare=file_parts_to_compare,
+                                                         subdirs=True)
         num_dirs = len(list_input_dirs)
         
         output_path = os.path.join(dir_output, name_output)
+        columns = {'Mouse': 'str', 'Slide': 'str', 'Tile': 'str', 'Modality pair': 'str', 'CW-SSIM': 'float'}
         
-        with open(output_path, 'w', newline='') as csvfile:
-                writer = csv.writer(csvfile)
-                writer.writerow(['Mouse', 'Slide', 'Tile', 'Modality pair', 'CW-SSIM'])
-                
+        with blk.ResultsWriter(output_path, columns) as writer:
                 for index_one in range(num_dirs - 1):
                         for index_two in range(index_one + 1, num_dirs):
                                 calculate_ssim_across_two_lists(path_lists[index_one], path_lists[index_two], writer)
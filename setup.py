@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 from setuptools import setup, find_packages
+import re
 
 
 with open('README.md') as f:
@@ -8,9 +9,12 @@ with open('README.md') as f:
 with open('LICENSE.txt') as f:
     license = f.read()
 
+with open('multiscale/__init__.py') as f:
+    version = re.search(r"__version__ = '(.*)'", f.read()).group(1)
+
 setup(
     name='multiscale_imaging',
-    version='0.2.1',
+    version=version,
     author='Michael Pinkert',
     author_email='mpinkert@wisc.edu',
     description='An multiscale image processing library for the Laboratory of Optical and Computational Instrumentation',